@@ -1,23 +1,80 @@
 from socket import *
+from select import select
 
+import errno
 import logging
 import pickle
+import struct
 import sys
 import os
 
+
+def _libc_sendfile():
+    """Wrap the sendfile system call of the C library with the signature
+    of os.sendfile, for python 2 on Linux. Return None if the C library
+    has no Linux sendfile.
+
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        # sendfile64 takes a 64 bits offset on 32 bits systems as well
+        c_sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    c_sendfile.restype = ctypes.c_ssize_t
+
+    def libc_sendfile(out_fd, in_fd, offset, count):
+        sent = c_sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return libc_sendfile
+
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # pysendfile package for python 2
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = _libc_sendfile()
+
 END_MSG = '\r\n\n'
 ACK = "0"
 ERR = "1"
 BUFFER_SIZE = 4096
+SENDFILE_CHUNK_SIZE = 8*1024**2
+RANGE_BUFFER_SIZE = 64*1024
 DUMMY = "DUMMY"
 
+# framed mode: every message is preceded by its length
+HEADER = struct.Struct('>I')
+FILE_HEADER = struct.Struct('>Q')
+# under this size, a message and its header (or end marker) are sent in
+# one call to avoid the Nagle/delayed ACK stall of two small consecutive
+# writes
+SMALL_MSG_SIZE = 64*1024
+
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 class MessageExchanger:
-    def __init__(self, sock):
+    def __init__(self, sock, framed=False):
+        """Wrap a connected socket. When framed is True, messages are sent
+        with a length header instead of the end marker. Both ends of
+        the connection must use the same mode.
+
+        """
         self.sock = sock
+        self.framed = framed
 
     def send_ack(self):
         logger.debug("SEND ACK")
@@ -32,40 +89,82 @@ class MessageExchanger:
         self.send(DUMMY)
     
     def send(self, msg, ack=False):
-        """Send a message through the socket as well as the end marker. Wait
-        for acknowledgment if ack is True.
+        """Send a message through the socket as well as the end marker (or
+        its length header in framed mode). Wait for acknowledgment if
+        ack is True.
 
         """
-        self.sock.send(msg)
-        logger.debug("SEND: " + msg)
-        self.sock.send(END_MSG)
+        if self.framed:
+            header = HEADER.pack(len(msg))
+            if len(msg) < SMALL_MSG_SIZE:
+                self.sock.sendall(header + msg)
+            else:
+                self.sock.sendall(header)
+                self.sock.sendall(msg)
+        elif len(msg) < SMALL_MSG_SIZE:
+            self.sock.sendall(msg + END_MSG)
+        else:
+            self.sock.sendall(msg)
+            self.sock.sendall(END_MSG)
+        logger.debug("SEND: %s", msg)
         if ack:
             ack_val = self.recv()
             return ack_val == ACK
         return True
 
     def recv(self):
-        """Read the content in the socket until the end marker is reached.
+        """Read the content in the socket until the end marker is reached, or
+        read exactly the announced length in framed mode. Return None
+        if the connection has been closed by the other end.
 
         """
-        msg = ''
-        l = len(END_MSG)
+        if self.framed:
+            return self.__recv_framed()
+        buf = bytearray()
         while True:
             shard = self.sock.recv(BUFFER_SIZE)
-            logger.debug("SHARD: " + shard)
-            if shard[-l:] == END_MSG:
-                msg += shard[:-l]
+            if not shard:
+                return None
+            buf.extend(shard)
+            # check the tail of the whole buffer so that a marker split
+            # across two shards is still detected
+            if buf.endswith(END_MSG):
                 break
-            else:
-                msg += shard
-        logger.debug("RECV: " + msg)
+        msg = str(buf[:-len(END_MSG)])
+        logger.debug("RECV: %s", msg)
+        return msg
+
+    def __recv_framed(self):
+        raw_len = self.recvall(HEADER.size)
+        if raw_len is None:
+            return None
+        msg = self.recvall(HEADER.unpack(raw_len)[0])
+        logger.debug("RECV: %s", msg)
         return msg
+
+    def recvall(self, n):
+        """Receive exactly n bytes into one preallocated buffer. Return None
+        if EOF is hit before.
+
+        """
+        buf = bytearray(n)
+        view = memoryview(buf)
+        received = 0
+        while received < n:
+            nbytes = self.sock.recv_into(view[received:], n - received)
+            if not nbytes:
+                return None
+            received += nbytes
+        return str(buf)
         
     def pkl_send(self, obj, ack=False):
         """Pickle an object and send it through the socket with the end marker.
+        Binary pickles may contain the end marker, so they are only used
+        in framed mode.
 
         """
-        str_obj = pickle.dumps(obj)
+        protocol = pickle.HIGHEST_PROTOCOL if self.framed else 0
+        str_obj = pickle.dumps(obj, protocol)
         return self.send(str_obj, ack=ack)
 
     def pkl_recv(self):
@@ -73,19 +172,94 @@ class MessageExchanger:
 
         """
         str_obj = self.recv()
+        if str_obj is None:
+            return None
         return pickle.loads(str_obj)
 
-    def file_send(self, f_path):
+    def file_send(self, f_path, chunk_size=SENDFILE_CHUNK_SIZE, zero_copy=True):
+        """Send a file through the socket followed by the end marker (or
+        preceded by its size in framed mode). When zero_copy is True
+        and sendfile is available, the file is copied to the socket by
+        the kernel, chunk_size bytes at a time.
+
+        """
         logger.debug("SEND FILE " + f_path)
+        f_size = os.path.getsize(f_path)
+        if self.framed:
+            self.sock.sendall(FILE_HEADER.pack(f_size))
+        self.range_send(f_path, 0, f_size, chunk_size, zero_copy)
+        if not self.framed:
+            self.sock.sendall(END_MSG)
+
+    def range_send(self, f_path, offset, length, chunk_size=SENDFILE_CHUNK_SIZE, zero_copy=True):
+        """Send length bytes of a file starting at offset, without end
+        marker nor header: the receiver must know the length.
+
+        """
         with open(f_path, "rb") as f_to_send:
-            data = True
-            while data:
-                data = f_to_send.read(BUFFER_SIZE)
-                self.sock.send(data)
-        self.sock.send(END_MSG)
+            sent = 0
+            if zero_copy and sendfile is not None:
+                sent = self.__sendfile(f_to_send, offset, length, chunk_size)
+            f_to_send.seek(offset + sent)
+            # fallback when sendfile is unavailable or not supported for this file
+            while sent < length:
+                data = f_to_send.read(min(chunk_size, length - sent))
+                if not data:
+                    break
+                self.sock.sendall(data)
+                sent += len(data)
+
+    def __sendfile(self, f_to_send, offset, length, chunk_size):
+        """Copy a part of an open file to the socket in kernel space and
+        return the number of bytes sent, 0 if sendfile does not support
+        this file.
+
+        """
+        in_fd = f_to_send.fileno()
+        out_fd = self.sock.fileno()
+        sent = 0
+        while sent < length:
+            try:
+                nbytes = sendfile(out_fd, in_fd, offset + sent, min(chunk_size, length - sent))
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    select([], [self.sock], [])
+                    continue
+                elif sent == 0 and e.errno in (errno.EINVAL, errno.ENOSYS):
+                    return 0
+                raise
+            if nbytes == 0: # file truncated while sending
+                break
+            sent += nbytes
+        return sent
+
+    def range_recv(self, f_name, offset, length):
+        """Receive exactly length bytes and write them at offset in an
+        existing file. Return False if the connection is closed before.
+
+        """
+        buf = bytearray(min(length, RANGE_BUFFER_SIZE))
+        view = memoryview(buf)
+        received = 0
+        out_f = os.open(f_name, os.O_WRONLY)
+        try:
+            os.lseek(out_f, offset, os.SEEK_SET)
+            while received < length:
+                nbytes = self.sock.recv_into(view, min(len(buf), length - received))
+                if not nbytes:
+                    return False
+                written = 0
+                while written < nbytes:
+                    written += os.write(out_f, view[written:nbytes])
+                received += nbytes
+        finally:
+            os.close(out_f)
+        return True
 
     def file_recv(self, f_name, f_size=None, progress=True):
         logger.debug("RECV FILE " + f_name)
+        if self.framed:
+            return self.__file_recv_framed(f_name, progress)
         l = len(END_MSG)
 
         total_size = 0
@@ -113,3 +287,31 @@ class MessageExchanger:
         if progress:
             print
         os.close(out_f)
+
+    def __file_recv_framed(self, f_name, progress=True):
+        raw_size = self.recvall(FILE_HEADER.size)
+        if raw_size is None:
+            return False
+        f_size = FILE_HEADER.unpack(raw_size)[0]
+
+        if progress:
+            sys.stdout.write("Downloading file...")
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        total_size = 0
+        out_f = os.open(f_name, os.O_WRONLY|os.O_CREAT|os.O_TRUNC)
+        try:
+            while total_size < f_size:
+                nbytes = self.sock.recv_into(view, min(BUFFER_SIZE, f_size - total_size))
+                if not nbytes:
+                    return False
+                os.write(out_f, view[:nbytes])
+                total_size += nbytes
+                if progress:
+                    perc = int(100.*total_size/f_size)
+                    sys.stdout.write("\rDownloading file... %3d%%" % perc)
+        finally:
+            os.close(out_f)
+            if progress:
+                print
+        return True
@@ -0,0 +1,90 @@
+from select import select
+from socket import *
+from threading import Lock
+
+import logging
+import time
+import CommunicationProtocol as proto
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# idle connections are closed after this many seconds, peers close them
+# after PEER_IDLE_TIMEOUT
+IDLE_TIMEOUT = 30
+PEER_IDLE_TIMEOUT = 2*IDLE_TIMEOUT
+
+class ConnectionPool:
+    """Keep-alive connections to the other peers, keyed by peer address.
+    A connection is taken from the pool for a request and given back
+    once the request is over, so that the next requests to the same
+    peer do not pay for a new connection. Connections left unused for
+    more than idle_timeout seconds are closed.
+
+    """
+    def __init__(self, framed=False, idle_timeout=IDLE_TIMEOUT):
+        self.framed = framed
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = Lock()
+
+    def __evict(self):
+        deadline = time.time() - self.idle_timeout
+        for key in self.idle.keys():
+            kept = []
+            for msg_exch, last_used in self.idle[key]:
+                if last_used < deadline:
+                    msg_exch.sock.close()
+                else:
+                    kept.append((msg_exch, last_used))
+            if kept:
+                self.idle[key] = kept
+            else:
+                del self.idle[key]
+
+    def acquire(self, addr, port):
+        """Return a MessageExchanger connected to a peer, reusing an idle
+        connection when one is still open. Raise socket.error if a new
+        connection cannot be established.
+
+        """
+        key = (addr, port)
+        with self.lock:
+            self.__evict()
+            connections = self.idle.get(key, [])
+            while connections:
+                msg_exch, last_used = connections.pop()
+                # an idle connection is readable only if the peer closed it
+                readable, _, _ = select([msg_exch.sock], [], [], 0)
+                if not readable:
+                    return msg_exch
+                msg_exch.sock.close()
+        logger.debug("New connection to %s:%d", addr, port)
+        peer_so = socket(AF_INET, SOCK_STREAM)
+        try:
+            peer_so.connect(key)
+        except error:
+            peer_so.close()
+            raise
+        return proto.MessageExchanger(peer_so, framed=self.framed)
+
+    def release(self, addr, port, msg_exch):
+        """Give back a connection after a successful request.
+
+        """
+        with self.lock:
+            self.idle.setdefault((addr, port), []).append((msg_exch, time.time()))
+
+    def discard(self, msg_exch):
+        """Close a connection left in an unknown state by a failed request.
+
+        """
+        msg_exch.sock.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for msg_exch, last_used in connections:
+                    msg_exch.sock.close()
+            self.idle = {}
@@ -0,0 +1,73 @@
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+import hashlib
+import os
+
+# size of the blocks read to hash a file
+HASH_BLOCK_SIZE = 1024**2
+
+
+def hash_file(f_path):
+    """Return the hexadecimal SHA-1 digest of the content of a file.
+
+    """
+    checksum = hashlib.sha1()
+    with open(f_path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            checksum.update(block)
+    return checksum.hexdigest()
+
+class FileHasher:
+    """Compute the content hashes of files in a pool of worker threads.
+    The hashes are cached by path with the modification time and the
+    size of the file, so a file is only hashed again once it changed.
+
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.pool = None
+        self.cache = {}
+        self.lock = Lock()
+
+    def cached(self, f_path):
+        """Return the hash of a file if it is in the cache and the file did
+        not change since, else None.
+
+        """
+        stats = os.stat(f_path)
+        with self.lock:
+            cached = self.cache.get(f_path)
+        if cached is not None and cached[0] == (stats.st_mtime, stats.st_size):
+            return cached[1]
+        return None
+
+    def __hash_cached(self, f_path):
+        f_hash = self.cached(f_path)
+        if f_hash is not None:
+            return f_hash
+        # stat before reading: a change during the hash is seen next time
+        stats = os.stat(f_path)
+        f_hash = hash_file(f_path)
+        with self.lock:
+            self.cache[f_path] = ((stats.st_mtime, stats.st_size), f_hash)
+        return f_hash
+
+    def imap(self, f_paths):
+        """Return an iterator over the hashes of the files, in order. The
+        files are hashed in the background while the first hashes are
+        consumed.
+
+        """
+        if self.pool is None:
+            # created on first use: the pool threads do not survive a fork
+            self.pool = ThreadPool(self.workers)
+        return self.pool.imap(self.__hash_cached, f_paths)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -2,36 +2,80 @@
 Usage:
    python IndexingServer.py <config.json>
 """
-from multiprocessing import Process, Manager
+from multiprocessing import Process
+from multiprocessing.managers import SyncManager
+from threading import Thread, Lock
+from Queue import Queue
 from socket import *
 
 import sys
 import json
+import select
 import logging
 import CommunicationProtocol as proto
+from NameIndex import NameIndex, SEARCH_MODES
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# 'process' spawns one process per peer connection, 'thread' serves all the
+# peers from a polling loop and a pool of worker threads
+ENGINES = ['process', 'thread']
+# maximum number of files returned by one page of list_page or by find
+MAX_PAGE_SIZE = 10000
+
+class IndexManager(SyncManager):
+    pass
+
+IndexManager.register('NameIndex', NameIndex)
+
 class IndexingServer:
-    def __init__(self, listening_ip, listening_port, pool_size=10):
+    def __init__(self, listening_ip, listening_port, pool_size=10, framed=False,
+                 engine='process', workers=8):
         self.listening_ip = listening_ip
         self.listening_port = listening_port
         self.pool_size = pool_size
+        self.framed = framed
+        if engine not in ENGINES:
+            raise ValueError("engine should be one of %s" % ENGINES)
+        self.engine = engine
+        self.workers = workers
 
-        self.manager = Manager()
-        self.peers_info = self.manager.dict()
-        self.file2peers = self.manager.dict()
-        self.files_info = self.manager.dict()
+        if self.engine == 'process':
+            # handlers run in their own process: share the index through a manager
+            self.manager = IndexManager()
+            self.manager.start()
+            self.peers_info = self.manager.dict()
+            self.file2peers = self.manager.dict()
+            self.files_info = self.manager.dict()
+            self.hash2peers = self.manager.dict()
+            self.name2hashes = self.manager.dict()
+            self.name_index = self.manager.NameIndex()
+            self.index_lock = self.manager.Lock()
+        else:
+            # handlers run in threads of this process: plain dicts
+            self.peers_info = {}
+            self.file2peers = {}
+            self.files_info = {}
+            self.hash2peers = {}
+            self.name2hashes = {}
+            self.name_index = NameIndex()
+            self.index_lock = Lock()
         
         self.listening_socket = None
+        self.poller = None
+        self.connections = {}
+        self.ready_queue = Queue()
 
         self.actions = {
             'echo': self.__action_echo,
             'register': self.__action_register,
+            'register_batch': self.__action_register_batch,
             'list': self.__action_list,
+            'list_page': self.__action_list_page,
             'lookup': self.__action_lookup,
+            'find': self.__action_find,
             'close_connection': self.__action_close_connection,
             'init': self.__action_init,
             'get_peer': self.__action_get_peer
@@ -50,11 +94,12 @@ class IndexingServer:
         logger.debug("Action is an init")
         type_val = {"port": int, "addr": str}
         peerid = int(cmd_vec[1])
-        peer_dict = self.peers_info.get(peerid, {})
         k = cmd_vec[2]
         v = type_val[k](cmd_vec[3])
-        peer_dict[k] = v
-        self.peers_info[peerid] = peer_dict
+        with self.index_lock:
+            peer_dict = self.peers_info.get(peerid, {})
+            peer_dict[k] = v
+            self.peers_info[peerid] = peer_dict
         return True
 
     def __action_close_connection(self, msg_exch, cmd_vec):
@@ -62,18 +107,23 @@ class IndexingServer:
         logger.info("Closing connection to peer " + str(peerid))
         
         # remove all files registered by this peer
-        if 'files' in self.peers_info[peerid]:
-            for f_name in self.peers_info[peerid]['files']:
-                l = self.file2peers[f_name]
-                l.remove(peerid)
-                # if no other peer has this file, remove entry
-                if not l:
-                    del self.file2peers[f_name]
-                    del self.files_info[f_name]
-                # else update list of peers
-                else:
-                    self.file2peers[f_name] = l
-        del self.peers_info[peerid]
+        with self.index_lock:
+            self.__unindex_hashes(peerid, self.peers_info[peerid].get('hashes', {}))
+            unregistered = []
+            if 'files' in self.peers_info[peerid]:
+                for f_name in self.peers_info[peerid]['files']:
+                    l = self.file2peers[f_name]
+                    l.remove(peerid)
+                    # if no other peer has this file, remove entry
+                    if not l:
+                        del self.file2peers[f_name]
+                        del self.files_info[f_name]
+                        unregistered.append(f_name)
+                    # else update list of peers
+                    else:
+                        self.file2peers[f_name] = l
+            self.name_index.remove(unregistered)
+            del self.peers_info[peerid]
         return False
     
     def __action_echo(self, msg_exch, cmd_vec):
@@ -83,6 +133,76 @@ class IndexingServer:
         msg_exch.send(response)
         return True
 
+    def __index_hashes(self, peerid, new_hashes):
+        """Record that a peer holds the contents of the given {name: hash}
+        dictionary. Must be called with the index lock held.
+
+        """
+        new_holders = {}
+        new_names = {}
+        for f_name, f_hash in new_hashes.items():
+            holders = new_holders.get(f_hash) or self.hash2peers.get(f_hash, set())
+            holders.add(peerid)
+            new_holders[f_hash] = holders
+            hashes = new_names.get(f_name) or self.name2hashes.get(f_name, {})
+            hashes.setdefault(f_hash, set()).add(peerid)
+            new_names[f_name] = hashes
+        self.hash2peers.update(new_holders)
+        self.name2hashes.update(new_names)
+
+    def __unindex_hashes(self, peerid, old_hashes):
+        """Forget the contents of the given {name: hash} dictionary held by
+        a peer. Must be called with the index lock held.
+
+        """
+        for f_name, f_hash in old_hashes.items():
+            holders = self.hash2peers.get(f_hash, set())
+            holders.discard(peerid)
+            if holders:
+                self.hash2peers[f_hash] = holders
+            elif f_hash in self.hash2peers:
+                del self.hash2peers[f_hash]
+            hashes = self.name2hashes.get(f_name, {})
+            names_holders = hashes.get(f_hash, set())
+            names_holders.discard(peerid)
+            if not names_holders:
+                hashes.pop(f_hash, None)
+            if hashes:
+                self.name2hashes[f_name] = hashes
+            elif f_name in self.name2hashes:
+                del self.name2hashes[f_name]
+
+    def __index_files(self, peerid, f_tuples):
+        """Add the files of a peer to the index in one pass. The tuples are
+        (name, size, path), followed by the hash of the content when the
+        peer computed it.
+
+        """
+        new_info = dict((f_tuple[0], tuple(f_tuple[:3])) for f_tuple in f_tuples)
+        new_hashes = dict((f_tuple[0], f_tuple[3]) for f_tuple in f_tuples if len(f_tuple) > 3)
+        with self.index_lock:
+            self.files_info.update(new_info)
+            self.name_index.add(new_info.values())
+            # add to peer info
+            peer_dict = self.peers_info[peerid]
+            peer_dict.setdefault('files', set()).update(new_info)
+            # a name registered again may come with a new content
+            old_hashes = peer_dict.setdefault('hashes', {})
+            self.__unindex_hashes(peerid, dict((f_name, old_hashes[f_name])
+                                               for f_name in new_info if f_name in old_hashes))
+            for f_name in new_info:
+                old_hashes.pop(f_name, None)
+            old_hashes.update(new_hashes)
+            self.peers_info[peerid] = peer_dict
+            self.__index_hashes(peerid, new_hashes)
+            # add to index
+            new_index = {}
+            for f_name in new_info:
+                peers_list = self.file2peers.get(f_name, set())
+                peers_list.add(peerid)
+                new_index[f_name] = peers_list
+            self.file2peers.update(new_index)
+
     def __action_register(self, msg_exch, cmd_vec):
         logger.debug("Action is a register")
         peerid = int(cmd_vec[1])
@@ -90,20 +210,24 @@ class IndexingServer:
             f_tuple = msg_exch.pkl_recv()
             if f_tuple is None:
                 break
-            f_name = f_tuple[0]
-            # add to file info dict
-            self.files_info[f_name] = f_tuple
-            # add to peer info
-            peer_dict = self.peers_info[peerid]
-            if "files" in peer_dict:
-                peer_dict['files'].add(f_name)
-            else:
-                peer_dict['files'] = set([f_name])
-            self.peers_info[peerid] = peer_dict
-            # add to index
-            peers_list = self.file2peers.get(f_name, set())
-            peers_list.add(peerid)
-            self.file2peers[f_name] = peers_list
+            self.__index_files(peerid, [f_tuple])
+            msg_exch.send_ack()
+        msg_exch.send_ack()
+        return True
+
+    def __action_register_batch(self, msg_exch, cmd_vec):
+        """Register the files of a peer sent as lists of file tuples. Each
+        list is applied to the index in one pass and acknowledged once.
+        An empty message (None) ends the registration.
+
+        """
+        logger.debug("Action is a batched register")
+        peerid = int(cmd_vec[1])
+        while True:
+            f_tuples = msg_exch.pkl_recv()
+            if f_tuples is None:
+                break
+            self.__index_files(peerid, f_tuples)
             msg_exch.send_ack()
         msg_exch.send_ack()
         return True
@@ -111,11 +235,52 @@ class IndexingServer:
     def __action_list(self, msg_exch, cmd_vec):
         logger.debug("Action is a list")
         dummy = msg_exch.recv()
-        available_files = self.files_info.values()
+        with self.index_lock:
+            available_files = self.files_info.values()
         msg_exch.pkl_send(available_files)
         return True
 
+    def __action_list_page(self, msg_exch, cmd_vec):
+        """Send one page of the files sorted by name as a tuple (files,
+        cursor). The command is 'list_page <size>', followed by the
+        pickled cursor returned with the previous page, or None for the
+        first page; the cursor is None after the last page. File names
+        may contain spaces, so the cursor is not part of the command.
+
+        """
+        logger.debug("Action is a list_page")
+        limit = min(int(cmd_vec[1]), MAX_PAGE_SIZE)
+        after = msg_exch.pkl_recv()
+        with self.index_lock:
+            page = self.name_index.page(limit, after)
+        msg_exch.pkl_send(page)
+        return True
+
+    def __action_find(self, msg_exch, cmd_vec):
+        """Send the files whose name matches a pattern. The command is
+        'find <prefix|glob|substring>', followed by the pickled pattern,
+        which may contain spaces.
+
+        """
+        logger.debug("Action is a find")
+        mode = cmd_vec[1]
+        pattern = msg_exch.pkl_recv()
+        if mode not in SEARCH_MODES:
+            msg_exch.pkl_send([])
+            return True
+        with self.index_lock:
+            found = self.name_index.search(pattern, mode, MAX_PAGE_SIZE)
+        msg_exch.pkl_send(found)
+        return True
+
     def __action_lookup(self, msg_exch, cmd_vec):
+        """Send the address of the peers that can serve a file, with the
+        identifier to request it with. When the peers registered the
+        hash of their files, every peer holding the same content is
+        returned, whatever the name of its copy; if different contents
+        share this name, the most widespread one is chosen.
+
+        """
         logger.debug("Action is a lookup")
         dummy = msg_exch.recv()
 
@@ -123,33 +288,112 @@ class IndexingServer:
         peerid = -1
         if len(cmd_vec) > 2:
             peerid = int(cmd_vec[2])
-        if search in self.file2peers:
-            # return ids of the peers that have this file
-            to_return = []
-            for pid in self.file2peers[search]:
+        to_return = []
+        with self.index_lock:
+            hashes = self.name2hashes.get(search)
+            if hashes:
+                f_req = max(hashes, key=lambda f_hash: len(self.hash2peers.get(f_hash, ())))
+                holders = self.hash2peers.get(f_req, set())
+            else:
+                # files registered without a hash are requested by name
+                f_req = search
+                holders = self.file2peers.get(search, set())
+            for pid in holders:
                 if pid in self.peers_info and pid != peerid:
-                    to_return.append(self.peers_info[pid])
-            msg_exch.pkl_send(to_return)
-        else: # file not registered by any peer
-            msg_exch.pkl_send([])
+                    peer_dict = self.peers_info[pid]
+                    to_return.append({'addr': peer_dict['addr'], 'port': peer_dict['port'],
+                                      'file': f_req})
+        msg_exch.pkl_send(to_return)
         return True
+
+    def __handle_message(self, msg_exch):
+        """Read one command from a peer and run the matching action. Return
+        False when the connection has to be closed.
+
+        """
+        msg = msg_exch.recv()
+        if msg is None: # peer closed the connection
+            return False
+        cmd_vec = msg.split()
+        action = cmd_vec[0]
+        if action not in self.actions:
+            msg_exch.send_err()
+            return True
+        msg_exch.send_ack()
+        return self.actions[action](msg_exch, cmd_vec)
     
     def __message_handler(self, client_so, client_addr):
         logger.info("Accepted connection from %s", client_addr)
-        msg_exch = proto.MessageExchanger(client_so)
+        msg_exch = proto.MessageExchanger(client_so, framed=self.framed)
         
         open_conn = True
         while open_conn:
-            msg = msg_exch.recv()
-            cmd_vec = msg.split()
-            action = cmd_vec[0]
-            if action not in self.actions:
-                msg_exch.send_err()
-            else:
-                msg_exch.send_ack()
-                open_conn = self.actions[action](msg_exch, cmd_vec)
+            open_conn = self.__handle_message(msg_exch)
         client_so.close()
 
+    def __pool_worker(self):
+        """Serve the commands of the connections that the polling loop found
+        readable, one command at a time, then hand the connection back
+        to the polling loop.
+
+        """
+        while True:
+            fd = self.ready_queue.get()
+            client_so, msg_exch = self.connections[fd]
+            try:
+                open_conn = self.__handle_message(msg_exch)
+            except (error, EOFError, KeyError, IndexError, ValueError) as e:
+                logger.error("Error while serving connection %d: %s", fd, repr(e))
+                open_conn = False
+            except Exception:
+                # the worker must survive any request, else this connection
+                # is never re-armed and the pool shrinks
+                logger.exception("Unexpected error while serving connection %d", fd)
+                open_conn = False
+            if open_conn:
+                self.poller.modify(fd, select.EPOLLIN|select.EPOLLONESHOT)
+            else:
+                self.poller.unregister(fd)
+                del self.connections[fd]
+                client_so.close()
+
+    def __run_processes(self):
+        """Spawn a new process to handle each peer connection.
+
+        """
+        while True:
+            logger.debug("Entering the infinite loop")
+            client_so, client_addr = self.listening_socket.accept()
+            handler = Process(target=self.__message_handler, args=(client_so, client_addr))
+            handler.daemon = True
+            handler.start()
+
+    def __run_pool(self):
+        """Serve every peer from one epoll loop and a fixed pool of worker
+        threads sharing the in-process index. A connection is only
+        handed to a worker while a command is pending on it, so the
+        number of connected peers is not bounded by the pool size.
+
+        """
+        self.poller = select.epoll()
+        for i in range(self.workers):
+            worker = Thread(target=self.__pool_worker)
+            worker.daemon = True
+            worker.start()
+
+        listening_fd = self.listening_socket.fileno()
+        self.poller.register(listening_fd, select.EPOLLIN)
+        while True:
+            for fd, event in self.poller.poll():
+                if fd == listening_fd:
+                    client_so, client_addr = self.listening_socket.accept()
+                    logger.info("Accepted connection from %s", client_addr)
+                    msg_exch = proto.MessageExchanger(client_so, framed=self.framed)
+                    self.connections[client_so.fileno()] = (client_so, msg_exch)
+                    self.poller.register(client_so.fileno(), select.EPOLLIN|select.EPOLLONESHOT)
+                else:
+                    self.ready_queue.put(fd)
+
     def run(self):
         """Main function. It handles the connection from peers to the indexing
         server. Everytime a peer connects to the server, a new socket
@@ -158,21 +402,22 @@ class IndexingServer:
 
         """
         self.listening_socket = socket(AF_INET, SOCK_STREAM)
+        self.listening_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.listening_socket.bind(("0.0.0.0", self.listening_port))
         self.listening_socket.listen(self.pool_size)
         logger.info("Indexing server listening on port %d", self.listening_port)
 
         try:
-            while True:
-                logger.debug("Entering the infinite loop")
-                client_so, client_addr = self.listening_socket.accept()
-                handler = Process(target=self.__message_handler, args=(client_so, client_addr))
-                handler.daemon = True
-                handler.start()
+            if self.engine == 'thread':
+                self.__run_pool()
+            else:
+                self.__run_processes()
         except KeyboardInterrupt:
             sys.stderr.write("\r")
             logger.info("Shutting down Indexing Server.")
         finally:
+            if self.poller is not None:
+                self.poller.close()
             self.listening_socket.close()
 
 def usage_error():
@@ -0,0 +1,122 @@
+from bisect import bisect_left, bisect_right, insort
+
+import fnmatch
+import re
+
+GRAM_SIZE = 3
+SEARCH_MODES = ['prefix', 'glob', 'substring']
+BRACKETS = re.compile(r'\[[^\]]*\]')
+
+
+def prefix_end(prefix):
+    """Return the smallest string greater than every string starting with
+    prefix, or None if there is no such string.
+
+    """
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def grams(s):
+    """Return the set of substrings of length GRAM_SIZE of a string.
+
+    """
+    return set(s[i:i+GRAM_SIZE] for i in range(len(s) - GRAM_SIZE + 1))
+
+class NameIndex:
+    """Index of the registered file names. The names are kept sorted to
+    answer prefix searches and paginated listings with a binary search,
+    and a trigram index narrows down substring and glob searches to the
+    names sharing all the trigrams of the query. The index is updated
+    incrementally when files are registered and unregistered.
+
+    """
+    def __init__(self):
+        self.names = []
+        self.info = {}
+        self.gram2names = {}
+
+    def add(self, f_tuples):
+        """Add or update the files described by (name, size, path) tuples.
+
+        """
+        for f_tuple in f_tuples:
+            f_name = f_tuple[0]
+            if f_name not in self.info:
+                insort(self.names, f_name)
+                for gram in grams(f_name):
+                    self.gram2names.setdefault(gram, set()).add(f_name)
+            self.info[f_name] = f_tuple
+
+    def remove(self, f_names):
+        for f_name in f_names:
+            if f_name not in self.info:
+                continue
+            del self.info[f_name]
+            del self.names[bisect_left(self.names, f_name)]
+            for gram in grams(f_name):
+                names = self.gram2names[gram]
+                names.discard(f_name)
+                if not names:
+                    del self.gram2names[gram]
+
+    def __prefix_range(self, prefix):
+        lo = bisect_left(self.names, prefix)
+        end = prefix_end(prefix)
+        hi = len(self.names) if end is None else bisect_left(self.names, end)
+        return lo, hi
+
+    def __candidates(self, literal):
+        """Return the names containing every trigram of literal, or None when
+        literal is too short to use the trigram index.
+
+        """
+        literal_grams = grams(literal)
+        if not literal_grams:
+            return None
+        sets = sorted((self.gram2names.get(gram, set()) for gram in literal_grams), key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def search(self, pattern, mode='substring', limit=None):
+        """Return the sorted tuples of the files whose name matches pattern.
+        mode is 'prefix', 'substring' or 'glob' (shell-style wildcards).
+
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError("mode should be one of %s" % SEARCH_MODES)
+        if mode == 'prefix':
+            lo, hi = self.__prefix_range(pattern)
+            matches = self.names[lo:hi]
+        elif mode == 'substring':
+            candidates = self.__candidates(pattern)
+            if candidates is None:
+                candidates = self.names
+            matches = sorted(f_name for f_name in candidates if pattern in f_name)
+        else:
+            regex = re.compile(fnmatch.translate(pattern))
+            # literal parts of the pattern, outside of wildcards and brackets
+            chunks = re.split(r'[*?]', BRACKETS.sub('?', pattern))
+            prefix = chunks[0]
+            literals = [l for l in chunks if l]
+            candidates = None
+            if literals:
+                candidates = self.__candidates(max(literals, key=len))
+            if candidates is None:
+                lo, hi = self.__prefix_range(prefix)
+                candidates = self.names[lo:hi]
+            matches = sorted(f_name for f_name in candidates if regex.match(f_name))
+        if limit is not None:
+            matches = matches[:limit]
+        return [self.info[f_name] for f_name in matches]
+
+    def page(self, limit, after=None):
+        """Return the tuples of at most limit files whose name comes after the
+        name given as a cursor, in alphabetical order, and the cursor
+        of the next page (None when the listing is complete).
+
+        """
+        start = 0 if after is None else bisect_right(self.names, after)
+        names = self.names[start:start+limit]
+        cursor = names[-1] if start + limit < len(self.names) else None
+        return [self.info[f_name] for f_name in names], cursor
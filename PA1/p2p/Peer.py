@@ -2,7 +2,9 @@
 Usage:
     python Peer.py <config.json>
  """
-from multiprocessing import Process, Manager, Queue
+from multiprocessing import Process, Manager
+from threading import Thread
+from Queue import Queue, Empty
 from socket import *
 
 import logging
@@ -16,22 +18,32 @@ import os
 import os.path
 import time
 import random
+import string
+from ConnectionPool import ConnectionPool, PEER_IDLE_TIMEOUT
+from FileHasher import FileHasher
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 LISTENING_TIMEOUT = 0.2
+# number of files sent in one message when registering
+REGISTER_CHUNK_SIZE = 1000
+# number of files received in one message when listing
+LIST_PAGE_SIZE = 1000
+# size of the parts of a file downloaded in parallel from several peers
+DOWNLOAD_CHUNK_SIZE = 4*1024**2
 
 
 class Peer:
     def __init__(self, listening_ip, listening_port, idxserv_ip, idxserv_port,
-                 pool_size=10, files_regex="./*", download_dir="./"):
+                 pool_size=10, files_regex="./*", download_dir="./", framed=False):
         self.listening_ip = listening_ip
         self.listening_port = listening_port
         
         self.idxserv_ip = idxserv_ip
         self.idxserv_port = idxserv_port
         self.pool_size = pool_size
+        self.framed = framed
         self.files_regex = files_regex
         self.download_dir = os.path.abspath(download_dir)
         if not os.path.isdir(self.download_dir):
@@ -42,13 +54,14 @@ class Peer:
         self.idxserv_socket = None
         self.idxserv_msg_exch = None
         self.peer_socket = None
+        self.peer_pool = ConnectionPool(framed=self.framed)
 
         self.manager = Manager()
         self.files_dict = self.manager.dict()
+        # the same files indexed by the SHA-1 of their content
+        self.hash_dict = self.manager.dict()
         self.server_running = self.manager.Value('i', 0)
-        
-        # TODO (optional): create checksum of each file using hashlib
-        # to identify it instead of identifying it by its name.
+        self.hasher = FileHasher()
         
         self.ui_actions = {
             'exit': self.__ui_action_exit,
@@ -56,6 +69,7 @@ class Peer:
             'lookup': self.__ui_action_lookup,
             'register': self.__ui_action_register,
             'list': self.__ui_action_list,
+            'find': self.__ui_action_find,
             'getid': self.__ui_action_getid,
             'echo': self.__ui_action_echo,
             'search': self.__ui_action_search,
@@ -63,7 +77,8 @@ class Peer:
         }
 
         self.client_actions = {
-            'obtain': self.__client_action_obtain
+            'obtain': self.__client_action_obtain,
+            'obtain_range': self.__client_action_obtain_range
         }
         
     def __IS_print(self, msg):
@@ -73,20 +88,49 @@ class Peer:
     def __block_print(self, msg, col_width=80):
         print textwrap.fill(textwrap.dedent(msg).strip(), width=80)
 
+    def __shared_file(self, f_req):
+        """Return the tuple of a file shared by this peer, requested either
+        by its name or by the hash of its content, or None.
+
+        """
+        f_tuple = self.files_dict.get(f_req)
+        if f_tuple is None:
+            f_tuple = self.hash_dict.get(f_req)
+        return f_tuple
+
     def __client_action_obtain(self, msg_exch, cmd_vec):
         msg_exch.recv() # dummy
         f_req = cmd_vec[1]
-        files_dict = self.files_dict
-        logger.debug("FILES DICT KEYS: " + str(files_dict.keys()))
-        if f_req in files_dict:
-            f_name, f_size, f_path = files_dict[f_req]
+        f_tuple = self.__shared_file(f_req)
+        if f_tuple is not None:
+            f_name, f_size, f_path = f_tuple
             ack = msg_exch.pkl_send(f_size, ack=True)
             if ack:
                 logger.debug("ACK: " + str(ack))
                 msg_exch.file_send(f_path)
             else:
                 logger.debug("ACK not ok")
-        return False
+        else:
+            msg_exch.pkl_send(None)
+        # keep the connection open for the next requests of this peer
+        return True
+
+    def __client_action_obtain_range(self, msg_exch, cmd_vec):
+        """Send the size of a file (None if it is not registered here) and,
+        once acknowledged, its content from offset, up to length bytes.
+        The connection stays open for the next ranges.
+
+        """
+        msg_exch.recv() # dummy
+        f_req, offset, length = cmd_vec[1], int(cmd_vec[2]), int(cmd_vec[3])
+        f_tuple = self.__shared_file(f_req)
+        if f_tuple is None:
+            msg_exch.pkl_send(None)
+            return True
+        f_name, f_size, f_path = f_tuple
+        if msg_exch.pkl_send(f_size, ack=True):
+            msg_exch.range_send(f_path, offset, max(0, min(length, f_size - offset)))
+        return True
     
     def __init_connection(self):
         self.idxserv_msg_exch.send("init %d addr %s" % (id(self), self.listening_ip), ack=True)
@@ -98,15 +142,6 @@ class Peer:
         self.__quit_ui()
         return False
 
-    def __list_file(self):
-        ack = self.idxserv_msg_exch.send('list', ack=True)
-        if not ack:
-            logger.error("Error in communication with indexing server.")
-            return True
-        self.idxserv_msg_exch.send_dummy()
-        file_list = self.idxserv_msg_exch.pkl_recv()
-        return file_list
-    
     def __search_file(self, cmd_vec):
         if len(cmd_vec) != 2:
             err_lookup = """
@@ -167,14 +202,18 @@ class Peer:
             self.__block_print(err_print)
             return True
 
-        # get all available files in other peers in case of a lookup/search benchmark
-        file_list = self.__list_file()
+        # sample the files of the other peers from a single page of the
+        # index, starting at a random name, rather than from the whole
+        # catalogue: the files not registered by this peer are shared by
+        # another one, no need to search each of them
         other_peers_file = []
-        for f_name, f_size, f_path in file_list:
-            search_cmd_vec = ['search', f_name]
-            peers_with_file = self.__search_file(search_cmd_vec)
-            if peers_with_file:
-                other_peers_file.append(f_name)
+        if bench_cmd in ['lookup', 'search']:
+            own_files = set(self.files_dict.keys())
+            file_list, cursor = self.__list_page(random.choice(string.ascii_letters + string.digits))
+            if not file_list:
+                file_list, cursor = self.__list_page()
+            other_peers_file = [f_tuple[0] for f_tuple in file_list
+                                if f_tuple[0] not in own_files]
 
         # build new vector of command
         new_cmd_vec = [cmd_vec[1]]
@@ -203,26 +242,100 @@ class Peer:
         f_name = cmd_vec[1]
         peers_with_file = self.__search_file(cmd_vec)
         if peers_with_file:
-            actual_idx = 0
-            choosen_peer = peers_with_file[actual_idx]
+            if not self.__parallel_download(f_name, peers_with_file):
+                logger.error("Could not download %s from the other peers.", f_name)
+        return True
 
-            # Establish connection to the peer to obtain file
-            conn_param = (choosen_peer['addr'], choosen_peer['port'])
-            fs_peer_so = socket(AF_INET, SOCK_STREAM)
-            fs_peer_so.connect(conn_param)
-            fs_msg_exch = proto.MessageExchanger(fs_peer_so)
-            
-            ack = fs_msg_exch.send("obtain %s" % f_name, ack=True)
-            if not ack:
-                logger.error("Problem when sending message to peer.")
-                return True
-            fs_msg_exch.send_dummy()
-            # Get file size
-            f_size = fs_msg_exch.pkl_recv()
-            # Receive file
-            fs_msg_exch.send_ack()
-            f_fullpath = os.path.join(self.download_dir, f_name)
-            fs_msg_exch.file_recv(f_fullpath, f_size, progress=False)
+    def __obtain_range(self, fs_msg_exch, f_req, f_fullpath, offset, length):
+        """Request a part of a file to a peer and write it in place in the
+        local file. Return the size of the file, or None if the peer
+        does not have it.
+
+        """
+        ack = fs_msg_exch.send("obtain_range %s %d %d" % (f_req, offset, length), ack=True)
+        if not ack:
+            return None
+        fs_msg_exch.send_dummy()
+        f_size = fs_msg_exch.pkl_recv()
+        if f_size is None:
+            return None
+        # the end marker mode reads by blocks: only ask for the data once
+        # the size has been received
+        fs_msg_exch.send_ack()
+        length = max(0, min(length, f_size - offset))
+        if not fs_msg_exch.range_recv(f_fullpath, offset, length):
+            return None
+        return f_size
+
+    def __download_worker(self, peer, f_fullpath, chunks):
+        """Download chunks of a file from one peer until there is no chunk
+        left. A chunk that could not be obtained is put back in the
+        queue for the other peers.
+
+        """
+        try:
+            fs_msg_exch = self.peer_pool.acquire(peer['addr'], peer['port'])
+        except error:
+            return
+        while True:
+            try:
+                offset = chunks.get_nowait()
+            except Empty:
+                break
+            try:
+                f_size = self.__obtain_range(fs_msg_exch, peer['file'], f_fullpath, offset,
+                                             DOWNLOAD_CHUNK_SIZE)
+            except error:
+                f_size = None
+            if f_size is None:
+                chunks.put(offset)
+                self.peer_pool.discard(fs_msg_exch)
+                return
+        self.peer_pool.release(peer['addr'], peer['port'], fs_msg_exch)
+
+    def __parallel_download(self, f_name, peers_with_file):
+        """Download a file by chunks from all the peers that have it, one
+        thread per peer. The peers are asked for the file under the
+        name or hash given by the indexing server. The first chunk gives
+        the size of the file; the other ones are written in place as
+        they arrive. Return True if the whole file has been received.
+
+        """
+        f_fullpath = os.path.join(self.download_dir, f_name)
+        os.close(os.open(f_fullpath, os.O_WRONLY|os.O_CREAT|os.O_TRUNC))
+
+        # get the first chunk from the first peer able to send it
+        f_size = None
+        for peer in peers_with_file:
+            try:
+                fs_msg_exch = self.peer_pool.acquire(peer['addr'], peer['port'])
+            except error:
+                continue
+            try:
+                f_size = self.__obtain_range(fs_msg_exch, peer['file'], f_fullpath, 0, DOWNLOAD_CHUNK_SIZE)
+            except error:
+                pass
+            if f_size is not None:
+                self.peer_pool.release(peer['addr'], peer['port'], fs_msg_exch)
+                break
+            self.peer_pool.discard(fs_msg_exch)
+        if f_size is None:
+            return False
+
+        chunks = Queue()
+        for offset in range(DOWNLOAD_CHUNK_SIZE, f_size, DOWNLOAD_CHUNK_SIZE):
+            chunks.put(offset)
+        # new round with the peers still answering as long as chunks are obtained
+        while not chunks.empty():
+            remaining = chunks.qsize()
+            workers = [Thread(target=self.__download_worker, args=(peer, f_fullpath, chunks))
+                       for peer in peers_with_file]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if chunks.qsize() == remaining:
+                return False
         return True
 
     def __ui_action_lookup(self, cmd_vec):
@@ -258,18 +371,21 @@ class Peer:
             actual_idx = user_choice - 1
             choosen_peer = peers_with_file[actual_idx]
 
-            # Establish connection to the peer to obtain file
-            conn_param = (choosen_peer['addr'], choosen_peer['port'])
-            fs_peer_so = socket(AF_INET, SOCK_STREAM)
-            fs_peer_so.connect(conn_param)
-            fs_msg_exch = proto.MessageExchanger(fs_peer_so)
+            # Get a connection to the peer to obtain file
+            addr, port = choosen_peer['addr'], choosen_peer['port']
+            fs_msg_exch = self.peer_pool.acquire(addr, port)
             
-            ack = fs_msg_exch.send("obtain %s" % f_name, ack=True)
+            ack = fs_msg_exch.send("obtain %s" % choosen_peer['file'], ack=True)
             if not ack:
                 logger.error("Problem when sending message to peer.")
+                self.peer_pool.discard(fs_msg_exch)
                 return True
             fs_msg_exch.send_dummy()
             f_size = fs_msg_exch.pkl_recv()
+            if f_size is None:
+                print("The peer does not share this file anymore.")
+                self.peer_pool.release(addr, port, fs_msg_exch)
+                return True
             f_size_str = format_filesize(f_size)
 
             sys.stdout.write("Download %s of size %s? [Y/n] " % (f_name, f_size_str))
@@ -283,6 +399,7 @@ class Peer:
             else:
                 fs_msg_exch.send_err()
                 print("Abort file transfer.")
+            self.peer_pool.release(addr, port, fs_msg_exch)
         return True
     
     def __ui_action_register(self, cmd_vec):
@@ -297,40 +414,126 @@ class Peer:
             self.__block_print(err_register_2)
             return True
             
-        ack = self.idxserv_msg_exch.send('register %d' % (id(self)), ack=True)
+        ack = self.idxserv_msg_exch.send('register_batch %d' % (id(self)), ack=True)
         if not ack:
             logger.error("Error in communication with indexing server.")
             return True
 
         logger.debug(files_to_send)
-        files_dict = self.files_dict
-        for f in files_to_send:
-            f_name = os.path.basename(f)
-            stats = os.stat(f)
-            f_size = stats.st_size
-            f_path = os.path.abspath(f)
-            f_tuple = (f_name, f_size, f_path)
-            self.idxserv_msg_exch.pkl_send(f_tuple, ack=True)
-            files_dict[f_name] = f_tuple
-        self.files_dict = files_dict
+        f_paths = [os.path.abspath(f) for f in files_to_send]
+        # the names are registered at once, with the hashes already in the
+        # cache: the other files are hashed in the background
+        new_files = {}
+        new_hashes = {}
+        to_hash = []
+        for i in range(0, len(f_paths), REGISTER_CHUNK_SIZE):
+            f_tuples = []
+            for f_path in f_paths[i:i+REGISTER_CHUNK_SIZE]:
+                f_name = os.path.basename(f_path)
+                f_size = os.path.getsize(f_path)
+                f_hash = self.hasher.cached(f_path)
+                new_files[f_name] = (f_name, f_size, f_path)
+                if f_hash is None:
+                    f_tuples.append((f_name, f_size, f_path))
+                    to_hash.append(f_path)
+                else:
+                    f_tuples.append((f_name, f_size, f_path, f_hash))
+                    new_hashes[f_hash] = (f_name, f_size, f_path)
+            self.idxserv_msg_exch.pkl_send(f_tuples, ack=True)
+        self.files_dict.update(new_files)
+        self.hash_dict.update(new_hashes)
             
         poison_pill = None
         ack = self.idxserv_msg_exch.pkl_send(poison_pill, ack=True)
+        if to_hash:
+            hash_sender = Thread(target=self.__register_hashes, args=(to_hash,))
+            hash_sender.daemon = True
+            hash_sender.start()
         return True
+
+    def __register_hashes(self, f_paths):
+        """Hash files already registered by name and register them again
+        with their hash, on a connection of its own so that the user
+        interface is not blocked meanwhile.
+
+        """
+        # the next files are hashed while a chunk is sent
+        f_hashes = self.hasher.imap(f_paths)
+        idxserv_socket = socket(AF_INET, SOCK_STREAM)
+        try:
+            idxserv_socket.connect((self.idxserv_ip, self.idxserv_port))
+            msg_exch = proto.MessageExchanger(idxserv_socket, framed=self.framed)
+            if not msg_exch.send('register_batch %d' % (id(self)), ack=True):
+                logger.error("Error in communication with indexing server.")
+                return
+            for i in range(0, len(f_paths), REGISTER_CHUNK_SIZE):
+                f_tuples = []
+                new_hashes = {}
+                for f_path in f_paths[i:i+REGISTER_CHUNK_SIZE]:
+                    f_name = os.path.basename(f_path)
+                    f_size = os.path.getsize(f_path)
+                    f_hash = next(f_hashes)
+                    f_tuples.append((f_name, f_size, f_path, f_hash))
+                    new_hashes[f_hash] = (f_name, f_size, f_path)
+                msg_exch.pkl_send(f_tuples, ack=True)
+                self.hash_dict.update(new_hashes)
+            msg_exch.pkl_send(None, ack=True)
+        except (error, EnvironmentError) as e:
+            logger.error("Could not register the hashes of the files: %s", e)
+        finally:
+            idxserv_socket.close()
         
+    def __list_page(self, after=None):
+        ack = self.idxserv_msg_exch.send('list_page %d' % LIST_PAGE_SIZE, ack=True)
+        if not ack:
+            logger.error("Error in communication with indexing server.")
+            return [], None
+        # the cursor is a file name, which may contain spaces
+        self.idxserv_msg_exch.pkl_send(after)
+        return self.idxserv_msg_exch.pkl_recv()
+
+    def __print_files(self, file_list, header=True):
+        if header:
+            print("{:<30}{:<10}{:<40}".format("Filename", "Size", "Path"))
+            print("-"*80)
+        for f_name, f_size, f_path in file_list:
+            f_size_str = format_filesize(f_size)
+            # reduce absolute path
+            if len(f_path) > 40:
+                f_path = f_path[:15] + " ... " + f_path[-15:]
+            print("{:<30}{:<10}{:<40}".format(f_name, f_size_str, f_path))
+
     def __ui_action_list(self, cmd_vec):
-        file_list = self.__list_file()
+        # print the catalogue page by page as it is received
+        file_list, cursor = self.__list_page()
         if not file_list:
             print("There is no file available on the Indexing Server.")
+            return True
+        self.__print_files(file_list)
+        while cursor is not None:
+            file_list, cursor = self.__list_page(cursor)
+            self.__print_files(file_list, header=False)
+        return True
+
+    def __ui_action_find(self, cmd_vec):
+        if len(cmd_vec) < 3 or cmd_vec[1] not in ['prefix', 'glob', 'substring']:
+            err_find = """
+            Error: find command needs a search mode (prefix, glob or
+            substring) followed by a pattern.
+            """
+            self.__block_print(err_find)
+            return True
+        ack = self.idxserv_msg_exch.send("find %s" % cmd_vec[1], ack=True)
+        if not ack:
+            logger.error("Error in communication with indexing server.")
+            return True
+        # the words of the pattern were split with the command
+        self.idxserv_msg_exch.pkl_send(" ".join(cmd_vec[2:]))
+        file_list = self.idxserv_msg_exch.pkl_recv()
+        if not file_list:
+            print("No file matches this pattern.")
         else:
-            print("{:<30}{:<10}{:<40}".format("Filename", "Size", "Path"))
-            print("-"*80)
-            for f_name, f_size, f_path in file_list:
-                f_size_str = format_filesize(f_size)
-                # reduce absolute path
-                if len(f_path) > 40:
-                    f_path = f_path[:15] + " ... " + f_path[-15:]
-                    print("{:<30}{:<10}{:<40}".format(f_name, f_size_str, f_path))
+            self.__print_files(file_list)
         return True
 
     def __ui_action_getid(self, cmd_vec=None):
@@ -362,6 +565,7 @@ class Peer:
             'search': 'Only request the indexing server for the lists of other peers having that file',
             'register': 'Register files to the indexing server.',
             'list': 'List all the available files in the indexing server.',
+            'find': 'Find the files whose name matches a pattern: find <prefix|glob|substring> <pattern>.',
             'help': 'Display the help screen.',
             'getid': 'Return the peer id.',
             'echo': 'Simple function that send a message to the server, wait for the same message and print it.',
@@ -374,18 +578,26 @@ class Peer:
     
     def __peer_message_handler(self, peer_so, peer_addr):
         logger.debug("Accepted connection from %s", peer_addr)
-        fc_msg_exch = proto.MessageExchanger(peer_so)
+        fc_msg_exch = proto.MessageExchanger(peer_so, framed=self.framed)
+        # the other peer keeps the connection in its pool: close it if it
+        # stays unused for too long
+        peer_so.settimeout(PEER_IDLE_TIMEOUT)
 
         open_conn = True
-        while open_conn:
-            msg = fc_msg_exch.recv()
-            cmd_vec = msg.split()
-            action = cmd_vec[0]
-            if action not in self.client_actions:
-                fc_msg_exch.send_err()
-            else:
-                fc_msg_exch.send_ack()
-                open_conn = self.client_actions[action](fc_msg_exch, cmd_vec)
+        try:
+            while open_conn:
+                msg = fc_msg_exch.recv()
+                if msg is None: # peer closed the connection
+                    break
+                cmd_vec = msg.split()
+                action = cmd_vec[0]
+                if action not in self.client_actions:
+                    fc_msg_exch.send_err()
+                else:
+                    fc_msg_exch.send_ack()
+                    open_conn = self.client_actions[action](fc_msg_exch, cmd_vec)
+        except timeout:
+            logger.debug("Closing idle connection from %s", peer_addr)
         peer_so.close()
 
     def __quit_server(self):
@@ -435,6 +647,8 @@ class Peer:
             self.idxserv_msg_exch.send("close_connection %d" % id(self), ack=True)
             self.idxserv_socket.close()
             self.idxserv_socket = None
+        self.peer_pool.close()
+        self.hasher.close()
         try:
             self.server_running.value = 0
         except IOError as e:
@@ -455,7 +669,7 @@ class Peer:
         try:
             self.idxserv_socket = socket(AF_INET, SOCK_STREAM)
             self.idxserv_socket.connect((self.idxserv_ip, self.idxserv_port))
-            self.idxserv_msg_exch = proto.MessageExchanger(self.idxserv_socket)
+            self.idxserv_msg_exch = proto.MessageExchanger(self.idxserv_socket, framed=self.framed)
             self.__init_connection()
         except error as e:
             if e.errno == errno.ECONNREFUSED:
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+"""
+Usage:
+   python bench_indexing_server.py server_ip server_port [peers=1,10,100,1000] [ops=100] [mix=search:100] [files=10] [framed=B] [output=F]
+
+Load generator for a running indexing server. For every number of
+concurrent peers, connect that many simulated peers, let each of them
+register a few files and then run ops requests drawn from the mix of
+search, obtain, find, list_page and register requests, given as
+name:weight pairs. An obtain is a search followed by the download of
+the file from one of the simulated peers that have it. Print the
+throughput and the latency percentiles in milliseconds of every kind
+of request and, if an output file is given, write them to it as JSON.
+"""
+from socket import *
+from threading import Thread, Event
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import CommunicationProtocol as proto
+
+OPERATIONS = ['search', 'obtain', 'find', 'list_page', 'register']
+# size of the files shared by the simulated peers
+FILE_SIZE = 1024
+# number of files received in one list_page request
+LIST_PAGE_SIZE = 1000
+
+
+class SimulatedPeer:
+    """Speak the peer side of the indexing server protocol without serving
+    any file.
+
+    """
+    def __init__(self, server_ip, server_port, peer_num, f_dir, framed=False):
+        self.peer_num = peer_num
+        self.f_dir = f_dir
+        self.framed = framed
+        # path of the shared files by name and by hash of their name
+        self.shared = {}
+        # the files of the other simulated peers are obtained from this
+        # server, on a port chosen by the system
+        self.listening_socket = socket(AF_INET, SOCK_STREAM)
+        self.listening_socket.bind(("127.0.0.1", 0))
+        self.listening_socket.listen(128)
+        server = Thread(target=self.__run_server)
+        server.daemon = True
+        server.start()
+        # connections to the other simulated peers, kept open between obtains
+        self.peer_conns = {}
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.connect((server_ip, server_port))
+        self.msg_exch = proto.MessageExchanger(self.sock, framed=framed)
+        self.msg_exch.send("init %d addr 127.0.0.1" % id(self), ack=True)
+        self.msg_exch.send("init %d port %d" % (id(self), self.listening_socket.getsockname()[1]), ack=True)
+
+    def __run_server(self):
+        while True:
+            try:
+                peer_so, peer_addr = self.listening_socket.accept()
+            except error:
+                break
+            handler = Thread(target=self.__serve, args=(peer_so,))
+            handler.daemon = True
+            handler.start()
+
+    def __serve(self, peer_so):
+        """Answer the obtain_range requests of another peer, the same way
+        as Peer does.
+
+        """
+        msg_exch = proto.MessageExchanger(peer_so, framed=self.framed)
+        try:
+            while True:
+                msg = msg_exch.recv()
+                if msg is None:
+                    break
+                cmd_vec = msg.split()
+                if cmd_vec[0] != 'obtain_range':
+                    msg_exch.send_err()
+                    continue
+                msg_exch.send_ack()
+                msg_exch.recv() # dummy
+                f_path = self.shared.get(cmd_vec[1])
+                offset, length = int(cmd_vec[2]), int(cmd_vec[3])
+                if f_path is None:
+                    msg_exch.pkl_send(None)
+                elif msg_exch.pkl_send(FILE_SIZE, ack=True):
+                    msg_exch.range_send(f_path, offset, max(0, min(length, FILE_SIZE - offset)))
+        except error:
+            pass
+        peer_so.close()
+
+    def share(self, f_names):
+        """Create the files to serve and register them.
+
+        """
+        data = os.urandom(FILE_SIZE)
+        for f_name in f_names:
+            f_path = os.path.join(self.f_dir, f_name)
+            with open(f_path, 'wb') as f:
+                f.write(data)
+            self.shared[f_name] = self.shared[hashlib.sha1(f_name).hexdigest()] = f_path
+        self.register(f_names)
+
+    def register(self, f_names):
+        self.msg_exch.send("register_batch %d" % id(self), ack=True)
+        self.msg_exch.pkl_send([(f_name, FILE_SIZE, self.shared[f_name], hashlib.sha1(f_name).hexdigest())
+                                for f_name in f_names], ack=True)
+        self.msg_exch.pkl_send(None, ack=True)
+
+    def lookup(self, f_name):
+        self.msg_exch.send("lookup %s %d" % (f_name, id(self)), ack=True)
+        self.msg_exch.send_dummy()
+        return self.msg_exch.pkl_recv()
+
+    def obtain(self, f_name):
+        """Look a file up and download it from the first peer that has it.
+        Return True if the whole file has been received.
+
+        """
+        peers_with_file = self.lookup(f_name)
+        if not peers_with_file:
+            return False
+        peer = peers_with_file[0]
+        key = (peer['addr'], peer['port'])
+        fs_msg_exch = self.peer_conns.get(key)
+        if fs_msg_exch is None:
+            peer_so = socket(AF_INET, SOCK_STREAM)
+            peer_so.connect(key)
+            fs_msg_exch = self.peer_conns[key] = proto.MessageExchanger(peer_so, framed=self.framed)
+        if not fs_msg_exch.send("obtain_range %s 0 %d" % (peer['file'], FILE_SIZE), ack=True):
+            return False
+        fs_msg_exch.send_dummy()
+        f_size = fs_msg_exch.pkl_recv()
+        if f_size is None:
+            return False
+        fs_msg_exch.send_ack()
+        f_fullpath = os.path.join(self.f_dir, "download_%d" % self.peer_num)
+        os.close(os.open(f_fullpath, os.O_WRONLY|os.O_CREAT))
+        return fs_msg_exch.range_recv(f_fullpath, 0, f_size)
+
+    def find(self, pattern):
+        self.msg_exch.send("find substring", ack=True)
+        self.msg_exch.pkl_send(pattern)
+        return self.msg_exch.pkl_recv()
+
+    def list_page(self, after=None):
+        self.msg_exch.send("list_page %d" % LIST_PAGE_SIZE, ack=True)
+        self.msg_exch.pkl_send(after)
+        return self.msg_exch.pkl_recv()
+
+    def close(self):
+        self.msg_exch.send("close_connection %d" % id(self), ack=True)
+        self.sock.close()
+        for fs_msg_exch in self.peer_conns.values():
+            fs_msg_exch.sock.close()
+        self.listening_socket.close()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    idx = min(len(sorted_values) - 1, int(round(p/100.*(len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+def parse_mix(mix_str):
+    """Parse 'name:weight,...' into a list of (name, weight) pairs.
+
+    """
+    mix = []
+    for item in mix_str.split(','):
+        op, weight = item.split(':')
+        if op not in OPERATIONS:
+            raise ValueError("operations should be in %s" % OPERATIONS)
+        mix.append((op, float(weight)))
+    return mix
+
+def draw(mix, total):
+    x = random.uniform(0, total)
+    for op, weight in mix:
+        x -= weight
+        if x <= 0:
+            return op
+    return mix[-1][0]
+
+def run_level(server_ip, server_port, nb_peers, nb_ops, mix, nb_files, framed):
+    """Connect nb_peers simulated peers and return the latencies in seconds
+    of their requests, by kind of request, and the total duration.
+
+    """
+    f_dir = tempfile.mkdtemp(prefix="bench_is_")
+    peers = [SimulatedPeer(server_ip, server_port, i, f_dir, framed) for i in range(nb_peers)]
+    names = [["p%d_%d_f%d" % (nb_peers, i, j) for j in range(nb_files)] for i in range(nb_peers)]
+    for peer, f_names in zip(peers, names):
+        peer.share(f_names)
+
+    total = sum(weight for op, weight in mix)
+    start = Event()
+    latencies = [dict((op, []) for op in OPERATIONS) for _ in peers]
+    def requests(i):
+        peer = peers[i]
+        # the files of the other peers are known without asking the server
+        others = [f for j, f_names in enumerate(names) if j != i for f in f_names] or names[i]
+        start.wait()
+        for _ in range(nb_ops):
+            op = draw(mix, total)
+            t0 = time.time()
+            if op == 'search':
+                peer.lookup(random.choice(others))
+            elif op == 'obtain':
+                peer.obtain(random.choice(others))
+            elif op == 'find':
+                peer.find(random.choice(others)[-4:])
+            elif op == 'list_page':
+                peer.list_page(random.choice(others))
+            else:
+                peer.register(names[i])
+            latencies[i][op].append(time.time() - t0)
+
+    threads = [Thread(target=requests, args=(i,)) for i in range(nb_peers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    t0 = time.time()
+    start.set()
+    for thread in threads:
+        thread.join()
+    delta = time.time() - t0
+    for peer in peers:
+        peer.close()
+    shutil.rmtree(f_dir, ignore_errors=True)
+    by_op = dict((op, [l for peer_latencies in latencies for l in peer_latencies[op]])
+                 for op in OPERATIONS)
+    return by_op, delta
+
+def summarize(latencies, delta):
+    latencies = sorted(l*1000. for l in latencies)
+    return {
+        "count": len(latencies),
+        "throughput": len(latencies)/delta,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else float('nan')
+    }
+
+def print_err(msg):
+    sys.stderr.write("Error: %s\n" % msg)
+    sys.stderr.write("%s\n" % __doc__.strip())
+    sys.exit(1)
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) < 3:
+        print_err("missing arguments.")
+    opts = {"peers": "1,10,100,1000", "ops": "100", "mix": "search:100", "files": "10",
+            "framed": "false", "output": None}
+    for arg in args[3:]:
+        arg_name, arg_val = arg.split('=')
+        if arg_name not in opts:
+            print_err("wrong argument: %s" % arg)
+        opts[arg_name] = arg_val
+    framed = opts["framed"].lower() in ['1', 'true', 'yes']
+    try:
+        mix = parse_mix(opts["mix"])
+    except ValueError as e:
+        print_err(str(e))
+
+    results = []
+    print("{:<8}{:<10}{:>12}{:>10}{:>10}{:>10}{:>10}".format("peers", "op", "ops/s", "p50", "p95", "p99", "max"))
+    for nb_peers in [int(n) for n in opts["peers"].split(',')]:
+        by_op, delta = run_level(args[1], int(args[2]), nb_peers, int(opts["ops"]), mix,
+                                 int(opts["files"]), framed)
+        level = {"peers": nb_peers, "duration": delta,
+                 "all": summarize([l for op in OPERATIONS for l in by_op[op]], delta)}
+        for op in OPERATIONS:
+            if by_op[op]:
+                level[op] = summarize(by_op[op], delta)
+        for op in OPERATIONS + ["all"]:
+            if op in level:
+                s = level[op]
+                print("{:<8}{:<10}{:>12.0f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+                    nb_peers, op, s["throughput"], s["p50"], s["p95"], s["p99"], s["max"]))
+        results.append(level)
+
+    if opts["output"] is not None:
+        with open(opts["output"], 'w') as output_fd:
+            json.dump({"framed": framed, "ops": int(opts["ops"]), "mix": dict(mix),
+                       "files": int(opts["files"]), "levels": results}, output_fd, indent=2)
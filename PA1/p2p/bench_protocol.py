@@ -0,0 +1,49 @@
+#!/usr/bin/python
+"""
+Usage:
+   python bench_protocol.py [max_files=100000]
+
+Measure the time needed to receive and unpickle the reply of a `list`
+request for an increasing number of registered files, with and without
+framing.
+"""
+from socket import socketpair
+from threading import Thread
+
+import sys
+import time
+import CommunicationProtocol as proto
+
+
+def fake_file_list(nb_files):
+    return [("f%06d" % i, 1024, "/tmp/files/f%06d" % i) for i in xrange(nb_files)]
+
+def time_list_reply(file_list, framed):
+    sender_so, receiver_so = socketpair()
+    sender = proto.MessageExchanger(sender_so, framed=framed)
+    receiver = proto.MessageExchanger(receiver_so, framed=framed)
+    thread = Thread(target=sender.pkl_send, args=(file_list,))
+    t0 = time.time()
+    thread.start()
+    received = receiver.pkl_recv()
+    delta = time.time() - t0
+    thread.join()
+    sender_so.close()
+    receiver_so.close()
+    assert len(received) == len(file_list)
+    return delta
+
+if __name__ == '__main__':
+    max_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sizes = []
+    nb_files = max_files
+    while nb_files >= 1000:
+        sizes.insert(0, nb_files)
+        nb_files /= 2
+
+    print("{:<10}{:>14}{:>14}{:>16}".format("files", "legacy (s)", "framed (s)", "framed us/file"))
+    for nb_files in sizes:
+        file_list = fake_file_list(nb_files)
+        legacy = time_list_reply(file_list, False)
+        framed = time_list_reply(file_list, True)
+        print("{:<10}{:>14.3f}{:>14.3f}{:>16.2f}".format(nb_files, legacy, framed, framed*1e6/nb_files))
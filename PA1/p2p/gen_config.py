@@ -2,14 +2,36 @@
 import json
 import sys
 
+from socket import *
 from urllib2 import urlopen
 
 doc = """
 Usage:
-   ./gen_config.py server [listening_port=P] [pool_size=S]
-   ./gen_config.py peer server_ip server_port [listening_port=P] [pool_size=S] [files_regex=R] [download_dir=D]
+   ./gen_config.py server [listening_ip=I] [listening_port=P] [pool_size=S] [framed=B] [engine=E] [workers=W]
+   ./gen_config.py peer server_ip server_port [listening_ip=I] [listening_port=P] [pool_size=S] [files_regex=R] [download_dir=D] [framed=B]
+
+listening_ip defaults to the address of the interface of the default route; listening_ip=public asks
+api.ipify.org for the public address instead.
 """
 
+def local_ip():
+    """Return the address of the interface used to reach other machines.
+
+    Connecting a UDP socket only selects a route: nothing is sent.
+    """
+    sock = socket(AF_INET, SOCK_DGRAM)
+    try:
+        sock.connect(("8.8.8.8", 53))
+        return sock.getsockname()[0]
+    except error:
+        return "127.0.0.1"
+    finally:
+        sock.close()
+
+def public_ip(timeout=5):
+    """Return the public address of this machine, as seen from the internet."""
+    return str(json.load(urlopen('https://api.ipify.org/?format=json', timeout=timeout))['ip'])
+
 def print_err(msg):
     sys.stderr.write("Error: %s\n" % msg)
     sys.stderr.write("%s\n" % doc.strip())
@@ -24,11 +46,15 @@ if __name__ == '__main__':
         print_err("Error: second argument should be 'peer' or 'server'.")
     
     types_dict = {
+        "listening_ip": str,
         "listening_port": int,
         "pool_size": int,
         "idxserv_port": int,
         "files_regex": str,
-        "download_dir": str
+        "download_dir": str,
+        "framed": lambda v: v.lower() in ['1', 'true', 'yes'],
+        "engine": str,
+        "workers": int
     }
 
     template_files = {
@@ -47,6 +73,8 @@ if __name__ == '__main__':
     else: # conf_type == 'server'
         opt_args = args[3:]
 
+    # the listening ip is found locally unless it is given
+    template_conf['listening_ip'] = None
     for arg in opt_args:
         arg_name, arg_val = arg.split('=')
         if arg_name in types_dict:
@@ -54,8 +82,10 @@ if __name__ == '__main__':
         else:
             print_err("Wrong argument: %s" % arg)
             
-    ip = json.load(urlopen('https://api.ipify.org/?format=json'))['ip']
-    template_conf['listening_ip'] = str(ip)
+    if template_conf['listening_ip'] is None:
+        template_conf['listening_ip'] = local_ip()
+    elif template_conf['listening_ip'] == 'public':
+        template_conf['listening_ip'] = public_ip()
 
     print json.dumps(template_conf, indent=4, separators=(',', ': '))
     
@@ -0,0 +1,65 @@
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from multiprocessing import Process, Queue
+from dht_data import CHOOSE_FROM, load_data, write_binary, write_text
+
+VAL_SIZE = 20
+FIRST_KEY = 100000
+# keys read after loading, as a benchmark command does
+READ_KEYS = 10000
+
+
+def write_text_per_char(path, first_key, count, val_size):
+    """Former generator: one random.choice call per character."""
+    with open(path, 'w') as data_fd:
+        for i in range(count):
+            v = ''.join(random.choice(CHOOSE_FROM) for _ in range(val_size))
+            data_fd.write("%d  %s\n" % (first_key + i, v))
+
+def measure_load(path, results):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    data = load_data(path)
+    t1 = time.time()
+    values = [data[str(k)] for k in xrange(FIRST_KEY, FIRST_KEY + READ_KEYS)]
+    t2 = time.time()
+    results.put((t1 - t0, t2 - t1, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024.))
+
+def load(path):
+    """Return the time to load a file, to read READ_KEYS values, and the
+    memory used in MB, measured in a new process."""
+    results = Queue()
+    p = Process(target=measure_load, args=(path, results))
+    p.start()
+    res = results.get()
+    p.join()
+    return res
+
+def print_usage(args):
+    sys.stderr.write("Usage: python %s [n_keys]\n" % args[0])
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) > 2:
+        print_usage(args)
+        sys.exit(1)
+    n_keys = int(args[1]) if len(args) == 2 else 800000
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print("%-16s%12s%12s%12s%12s" % ("format", "write (s)", "load (s)", "read (s)", "memory (MB)"))
+        for name, write in [("text per char", write_text_per_char), ("text", write_text),
+                            ("binary", write_binary)]:
+            path = os.path.join(tmp_dir, name.replace(' ', '_'))
+            t0 = time.time()
+            write(path, FIRST_KEY, n_keys, VAL_SIZE)
+            delta = time.time() - t0
+            print("%-16s%12.3f%12.3f%12.3f%12.1f" % ((name, delta) + load(path)))
+    finally:
+        shutil.rmtree(tmp_dir)
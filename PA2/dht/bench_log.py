@@ -0,0 +1,86 @@
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from multiprocessing import Process, Queue
+from threading import Thread
+from dht import DHT
+from dht_data import load_pairs
+from dht_protocol import *
+from dht_store import DurableStore
+from socket import *
+
+PORT = 17100
+# numbers of client threads sending put requests at the same time
+CLIENTS = [1, 4, 16]
+
+
+def run_node(peers_map, commands):
+    """Serve a node until it is told to stop."""
+    logging.disable(logging.INFO)
+    node = DHT(peers_map, node_id=0)
+    node.server.start()
+    commands.get()
+    node.stop()
+    node.server.join()
+
+def connect():
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.connect(("127.0.0.1", PORT))
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    return MessageExchanger(sock)
+
+def put_all(data):
+    """Put the pairs one request at a time, as the benchmark put command."""
+    exch = connect()
+    for k, v in data:
+        exch.send(encode_request(OP_PUT, [k], [v]))
+        exch.recv()
+    exch.sock.close()
+
+def run(data, clients, data_dir):
+    """Return the number of put requests per second served by a node."""
+    peers_map = {0: {'ip': '127.0.0.1', 'port': PORT, 'data_dir': data_dir}}
+    commands = Queue()
+    node = Process(target=run_node, args=(peers_map, commands))
+    node.start()
+    time.sleep(1)
+    threads = [Thread(target=put_all, args=(data[i::clients],)) for i in range(clients)]
+    t0 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    delta = time.time() - t0
+    commands.put("stop")
+    node.join()
+    return len(data) / delta
+
+def print_usage(args):
+    sys.stderr.write("Usage: python %s keyval.data [n_keys]\n" % args[0])
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) not in [2, 3]:
+        print_usage(args)
+        sys.exit(1)
+    n_keys = int(args[2]) if len(args) == 3 else 100000
+    data = load_pairs(args[1], n_keys)
+    logging.disable(logging.INFO)
+
+    print("%-10s%10s%12s" % ("store", "clients", "put/s"))
+    for clients in CLIENTS:
+        print("%-10s%10d%12.0f" % ("memory", clients, run(data, clients, None)))
+        data_dir = tempfile.mkdtemp()
+        try:
+            print("%-10s%10d%12.0f" % ("log", clients, run(data, clients, data_dir)))
+            # time to rebuild the store at startup
+            t0 = time.time()
+            store = DurableStore(data_dir)
+            delta = time.time() - t0
+            store.close()
+            print("%d keys replayed in %.3f seconds." % (len(store), delta))
+        finally:
+            shutil.rmtree(data_dir)
@@ -0,0 +1,62 @@
+import sys
+import timeit
+
+from dht_protocol import *
+
+# former text format: space separated words, results through string tables
+py2str = {
+    True: "SUCCESS",
+    False: "FAILURE",
+    None: "NONE"
+}
+
+str2py = {
+    "SUCCESS": True,
+    "FAILURE": False,
+    "NONE": None
+}
+
+
+def text_round_trip(keys, values, results):
+    if values is None:
+        cmd = "get %s" % " ".join(keys)
+    else:
+        cmd = "put %s" % " ".join(arg for kv in zip(keys, values) for arg in kv)
+    cmd_vec = cmd.split()
+    res = " ".join(py2str[r] if r in py2str else r for r in results)
+    return [str2py.get(r, r) for r in res.split()]
+
+def binary_round_trip(keys, values, results):
+    opcode = OP_GET if values is None else OP_PUT
+    msg = bytearray(encode_request(opcode, keys, values))
+    decode_request(memoryview(msg))
+    res = encode_response(results)
+    return decode_response(memoryview(res))
+
+def bench(func, keys, values, results, number):
+    """Return the time in microseconds of one encoding and decoding of a
+    request and its response."""
+    run = lambda: func(keys, values, results)
+    return min(timeit.repeat(run, number=number, repeat=3)) * 1e6 / number
+
+def print_usage(args):
+    sys.stderr.write("Usage: python %s [number]\n" % args[0])
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) > 2:
+        print_usage(args)
+        sys.exit(1)
+    number = int(args[1]) if len(args) == 2 else 10000
+
+    print("%-8s%8s%8s%14s%14s" % ("op", "keys", "size", "text (us)", "binary (us)"))
+    for n_keys in [1, 1000]:
+        for val_size in [20, 1000]:
+            keys = ["%06d" % i for i in range(n_keys)]
+            values = ["v" * val_size for _ in keys]
+            n = max(1, number / n_keys)
+            # a put is answered by a status per key, a get by the values
+            for op, vals, results in [("put", values, [True] * n_keys), ("get", None, values)]:
+                print("%-8s%8d%8d%14.2f%14.2f" % (op, n_keys, val_size,
+                                                 bench(text_round_trip, keys, vals, results, n),
+                                                 bench(binary_round_trip, keys, vals, results, n)))
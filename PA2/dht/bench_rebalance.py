@@ -0,0 +1,158 @@
+import logging
+import random
+import sys
+import time
+
+from multiprocessing import Process, Queue
+from threading import Thread
+from dht import DHT
+from dht_data import load_pairs
+from dht_protocol import *
+from socket import *
+
+# nodes of the local cluster: nodes 0 to 2 are started, node 3 joins and
+# node 1 leaves while the drivers keep on sending requests
+NODES = 4
+BASE_PORT = 17000
+# nodes the drivers send their requests to: they forward the requests
+# on keys they do not own to the owner
+ENTRY_NODES = [0, 2]
+# number of driver threads, fraction of puts and length of an interval
+DRIVERS = 4
+PUT_RATIO = 0.1
+INTERVAL = 0.5
+
+
+def run_node(peers_map, node_id, commands, results):
+    """Serve a node of the cluster and run the membership commands received."""
+    logging.disable(logging.INFO)
+    node = DHT(peers_map, node_id=node_id)
+    node.server.start()
+    while True:
+        cmd = commands.get()
+        if cmd == "join":
+            node.join()
+        elif cmd == "leave":
+            node.leave()
+            break
+        elif cmd == "stop":
+            break
+    results.put((node_id, len(node.hashmap)))
+    node.stop()
+    node.server.join()
+
+def connect(node_id):
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.connect(("127.0.0.1", BASE_PORT + node_id))
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    return MessageExchanger(sock)
+
+def request(exch, opcode, keys, values=None):
+    exch.send(encode_request(opcode, keys, values))
+    return decode_response(memoryview(exch.recv()))
+
+class Driver(Thread):
+    """Send gets and puts on its own keys and check the values read."""
+
+    def __init__(self, data, seed):
+        super(Driver, self).__init__()
+        self.data = dict(data)
+        self.expected = dict(data)
+        self.keys = self.expected.keys()
+        self.random = random.Random(seed)
+        self.exchs = [connect(i) for i in ENTRY_NODES]
+        self.ops = 0
+        self.errors = 0
+        self.stop = False
+
+    def run(self):
+        version = 0
+        while not self.stop:
+            key = self.random.choice(self.keys)
+            exch = self.random.choice(self.exchs)
+            if self.random.random() < PUT_RATIO:
+                version += 1
+                value = "%s.%d" % (self.data[key], version)
+                request(exch, OP_PUT, [key], [value])
+                self.expected[key] = value
+            elif request(exch, OP_GET, [key])[0] != self.expected[key]:
+                self.errors += 1
+            self.ops += 1
+
+def print_usage(args):
+    sys.stderr.write("Usage: python %s keyval.data [n_keys] [phase_duration]\n" % args[0])
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) not in [2, 3, 4]:
+        print_usage(args)
+        sys.exit(1)
+    n_keys = int(args[2]) if len(args) > 2 else 100000
+    duration = float(args[3]) if len(args) > 3 else 5.
+    data = load_pairs(args[1], n_keys)
+
+    peers_map = {i: {'ip': '127.0.0.1', 'port': BASE_PORT + i} for i in range(NODES)}
+    first_nodes = {i: peers_map[i] for i in range(NODES - 1)}
+    results = Queue()
+    commands = {}
+    processes = []
+    for node_id in range(NODES):
+        commands[node_id] = Queue()
+        # the last node only knows the others when it joins
+        node_map = dict(first_nodes if node_id < NODES - 1 else peers_map)
+        p = Process(target=run_node, args=(node_map, node_id, commands[node_id], results))
+        p.start()
+        processes.append(p)
+    time.sleep(1)
+
+    # load the keys through the entry nodes
+    exch = connect(ENTRY_NODES[0])
+    for b in range(0, len(data), 1000):
+        batch = data[b:b+1000]
+        request(exch, OP_PUT, [k for k, v in batch], [v for k, v in batch])
+
+    drivers = [Driver(data[i::DRIVERS], i) for i in range(DRIVERS)]
+    for driver in drivers:
+        driver.start()
+
+    # membership change at the start of each phase but the first one
+    phases = [("steady", None), ("join 3", (NODES - 1, "join")),
+              ("leave 1", (1, "leave")), ("steady", None)]
+    print("%-10s%10s%12s" % ("phase", "time (s)", "ops/s"))
+    t_start = time.time()
+    last_ops = 0
+    for name, change in phases:
+        if change is not None:
+            node_id, cmd = change
+            commands[node_id].put(cmd)
+        t_end = time.time() + duration
+        while time.time() < t_end:
+            time.sleep(INTERVAL)
+            ops = sum(driver.ops for driver in drivers)
+            print("%-10s%10.1f%12.0f" % (name, time.time() - t_start, (ops - last_ops) / INTERVAL))
+            last_ops = ops
+    for driver in drivers:
+        driver.stop = True
+        driver.join()
+
+    # every key must still hold its last value
+    expected = {}
+    for driver in drivers:
+        expected.update(driver.expected)
+    keys = expected.keys()
+    missing = 0
+    for b in range(0, len(keys), 1000):
+        batch = keys[b:b+1000]
+        values = request(exch, OP_GET, batch)
+        missing += sum(1 for k, v in zip(batch, values) if v != expected[k])
+    print("Errors during the run: %d, wrong values at the end: %d/%d."
+          % (sum(driver.errors for driver in drivers), missing, len(keys)))
+
+    for node_id in range(NODES):
+        if node_id != 1:
+            commands[node_id].put("stop")
+    for _ in range(NODES):
+        node_id, count = results.get()
+        print("Node %d holds %d keys." % (node_id, count))
+    for p in processes:
+        p.join()
@@ -0,0 +1,38 @@
+import sys
+import timeit
+
+from hashlib import md5
+from hash_ring import HashRing, key_movement
+from dht_data import load_pairs
+
+
+def modulo_hash(nodes_count):
+    return lambda key: int(md5(key).hexdigest(), 16) % nodes_count
+
+def print_usage(args):
+    sys.stderr.write("Usage: python %s [keyval.data] [old_nodes] [new_nodes]\n" % args[0])
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) > 4:
+        print_usage(args)
+        sys.exit(1)
+    if len(args) > 1:
+        keys = [k for k, v in load_pairs(args[1], 100000)]
+    else:
+        keys = [str(k) for k in range(100000, 200000)]
+    old_count = int(args[2]) if len(args) > 2 else 8
+    new_count = int(args[3]) if len(args) > 3 else 16
+
+    print("Keys moved when going from %d to %d nodes (%d keys):" % (old_count, new_count, len(keys)))
+    print("%-16s%10s%16s" % ("hash", "moved", "lookup (us)"))
+    moved = key_movement(keys, modulo_hash(old_count), modulo_hash(new_count))
+    lookup = modulo_hash(new_count)
+    t = min(timeit.repeat(lambda: [lookup(k) for k in keys], number=1, repeat=3))
+    print("%-16s%9.1f%%%16.2f" % ("modulo", 100 * moved, t * 1e6 / len(keys)))
+    for vnodes in [1, 10, 100, 1000]:
+        old_ring = HashRing(range(old_count), vnodes)
+        new_ring = HashRing(range(new_count), vnodes)
+        moved = key_movement(keys, old_ring.lookup, new_ring.lookup)
+        t = min(timeit.repeat(lambda: [new_ring.lookup(k) for k in keys], number=1, repeat=3))
+        print("%-16s%9.1f%%%16.2f" % ("ring %d vnodes" % vnodes, 100 * moved, t * 1e6 / len(keys)))
@@ -0,0 +1,67 @@
+import sys
+import time
+
+from multiprocessing import Manager
+from dht_store import ShardedStore
+from dht_data import load_pairs
+
+
+class ManagerStore:
+    """Hashmap shared through a manager process, as the DHT used to do."""
+
+    def __init__(self):
+        self.manager = Manager()
+        self.hashmap = self.manager.dict()
+        self.map_lock = self.manager.Lock()
+
+    def put(self, key, value):
+        self.map_lock.acquire()
+        self.hashmap[key] = value
+        self.map_lock.release()
+        return True
+
+    def get(self, key):
+        self.map_lock.acquire()
+        val = self.hashmap.get(key)
+        self.map_lock.release()
+        return val
+
+    def rem(self, key):
+        self.map_lock.acquire()
+        del self.hashmap[key]
+        self.map_lock.release()
+        return True
+
+
+def run(store, data):
+    """Return the number of operations per second of put, get and rem."""
+    results = {}
+    t0 = time.time()
+    for k, v in data:
+        store.put(k, v)
+    results['put'] = len(data) / (time.time() - t0)
+    t0 = time.time()
+    for k, v in data:
+        store.get(k)
+    results['get'] = len(data) / (time.time() - t0)
+    t0 = time.time()
+    for k, v in data:
+        store.rem(k)
+    results['rem'] = len(data) / (time.time() - t0)
+    return results
+
+def print_usage(args):
+    sys.stderr.write("Usage: python %s keyval.data [n_keys]\n" % args[0])
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) not in [2, 3]:
+        print_usage(args)
+        sys.exit(1)
+    n_keys = int(args[2]) if len(args) == 3 else 100000
+    data = load_pairs(args[1], n_keys)
+
+    print("%-10s%12s%12s%12s" % ("store", "put/s", "get/s", "rem/s"))
+    for name, store in [("manager", ManagerStore()), ("sharded", ShardedStore())]:
+        results = run(store, data)
+        print("%-10s%12.0f%12.0f%12.0f" % (name, results['put'], results['get'], results['rem']))
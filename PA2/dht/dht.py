@@ -4,34 +4,56 @@ import logging
 import os
 import time
 
-from urllib2 import urlopen
-from hashlib import md5
-from dht_client import DHTClient
+from dht_client import DHTClient, BATCH_SIZE
+from dht_protocol import *
 from dht_server import DHTServer
-from multiprocessing import Manager, Value, Lock
+from dht_store import ShardedStore, DurableStore
+from hash_ring import HashRing, VNODES
+from node_identity import is_local_ip, resolve_node_id
+from multiprocessing import Value
+from threading import Thread, Lock, local
+from socket import *
 
 logging.basicConfig(level=logging.DEBUG)
 
 class DHT:
-    def __init__(self, peers_map):
+    def __init__(self, peers_map, vnodes=VNODES, node_id=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.DEBUG)
 
         self.peers_map = peers_map
         self.peers_count = len(peers_map)
+        # keys are spread over the peers with consistent hashing
+        self.vnodes = vnodes
+        self.ring = HashRing(peers_map.keys(), vnodes)
 
-        # get this server info from config file
-        this_ip = str(json.load(urlopen('https://api.ipify.org/?format=json'))['ip'])
-        this_server = filter(lambda s: s[1]['ip'] == this_ip, self.peers_map.iteritems())
-        if not this_server:
-            raise ValueError("peer %s is not included in the config file." % this_ip)
-        self.id, config = this_server[0]
+        if node_id is None:
+            # find this server in the config file from the local interfaces
+            node_id = resolve_node_id(peers_map)
+        self.id, config = node_id, self.peers_map[node_id]
         self.ip = config['ip']
         self.port = config['port']
+        # several nodes may run on one machine with an address each
+        self.bind_ip = self.ip if is_local_ip(self.ip) else "0.0.0.0"
 
-        self.manager = Manager()
-        self.hashmap = self.manager.dict()
-        self.map_lock = self.manager.Lock()
+        # the server threads and the client share the store of this process,
+        # kept on disk if the config of the node gives a data directory
+        self.log = None
+        if config.get('data_dir'):
+            self.hashmap = DurableStore(config['data_dir'], on_sync=self._synced)
+            self.log = self.hashmap.log
+        else:
+            self.hashmap = ShardedStore()
+
+        # while the ring changes, the ring before the change, the nodes that
+        # still have to hand over keys to this node, and the keys deleted
+        # since the change that these nodes must not bring back
+        self.prev_ring = None
+        self.pending_handoffs = set()
+        self.tombstones = set()
+        self.handoff_lock = Lock()
+        # connections to the other nodes of each thread
+        self.local = local()
 
         self.terminate = Value('i', 0)
 
@@ -40,42 +62,170 @@ class DHT:
 
     def put(self, key, value):
         """Fill the hashmap with a key and value."""
-        self.map_lock.acquire()
-        self.hashmap[key] = value
-        self.map_lock.release()
-        return True
+        return self.hashmap.put(key, value)
 
     def get(self, key):
         """Get value of a given key."""
-        self.map_lock.acquire()
-        val = self.hashmap.get(key)
-        self.map_lock.release()
-        return val
+        value = self.hashmap.get(key)
+        prev_ring = self.prev_ring
+        if value is None and prev_ring is not None and key not in self.tombstones:
+            # the former owner of the key may not have handed it over yet
+            prev_id = prev_ring.lookup(key)
+            if prev_id != self.id:
+                value = self.remote(prev_id, OP_GET|PREVIOUS, [key])[0]
+                if value is None:
+                    # handed over since the first read
+                    value = self.hashmap.get(key)
+        return value
 
     def rem(self, key):
         """Delete entry in the hashmap."""
-        self.map_lock.acquire()
-        del self.hashmap[key]
-        self.map_lock.release()
-        return True
+        with self.handoff_lock:
+            prev_ring = self.prev_ring
+            if prev_ring is not None:
+                self.tombstones.add(key)
+            removed = self.hashmap.rem(key)
+        if not removed and prev_ring is not None:
+            prev_id = prev_ring.lookup(key)
+            if prev_id != self.id:
+                removed = self.remote(prev_id, OP_REM|PREVIOUS, [key])[0]
+        return removed
+
+    def sync(self):
+        """Wait until the writes made so far are on disk."""
+        if self.log is not None:
+            self.log.wait(self.log.last_lsn)
+
+    def _synced(self):
+        # the server sends the responses of the writes now on disk
+        self.server.wakeup()
+
+    def migrate(self, key, value):
+        """Store a key handed over by its former owner, unless it has been
+        written or deleted on this node since the ring changed."""
+        with self.handoff_lock:
+            if key in self.tombstones:
+                return False
+            return self.hashmap.put_new(key, value)
+
+    def remote(self, server_id, opcode, keys, values=None):
+        """Send a request to another node and return its results."""
+        conns = self.local.__dict__.setdefault('conns', {})
+        if server_id not in conns:
+            peer = self.peers_map[server_id]
+            sock = socket(AF_INET, SOCK_STREAM)
+            sock.connect((peer['ip'], peer['port']))
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            conns[server_id] = MessageExchanger(sock)
+        exch = conns[server_id]
+        try:
+            if isinstance(keys[0], list):
+                # several requests with the same opcode, pipelined
+                msgs = [encode_request(opcode, k, v) for k, v in zip(keys, values)]
+                return [decode_response(memoryview(msg)) for msg in exch.pipeline(msgs)]
+            exch.send(encode_request(opcode, keys, values))
+            msg = exch.recv()
+            if msg is None:
+                raise EOFError("connection closed by node %d" % server_id)
+        except (error, EOFError):
+            del conns[server_id]
+            exch.sock.close()
+            raise
+        return decode_response(memoryview(msg))
+
+    def handoff(self, notify):
+        """Send the keys this node does not own anymore to their owner, by
+        batches, then delete them and tell the nodes of notify that the
+        handoff is over."""
+        ring = self.ring
+        moved = {}
+        for key, value in self.hashmap.items():
+            owner = ring.lookup(key)
+            if owner != self.id:
+                moved.setdefault(owner, []).append((key, value))
+        for owner, items in moved.iteritems():
+            batches = [items[b:b+BATCH_SIZE] for b in range(0, len(items), BATCH_SIZE)]
+            self.remote(owner, OP_MIGRATE, [[k for k, v in batch] for batch in batches],
+                        [[v for k, v in batch] for batch in batches])
+            for key, value in items:
+                self.hashmap.rem(key)
+            self.logger.info("%d keys handed over to node %d." % (len(items), owner))
+        for node_id in notify:
+            self.remote(node_id, OP_HANDOFF, [str(self.id)])
+
+    def add_node(self, node_id, ip, port):
+        """Add a node joining the ring and hand over the keys it now owns."""
+        self.peers_map[node_id] = {'ip': ip, 'port': port}
+        self.peers_count = len(self.peers_map)
+        self.ring = HashRing(self.peers_map.keys(), self.vnodes)
+        Thread(target=self.handoff, args=([node_id],)).start()
+
+    def remove_node(self, node_id):
+        """Remove a node leaving the ring: it hands over its keys and reads
+        fall back to it until it is done."""
+        with self.handoff_lock:
+            self.prev_ring = self.ring
+            self.pending_handoffs.add(node_id)
+            self.ring = HashRing([i for i in self.peers_map if i != node_id], self.vnodes)
+
+    def handoff_done(self, node_id):
+        """Take note that a node handed over all its keys to this node."""
+        with self.handoff_lock:
+            self.pending_handoffs.discard(node_id)
+            if node_id not in self.ring.nodes:
+                # a node that left
+                del self.peers_map[node_id]
+                self.peers_count = len(self.peers_map)
+            if not self.pending_handoffs:
+                self.prev_ring = None
+                self.tombstones = set()
+
+    def join(self):
+        """Join the ring of the other nodes of the config file. They hand
+        over the keys of this node in the background."""
+        others = [i for i in self.peers_map if i != self.id]
+        with self.handoff_lock:
+            self.prev_ring = HashRing(others, self.vnodes)
+            self.pending_handoffs = set(others)
+        for node_id in others:
+            self.remote(node_id, OP_JOIN, [str(self.id), self.ip, str(self.port)])
+
+    def leave(self):
+        """Leave the ring: hand over every key to the other nodes."""
+        others = [i for i in self.peers_map if i != self.id]
+        for node_id in others:
+            self.remote(node_id, OP_LEAVE, [str(self.id)])
+        self.prev_ring = self.ring
+        self.ring = HashRing(others, self.vnodes)
+        self.handoff(others)
+
+    def migrating(self):
+        """Return True while keys are handed over to this node."""
+        return self.prev_ring is not None
+
+    def stop(self):
+        """Terminate the node and wake up its server."""
+        self.terminate.value = 1
+        self.server.wakeup()
 
     def server_hash(self, key):
         """Return the peer id to contact given a key."""
-        return int(md5(key).hexdigest(), 16) % self.peers_count
+        return self.ring.lookup(key)
 
 
 def print_usage(args):
-    sys.stderr.write("Usage: python %s config.json\n" % args[0])
+    sys.stderr.write("Usage: python %s config.json [id]\n" % args[0])
 
 if __name__ == '__main__':
     args = sys.argv
-    if len(args) != 2:
+    if len(args) not in [2, 3]:
         print_usage(args)
         sys.exit(1)
     with open(args[1], 'r') as config_fd:
         peers_map = json.load(config_fd)
         peers_map = {int(id): peers_map[id] for id in peers_map}
-    dht_node = DHT(peers_map)
+    node_id = int(args[2]) if len(args) == 3 else None
+    dht_node = DHT(peers_map, node_id=node_id)
     try:
         dht_node.server.start()
         time.sleep(1)
@@ -83,3 +233,4 @@ if __name__ == '__main__':
         dht_node.server.join()
     except KeyboardInterrupt as e:
         sys.stderr.write("KeyboardInterrupt")
+        dht_node.stop()
@@ -0,0 +1,209 @@
+import random
+import time
+
+from array import array
+from bisect import bisect_left
+from fractions import gcd
+from threading import Thread
+from dht_protocol import *
+from socket import error
+
+OPERATIONS = ["put", "get", "del"]
+# opcode and method of the DHT of each operation
+DHT_ACTIONS = {
+    "put": (OP_PUT, "put"),
+    "get": (OP_GET, "get"),
+    "del": (OP_REM, "rem")
+}
+# a latency is counted in the bucket of its 7 most significant bits: the
+# buckets keep 2 significant digits from 1us to hours
+SUB_BUCKET_BITS = 7
+
+
+class LatencyHistogram:
+    """Histogram of latencies in microseconds with buckets of logarithmic
+    size, as HdrHistogram: recording is O(1), the memory does not grow with
+    the number of values and the percentiles keep 2 significant digits."""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _bucket(self, value):
+        shift = max(0, value.bit_length() - SUB_BUCKET_BITS)
+        return (value >> shift) << shift
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Return the lower bound in microseconds of the bucket holding the
+        p-th percentile."""
+        if not self.count:
+            return 0
+        rank = p / 100. * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return bucket
+        return self.max
+
+    def summary(self):
+        """Return the statistics of the histogram, latencies in ms."""
+        res = {"count": self.count,
+               "mean": self.total / 1000. / self.count if self.count else 0.,
+               "max": self.max / 1000.}
+        for p in [50, 90, 99, 99.9]:
+            res["p%s" % str(p).replace('.', '')] = self.percentile(p) / 1000.
+        # lower bound in microseconds and count of each non empty bucket
+        res["histogram"] = sorted(self.counts.items())
+        return res
+
+
+class ZipfGenerator:
+    """Draw ranks from 0 to n-1 where rank r has a probability proportional
+    to 1/(r+1)^s: s=0 is uniform, s around 1 makes a few keys very hot."""
+
+    def __init__(self, n, s):
+        total = sum(1. / (r + 1) ** s for r in xrange(n))
+        # packed doubles: a fifth of the memory of a list of floats
+        self.cdf = array('d')
+        acc = 0.
+        for r in xrange(n):
+            acc += 1. / (r + 1) ** s / total
+            self.cdf.append(acc)
+
+    def rank(self, x):
+        """Return the rank of a uniform number of [0, 1)."""
+        return min(bisect_left(self.cdf, x), len(self.cdf) - 1)
+
+
+def parse_mix(mix_str):
+    """Parse 'op:weight,...' into a list of (op, weight) pairs."""
+    mix = []
+    for item in mix_str.split(','):
+        op, weight = item.split(':')
+        if op not in OPERATIONS:
+            raise ValueError("operations should be in %s" % OPERATIONS)
+        mix.append((op, float(weight)))
+    return mix
+
+
+class BenchmarkWorker(Thread):
+    """Run operations drawn from a mix on keys drawn from a Zipf law, on the
+    node owning each key, and record their latency."""
+
+    def __init__(self, dht, key_of, data, count, mix, zipf, seed):
+        super(BenchmarkWorker, self).__init__()
+        self.dht = dht
+        self.key_of = key_of
+        self.data = data
+        self.count = count
+        self.mix = mix
+        self.total = sum(weight for op, weight in mix)
+        self.zipf = zipf
+        self.random = random.Random(seed)
+        self.histograms = dict((op, LatencyHistogram()) for op, weight in mix)
+        self.errors = 0
+
+    def _draw(self):
+        x = self.random.uniform(0, self.total)
+        for op, weight in self.mix:
+            x -= weight
+            if x <= 0:
+                return op
+        return self.mix[-1][0]
+
+    def run(self):
+        for _ in xrange(self.count):
+            op = self._draw()
+            key = self.key_of(self.zipf.rank(self.random.random()))
+            opcode, method = DHT_ACTIONS[op]
+            args = [key, self.data[key]] if op == "put" else [key]
+            server_id = self.dht.server_hash(key)
+            t0 = time.time()
+            try:
+                if server_id == self.dht.id:
+                    getattr(self.dht, method)(*args)
+                    if op != "get":
+                        self.dht.sync()
+                else:
+                    # one connection to each node per thread
+                    self.dht.remote(server_id, opcode, args[:1], args[1:] or None)
+            except (error, EOFError) as e:
+                self.errors += 1
+                continue
+            self.histograms[op].record(time.time() - t0)
+
+
+def rank_permutation(data, seed):
+    """Return the number of keys of the data and a function returning the
+    key of a rank. The ranks are permuted by an affine map so that the hot
+    keys are spread over the nodes; the key of a rank is only read when it
+    is drawn."""
+    if hasattr(data, "key_at"):
+        n_keys, key_at = data.count, data.key_at
+    else:
+        keys = sorted(data)
+        n_keys, key_at = len(keys), keys.__getitem__
+    rand = random.Random(seed)
+    # a stride prime with the number of keys makes the map a bijection
+    stride = rand.randrange(1, max(2, n_keys))
+    while gcd(stride, n_keys) != 1:
+        stride = rand.randrange(1, n_keys)
+    start = rand.randrange(max(1, n_keys))
+
+    def key_of(rank):
+        return key_at((stride * rank + start) % n_keys)
+    return n_keys, key_of
+
+def run_benchmark(dht, data, workers, count, mix, zipf_s, seed=0):
+    """Run count operations on each of workers concurrent threads and return
+    the results as a dict ready to be dumped in JSON."""
+    n_keys, key_of = rank_permutation(data, seed)
+    zipf = ZipfGenerator(n_keys, zipf_s)
+    threads = [BenchmarkWorker(dht, key_of, data, count, mix, zipf, (seed, dht.id, i))
+               for i in range(workers)]
+    t0 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - t0
+
+    operations = {}
+    for op, weight in mix:
+        histogram = LatencyHistogram()
+        for thread in threads:
+            histogram.merge(thread.histograms[op])
+        operations[op] = histogram.summary()
+        operations[op]["throughput"] = histogram.count / duration
+    completed = sum(res["count"] for res in operations.values())
+    return {
+        "node": dht.id,
+        "nodes": len(dht.peers_map),
+        "workers": workers,
+        "ops_per_worker": count,
+        "mix": dict(mix),
+        "zipf": zipf_s,
+        "keys": n_keys,
+        "duration": duration,
+        "throughput": completed / duration,
+        "errors": sum(thread.errors for thread in threads),
+        "operations": operations
+    }
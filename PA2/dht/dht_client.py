@@ -4,12 +4,18 @@ import sys
 import time
 
 from multiprocessing import Process
+from threading import Thread
 from dht_protocol import *
+from dht_bench import parse_mix, run_benchmark
+from dht_data import load_data
 from socket import *
 from collections import Counter
 
 logging.basicConfig(level=logging.DEBUG)
 
+# number of keys sent in one mput/mget/mdel request
+BATCH_SIZE = 1000
+
 class DHTClient(Process):
     def __init__(self, dht):
         super(DHTClient, self).__init__()
@@ -20,11 +26,8 @@ class DHTClient(Process):
 
         # load key/val data for benchmark
         self.logger.info("Loading data in memory for the benchmark...")
-        self.data = {}
-        with open("keyval.data") as data_fd:
-            for line in data_fd:
-                k, v = line.split()
-                self.data[k] = v
+        # mapped in memory if the data file is binary
+        self.data = load_data("keyval.data")
         self.logger.info("Benchmark data successfully loaded.")
         # keep map of sockets connected with peers
         # init connection at first client request
@@ -32,10 +35,21 @@ class DHTClient(Process):
             "put": self._put,
             "get": self._get,
             "del": self._del,
+            "mput": self._mput,
+            "mget": self._mget,
+            "mdel": self._mdel,
             "benchmark": self._benchmark,
+            "join": self._join,
+            "leave": self._leave,
             "exit": self._exit,
         }
         self.socket_map = {}
+        # batched actions of the client and the matching server actions
+        self.multi_actions = {
+            "mput": "put",
+            "mget": "get",
+            "mdel": "rem"
+        }
 
     def run(self):
         self.logger.info('Starting DHT client.')
@@ -59,16 +73,20 @@ class DHTClient(Process):
             except KeyboardInterrupt as e:
                 sys.stderr.write("\r\n")
             except EOFError as e:
-                self.dht.terminate.value = 1
+                self.dht.stop()
+                stop = True
 
-    def _get_peer_sock(self, server_id):
+    def _get_peer_exch(self, server_id):
         if server_id not in self.socket_map:
             sock = socket(AF_INET, SOCK_STREAM)
             peer = self.dht.peers_map[server_id]
             sock.connect((peer['ip'], peer['port']))
-            self.socket_map[server_id] = sock
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            # one exchanger per socket: it buffers the responses received
+            self.socket_map[server_id] = MessageExchanger(sock)
         return self.socket_map[server_id]
 
+
     def _generic_action(self, action, key, args, print_output=True):
         # hash key to get the server id
         server_id = self.dht.server_hash(key)
@@ -77,57 +95,155 @@ class DHTClient(Process):
             self.logger.debug("local %s" % (action))
             method = getattr(self.dht, action)
             res = method(*args)
+            self.dht.sync()
         else:
             self.logger.debug("network %s" % (action))
-            sock = self._get_peer_sock(server_id)
-            exch = MessageExchanger(sock)
-            exch.send("%s %s" % (action, " ".join(args)))
-            res = exch.recv()
-            if res in str2py:
-                res = str2py[res]
+            exch = self._get_peer_exch(server_id)
+            values = args[1:] or None
+            exch.send(encode_request(OPCODES[action], [key], values))
+            res = decode_response(memoryview(exch.recv()))[0]
         if print_output:
             print("RET> %s" % res)
         return False, res
 
-    def _benchmark(self, action, first_key, count):
+    def _multi_action(self, action, keys, values=None, print_output=True):
+        # group the keys by server id: the local keys are read or written
+        # directly, the other ones are sent by batches of BATCH_SIZE keys,
+        # in parallel to every node
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self.dht.server_hash(key), []).append(i)
+        results = [None] * len(keys)
+
+        def run_group(server_id, idx):
+            if server_id == self.dht.id:
+                self.logger.debug("local m%s" % (action))
+                method = getattr(self.dht, action)
+                for i in idx:
+                    args = [keys[i]] if values is None else [keys[i], values[i]]
+                    results[i] = method(*args)
+                self.dht.sync()
+                return
+            self.logger.debug("network m%s" % (action))
+            batches = [idx[b:b+BATCH_SIZE] for b in range(0, len(idx), BATCH_SIZE)]
+            msgs = []
+            for batch in batches:
+                batch_values = None if values is None else [values[i] for i in batch]
+                msgs.append(encode_request(OPCODES[action], [keys[i] for i in batch], batch_values))
+            for batch, res in zip(batches, self._get_peer_exch(server_id).pipeline(msgs)):
+                for i, v in zip(batch, decode_response(memoryview(res))):
+                    results[i] = v
+
+        threads = [Thread(target=run_group, args=(server_id, idx))
+                   for server_id, idx in groups.iteritems()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if print_output:
+            print("RET> %s" % results)
+        return False, results
+
+    def _mixed_benchmark(self, *args):
+        # benchmark mixed [workers=4] [ops=10000] [mix=get:90,put:10] [zipf=0.99] [output=F]
+        opts = {"workers": "4", "ops": "10000", "mix": "get:90,put:10", "zipf": "0.99",
+                "output": "bench_%d.json" % self.dht.id}
+        for arg in args:
+            arg_name, _, arg_val = arg.partition('=')
+            if arg_name not in opts:
+                raise TypeError("unknown benchmark argument: %s" % arg)
+            opts[arg_name] = arg_val
+        try:
+            mix = parse_mix(opts["mix"])
+        except ValueError as e:
+            raise TypeError(str(e))
+        res = run_benchmark(self.dht, self.data, int(opts["workers"]), int(opts["ops"]),
+                            mix, float(opts["zipf"]))
+        for op, op_res in sorted(res["operations"].items()):
+            self.logger.info("%s: %d ops, %.0f ops/s, mean %.3f ms, p50 %.3f ms, p99 %.3f ms, max %.3f ms." % (
+                op, op_res["count"], op_res["throughput"], op_res["mean"], op_res["p50"],
+                op_res["p99"], op_res["max"]))
+        self.logger.info("%.0f ops/s in %.3f seconds, %d errors." % (
+            res["throughput"], res["duration"], res["errors"]))
+        with open(opts["output"], 'w') as output_fd:
+            json.dump(res, output_fd, indent=2)
+        self.logger.info("Results written to %s." % opts["output"])
+        return False, None
+
+    def _benchmark(self, action, *args):
+        if action == "mixed":
+            return self._mixed_benchmark(*args)
         # benchmark action first_key count
+        first_key, count = args
         first_key = int(first_key)
         count = int(count)
         results = []
         t0 = time.time()
         R = range(first_key, first_key+count)
-        for k in R:
-            k = str(k)
-            if action == "put":
-                args = [k, self.data[k], False]
-            else:
-                args = [k, False]
-            func = getattr(self, "_" + action)
-            _, ret = func(*args)
-            results.append(ret)
+        if action in self.multi_actions:
+            keys = [str(k) for k in R]
+            values = [self.data[k] for k in keys] if action == "mput" else None
+            _, results = self._multi_action(self.multi_actions[action], keys, values, False)
+        else:
+            for k in R:
+                k = str(k)
+                if action == "put":
+                    args = [k, self.data[k], False]
+                else:
+                    args = [k, False]
+                func = getattr(self, "_" + action)
+                _, ret = func(*args)
+                results.append(ret)
         t1 = time.time()
         delta = t1 - t0
         self.logger.info("Results check:")
-        if action == 'get':
+        if action in ['get', 'mget']:
             results = [True if results[i] == self.data[str(k)] else False for i, k in enumerate(R)]
         self.logger.info("Results: %s" % (repr(Counter(results).most_common(2))))
         self.logger.info("%d %s operations completed in %.3f seconds." % (count, action, delta))
         return False, None
 
 
-    def _put(self, key, value):
+    def _put(self, key, value, print_output=True):
         self.logger.debug("put")
-        return self._generic_action("put", key, [key, value])
+        return self._generic_action("put", key, [key, value], print_output)
 
-    def _get(self, key):
+    def _get(self, key, print_output=True):
         self.logger.debug("get")
-        return self._generic_action("get", key, [key])
+        return self._generic_action("get", key, [key], print_output)
 
-    def _del(self, key):
+    def _del(self, key, print_output=True):
         self.logger.debug("del")
-        return self._generic_action("rem", key, [key])
+        return self._generic_action("rem", key, [key], print_output)
+
+    def _mput(self, *args):
+        self.logger.debug("mput")
+        if len(args) % 2:
+            raise TypeError("mput expects pairs of key and value")
+        return self._multi_action("put", list(args[::2]), list(args[1::2]))
+
+    def _mget(self, *keys):
+        self.logger.debug("mget")
+        return self._multi_action("get", list(keys))
+
+    def _mdel(self, *keys):
+        self.logger.debug("mdel")
+        return self._multi_action("rem", list(keys))
+
+    def _join(self):
+        self.logger.debug("join")
+        self.dht.join()
+        self.logger.info("Joined the ring, keys are being handed over.")
+        return False, None
+
+    def _leave(self):
+        self.logger.debug("leave")
+        self.dht.leave()
+        self.logger.info("Left the ring, all keys handed over.")
+        self.dht.stop()
+        return True, None
 
     def _exit(self):
         self.logger.debug("exit")
-        self.dht.terminate.value = 1
+        self.dht.stop()
         return True, None
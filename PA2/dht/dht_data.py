@@ -0,0 +1,128 @@
+import mmap
+import os
+import string
+import struct
+
+# binary benchmark data: a header followed by the values of consecutive
+# integer keys, all of the same size, so the value of a key is found from
+# the key alone
+MAGIC = 'KVD1'
+HEADER = struct.Struct('>4sIII')
+CHOOSE_FROM = string.ascii_lowercase + string.ascii_uppercase + string.digits
+# random bytes kept to draw the characters uniformly: the largest multiple
+# of the number of characters
+KEPT_BYTES = 256 // len(CHOOSE_FROM) * len(CHOOSE_FROM)
+TO_CHARS = ''.join(CHOOSE_FROM[b % len(CHOOSE_FROM)] for b in range(256))
+DROPPED_BYTES = ''.join(chr(b) for b in range(KEPT_BYTES, 256))
+
+
+def random_chars(n):
+    """Return n random characters of CHOOSE_FROM, drawn by blocks."""
+    chunks = []
+    missing = n
+    while missing > 0:
+        chunk = os.urandom(missing + missing // 8 + 16).translate(TO_CHARS, DROPPED_BYTES)
+        chunks.append(chunk[:missing])
+        missing -= len(chunks[-1])
+    return ''.join(chunks)
+
+
+class KeyValData:
+    """Read-only mapping of the values of a binary data file, mapped in
+    memory: the pages of the values are only read when they are used."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as data_fd:
+            self.map = mmap.mmap(data_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.first_key, self.count, self.val_size = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError("%s is not a binary data file." % path)
+
+    def _offset(self, key):
+        try:
+            i = int(key) - self.first_key
+        except ValueError:
+            raise KeyError(key)
+        if not 0 <= i < self.count:
+            raise KeyError(key)
+        return HEADER.size + i * self.val_size
+
+    def __getitem__(self, key):
+        offset = self._offset(key)
+        return self.map[offset:offset+self.val_size]
+
+    def __contains__(self, key):
+        try:
+            self._offset(key)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (str(k) for k in xrange(self.first_key, self.first_key + self.count))
+
+    def key_at(self, i):
+        """Return the i-th key, without reading the others."""
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return str(self.first_key + i)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return list(self)
+
+
+def is_binary(path):
+    with open(path, 'rb') as data_fd:
+        return data_fd.read(len(MAGIC)) == MAGIC
+
+def load_data(path):
+    """Return the benchmark data of a file as a mapping of keys to values:
+    mapped in memory for a binary file, loaded in a dict for a text file."""
+    if is_binary(path):
+        return KeyValData(path)
+    data = {}
+    with open(path) as data_fd:
+        for line in data_fd:
+            k, v = line.split()
+            data[k] = v
+    return data
+
+def load_pairs(path, n_keys):
+    """Return the first n_keys (key, value) pairs of a data file."""
+    if is_binary(path):
+        data = KeyValData(path)
+        first_key = data.first_key
+        return [(str(k), data[k]) for k in xrange(first_key, first_key + min(n_keys, len(data)))]
+    pairs = []
+    with open(path) as data_fd:
+        for line in data_fd:
+            if len(pairs) == n_keys:
+                break
+            k, v = line.split()
+            pairs.append((k, v))
+    return pairs
+
+def write_binary(path, first_key, count, val_size):
+    """Write count random values of val_size characters for the keys
+    following first_key in a binary data file."""
+    with open(path, 'wb') as data_fd:
+        data_fd.write(HEADER.pack(MAGIC, first_key, count, val_size))
+        # by blocks of a million values at most
+        for start in xrange(0, count, 1000000):
+            data_fd.write(random_chars(min(1000000, count - start) * val_size))
+
+def write_text(path, first_key, count, val_size):
+    """Write count random values in the text format, one 'key  value' pair
+    per line."""
+    with open(path, 'w') as data_fd:
+        for start in xrange(0, count, 1000000):
+            n = min(1000000, count - start)
+            chars = random_chars(n * val_size)
+            data_fd.write(''.join("%d  %s\n" % (first_key + start + i, chars[i*val_size:(i+1)*val_size])
+                                  for i in xrange(n)))
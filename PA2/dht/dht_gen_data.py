@@ -1,15 +1,20 @@
-import random
-import string
 import sys
 
+from dht_data import write_binary, write_text
+
 val_size = 20
 n_servers = 8
 n_keys = 100000
 
-choose_from = string.ascii_lowercase + string.ascii_uppercase + string.digits
+def print_usage(args):
+    sys.stderr.write("Usage: python %s keyval.data [binary|text]\n" % args[0])
 
-for s in range(1, n_servers+1):
-    sys.stderr.write("Create key value for server %d/%d.\n" % (s, n_servers))
-    for i in range(n_keys):
-        v = ''.join(random.choice(choose_from) for _ in range(val_size))
-        print("%d%05d  %s" % (s, i, v))
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) not in [2, 3] or (len(args) == 3 and args[2] not in ["binary", "text"]):
+        print_usage(args)
+        sys.exit(1)
+    write = write_text if len(args) == 3 and args[2] == "text" else write_binary
+    # keys of server s range from s00000 to s99999
+    sys.stderr.write("Create key value for %d servers.\n" % n_servers)
+    write(args[1], n_keys, n_servers * n_keys, val_size)
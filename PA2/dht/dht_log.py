@@ -0,0 +1,208 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+from threading import Thread, Condition
+
+# a record is the crc of the rest of the record, an operation, the length
+# of the key and of the value, and their raw bytes
+RECORD = struct.Struct('>IBII')
+LOG_PUT = 1
+LOG_REM = 2
+# size of the log above which a snapshot of the store is written and a
+# new log is started
+SNAPSHOT_SIZE = 64*1024**2
+
+
+def encode_record(op, key, value=''):
+    body = RECORD.pack(0, op, len(key), len(value))[4:] + key + value
+    return struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body
+
+def read_records(path):
+    """Iterate over the valid records of a file and the offset of their
+    end: a record cut by a crash ends the file."""
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size == 0:
+        return
+    with open(path, 'rb') as fd:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = 0
+        while offset + RECORD.size <= size:
+            crc, op, key_len, value_len = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + key_len + value_len
+            if end > size or zlib.crc32(data[offset+4:end]) & 0xffffffff != crc:
+                break
+            key_start = offset + RECORD.size
+            yield op, data[key_start:key_start+key_len], data[key_start+key_len:end], end
+            offset = end
+    finally:
+        data.close()
+
+
+class WriteLog:
+    """Append-only log of the writes of a store, with periodic snapshots.
+
+    Writes are appended to a buffer and a writer thread writes and fsyncs
+    everything buffered at once, so concurrent writers share each fsync.
+    When the log grows above snapshot_size, the writer starts a new log
+    and a snapshot of the store is written: at startup, the last complete
+    snapshot is loaded and the logs that follow it are replayed."""
+
+    def __init__(self, path, snapshot_size=SNAPSHOT_SIZE, on_sync=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.INFO)
+
+        self.path = path
+        self.snapshot_size = snapshot_size
+        # called by the writer thread after each fsync
+        self.on_sync = on_sync
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.cond = Condition()
+        self.buf = []
+        # sequence number of the last record appended and of the last
+        # record on disk
+        self.last_lsn = 0
+        self.synced_lsn = 0
+        self.gen = 0
+        self.log_fd = None
+        self.log_size = 0
+        self.items = None
+        self.snapshot_thread = None
+        self.closed = False
+        self.writer = None
+
+    def _file(self, name, gen):
+        return os.path.join(self.path, "%s.%d" % (name, gen))
+
+    def _gens(self, name):
+        gens = []
+        for f in os.listdir(self.path):
+            prefix, _, gen = f.partition('.')
+            if prefix == name and gen.isdigit():
+                gens.append(int(gen))
+        return sorted(gens)
+
+    def replay(self, put, rem):
+        """Load the last snapshot and replay the logs written after it with
+        the put and rem functions of the store. Return the number of
+        records read."""
+        snapshots = self._gens("snapshot")
+        self.gen = snapshots[-1] if snapshots else 0
+        count = 0
+        for op, key, value, end in read_records(self._file("snapshot", self.gen)):
+            put(key, value)
+            count += 1
+        logs = [gen for gen in self._gens("log") if gen >= self.gen]
+        end = 0
+        for gen in logs:
+            end = 0
+            for op, key, value, end in read_records(self._file("log", gen)):
+                if op == LOG_PUT:
+                    put(key, value)
+                else:
+                    rem(key)
+                count += 1
+            self.gen = gen
+        # appends go after the last valid record of the last log
+        self.log_fd = os.open(self._file("log", self.gen), os.O_WRONLY|os.O_CREAT)
+        os.ftruncate(self.log_fd, end)
+        os.lseek(self.log_fd, end, os.SEEK_SET)
+        self.log_size = end
+        self.logger.info("%d records replayed from %s." % (count, self.path))
+        return count
+
+    def start(self, items):
+        """Start the writer thread. items returns the entries of the store
+        for the snapshots."""
+        self.items = items
+        self.writer = Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def append(self, op, key, value=''):
+        """Buffer a record and return its sequence number."""
+        record = encode_record(op, key, value)
+        with self.cond:
+            self.buf.append(record)
+            self.last_lsn += 1
+            self.cond.notify_all()
+            return self.last_lsn
+
+    def wait(self, lsn):
+        """Wait until the record of sequence number lsn is on disk."""
+        with self.cond:
+            while self.synced_lsn < lsn and not self.closed:
+                self.cond.wait()
+
+    def _write(self):
+        while True:
+            with self.cond:
+                while not self.buf and not self.closed:
+                    self.cond.wait()
+                if not self.buf:
+                    return
+                records, self.buf = self.buf, []
+                lsn = self.last_lsn
+            data = ''.join(records)
+            os.write(self.log_fd, data)
+            os.fsync(self.log_fd)
+            self.log_size += len(data)
+            with self.cond:
+                self.synced_lsn = lsn
+                self.cond.notify_all()
+            if self.on_sync is not None:
+                self.on_sync()
+            if self.log_size > self.snapshot_size and (
+                    self.snapshot_thread is None or not self.snapshot_thread.is_alive()):
+                self._rotate()
+
+    def _rotate(self):
+        """Start a new log and write a snapshot of the store in the
+        background: the new log is replayed on top of the snapshot."""
+        os.close(self.log_fd)
+        self.gen += 1
+        self.log_fd = os.open(self._file("log", self.gen), os.O_WRONLY|os.O_CREAT|os.O_TRUNC)
+        self.log_size = 0
+        self.snapshot_thread = Thread(target=self._snapshot, args=(self.gen,))
+        self.snapshot_thread.start()
+
+    def _snapshot(self, gen):
+        tmp_path = self._file("snapshot", gen) + ".tmp"
+        count = 0
+        with open(tmp_path, 'wb') as fd:
+            chunk = []
+            for key, value in self.items():
+                chunk.append(encode_record(LOG_PUT, key, value))
+                count += 1
+                if len(chunk) == 10000:
+                    fd.write(''.join(chunk))
+                    chunk = []
+            fd.write(''.join(chunk))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp_path, self._file("snapshot", gen))
+        dir_fd = os.open(self.path, os.O_RDONLY)
+        os.fsync(dir_fd)
+        os.close(dir_fd)
+        # the snapshot replaces the older snapshots and logs
+        for name in ["snapshot", "log"]:
+            for old_gen in self._gens(name):
+                if old_gen < gen:
+                    os.remove(self._file(name, old_gen))
+        self.logger.info("Snapshot of %d entries written." % count)
+
+    def close(self):
+        """Write the buffered records and stop the writer thread."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        os.close(self.log_fd)
@@ -1,41 +1,201 @@
 import struct
 
-py2str = {
-    True: "SUCCESS",
-    False: "FAILURE",
-    None: "NONE"
+# length of the message and id of the request in front of each message
+HEADER = struct.Struct('>II')
+# maximum number of bytes read from a socket at once
+RECV_SIZE = 64*1024
+# number of requests sent to a node before waiting for their responses
+PIPELINE_DEPTH = 64
+
+# a request is an opcode and a number of keys, followed by the length of
+# each key (and of its value for a put) and their raw bytes
+OP_PUT = 1
+OP_GET = 2
+OP_REM = 3
+OPCODES = {
+    "put": OP_PUT,
+    "get": OP_GET,
+    "rem": OP_REM
 }
+# membership changes: keys handed over by their former owner, a node
+# joining (keys are its id, ip and port), a node leaving (its id) and a
+# node done handing over its keys (its id)
+OP_MIGRATE = 4
+OP_JOIN = 5
+OP_LEAVE = 6
+OP_HANDOFF = 7
+# flag of the requests forwarded by a node to the owner of their keys:
+# they are never forwarded again
+FORWARDED = 0x80
+# flag of the requests sent to the former owner of their keys while they
+# are handed over: they are served from its store
+PREVIOUS = 0x40
+FLAGS = FORWARDED | PREVIOUS
+VALUE_OPS = (OP_PUT, OP_MIGRATE)
+REQUEST = struct.Struct('>BI')
+KEY = struct.Struct('>I')
+KEY_VALUE = struct.Struct('>II')
 
-str2py = {
-    "SUCCESS": True,
-    "FAILURE": False,
-    "NONE": None
+# a response is a number of results, each one a type byte followed by
+# the length and the raw bytes of the value for a value result
+COUNT = struct.Struct('>I')
+RESULT = struct.Struct('>B')
+VALUE = struct.Struct('>BI')
+RES_NONE = 0
+RES_FALSE = 1
+RES_TRUE = 2
+RES_VALUE = 3
+py2res = {
+    None: RESULT.pack(RES_NONE),
+    False: RESULT.pack(RES_FALSE),
+    True: RESULT.pack(RES_TRUE)
+}
+# type bytes as read from a memoryview
+res2py = {
+    RESULT.pack(RES_NONE): None,
+    RESULT.pack(RES_FALSE): False,
+    RESULT.pack(RES_TRUE): True
 }
+VALUE_TYPE = RESULT.pack(RES_VALUE)
+
+def frame(msg, req_id=0):
+    """Return a message preceded by its header."""
+    return HEADER.pack(len(msg), req_id) + msg
+
+def _check(offset, end):
+    # the fields are sliced without bound checks: check the end once
+    if offset > end:
+        raise ValueError("truncated message")
+
+def encode_request(opcode, keys, values=None):
+    """Encode a request on keys, with their values for a put."""
+    header = REQUEST.pack(opcode, len(keys))
+    if values is None:
+        pack = KEY.pack
+        return header + ''.join([pack(len(key)) + key for key in keys])
+    pack = KEY_VALUE.pack
+    return header + ''.join([pack(len(key), len(value)) + key + value
+                             for key, value in zip(keys, values)])
+
+def decode_request(view, offset=0, end=None):
+    """Decode the request held by a memoryview between offset and end.
+    Return the opcode, the keys, and the values (None if the request has
+    no value)."""
+    if end is None:
+        end = len(view)
+    _check(offset + REQUEST.size, end)
+    opcode, count = REQUEST.unpack_from(view, offset)
+    offset += REQUEST.size
+    keys = []
+    values = None
+    if (opcode & ~FLAGS) in VALUE_OPS:
+        values = []
+        unpack, size = KEY_VALUE.unpack_from, KEY_VALUE.size
+        for _ in xrange(count):
+            key_len, value_len = unpack(view, offset)
+            offset += size
+            keys.append(view[offset:offset+key_len].tobytes())
+            offset += key_len
+            values.append(view[offset:offset+value_len].tobytes())
+            offset += value_len
+    else:
+        unpack, size = KEY.unpack_from, KEY.size
+        for _ in xrange(count):
+            key_len = unpack(view, offset)[0]
+            offset += size
+            keys.append(view[offset:offset+key_len].tobytes())
+            offset += key_len
+    _check(offset, end)
+    return opcode, keys, values
+
+def encode_response(results):
+    """Encode a list of results: None, True, False or a value."""
+    pack = VALUE.pack
+    return COUNT.pack(len(results)) + ''.join([
+        pack(RES_VALUE, len(res)) + res if isinstance(res, str) else py2res[res]
+        for res in results])
+
+def decode_response(view, offset=0, end=None):
+    """Decode the list of results held by a memoryview."""
+    if end is None:
+        end = len(view)
+    _check(offset + COUNT.size, end)
+    count = COUNT.unpack_from(view, offset)[0]
+    offset += COUNT.size
+    results = []
+    unpack, size = VALUE.unpack_from, VALUE.size
+    for _ in xrange(count):
+        res_type = view[offset]
+        if res_type == VALUE_TYPE:
+            value_len = unpack(view, offset)[1]
+            offset += size
+            results.append(view[offset:offset+value_len].tobytes())
+            offset += value_len
+        else:
+            results.append(res2py[res_type])
+            offset += RESULT.size
+    _check(offset, end)
+    return results
 
 class MessageExchanger:
     def __init__(self, sock):
         self.sock = sock
+        # bytes received after the last message returned
+        self.buf = bytearray()
+
+    def send(self, msg, req_id=0):
+        # send length of the message and id of the request
+        self.sock.sendall(frame(msg, req_id))
+
+    def send_many(self, msgs, first_id=0):
+        """Send several requests at once, with consecutive ids."""
+        self.sock.sendall(''.join(frame(msg, first_id + i) for i, msg in enumerate(msgs)))
 
-    def send(self, msg):
-        # send length of the message
-        msg = struct.pack('>I', len(msg)) + msg
-        self.sock.sendall(msg)
+    def pipeline(self, msgs, depth=PIPELINE_DEPTH):
+        """Send requests keeping up to depth of them in flight and return the
+        responses in the order of the requests."""
+        results = [None] * len(msgs)
+        sent = received = 0
+        while received < len(msgs):
+            in_flight = sent - received
+            if sent < len(msgs) and in_flight <= depth // 2:
+                n = min(depth - in_flight, len(msgs) - sent)
+                self.send_many(msgs[sent:sent+n], sent)
+                sent += n
+            res = self.recv_with_id()
+            if res is None:
+                raise EOFError("connection closed while waiting for responses")
+            req_id, msg = res
+            results[req_id] = msg
+            received += 1
+        return results
 
     def recv(self):
-        # get message length
-        raw_msglen = self.recvall(4)
-        if not raw_msglen:
+        res = self.recv_with_id()
+        if res is None:
             return None
-        msglen = struct.unpack('>I', raw_msglen)[0]
+        return res[1]
+
+    def recv_with_id(self):
+        """Return the next message and the id of its request, or None."""
+        raw_header = self.recvall(HEADER.size)
+        if not raw_header:
+            return None
+        msglen, req_id = HEADER.unpack(raw_header)
         # get message
-        return self.recvall(msglen)
+        msg = self.recvall(msglen)
+        if msg is None:
+            return None
+        return req_id, msg
 
     def recvall(self, n):
-        # Helper function to recv n bytes or return None if EOF is hit
-        data = ''
-        while len(data) < n:
-            packet = self.sock.recv(n - len(data))
+        # Helper function to recv n bytes or return None if EOF is hit.
+        # Read by large blocks: pipelined responses arrive together.
+        while len(self.buf) < n:
+            packet = self.sock.recv(max(RECV_SIZE, n - len(self.buf)))
             if not packet:
                 return None
-            data += packet
+            self.buf += packet
+        data = str(self.buf[:n])
+        del self.buf[:n]
         return data
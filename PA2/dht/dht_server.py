@@ -1,15 +1,39 @@
 import json
 import logging
+import os
+import select
+import struct
 import sys
 
-from select import select
+from errno import EAGAIN, EWOULDBLOCK
 from dht_protocol import *
-from multiprocessing import Process
+from threading import Thread
 from socket import *
+from Queue import Queue, Empty
+from collections import deque
 
 logging.basicConfig(level=logging.DEBUG)
 
-class DHTServer(Process):
+# maximum number of bytes read from a socket at once
+RECV_SIZE = 64*1024
+# number of threads serving the requests that need other nodes
+WORKERS = 4
+# requests answered once their writes are on disk
+WRITE_OPS = (OP_PUT, OP_REM, OP_MIGRATE)
+
+
+class Connection:
+    """Buffers of a peer connection served by the event loop."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        # kept to find the connection once the socket is closed
+        self.fd = sock.fileno()
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+
+
+class DHTServer(Thread):
     def __init__(self, dht):
         super(DHTServer, self).__init__()
 
@@ -18,13 +42,36 @@ class DHTServer(Process):
 
         self.dht = dht
         self.listening_socket = None
-        
+        self.poller = None
+        # written to wake up the event loop when the node terminates
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
         self.actions_list = {
-            "put": self._put,
-            "get": self._get,
-            "rem": self._del
+            OP_PUT: self._put,
+            OP_GET: self._get,
+            OP_REM: self._del,
+            OP_MIGRATE: self._migrate
+        }
+        # actions on the store only, for the keys this node hands over
+        self.store_actions = {
+            OP_PUT: self.dht.hashmap.put,
+            OP_GET: self.dht.hashmap.get,
+            OP_REM: self.dht.hashmap.rem,
+            OP_MIGRATE: self.dht.hashmap.put_new
         }
-        self.socket_list = []
+        # membership actions take all the keys of the request at once
+        self.membership_actions = {
+            OP_JOIN: self._join,
+            OP_LEAVE: self._leave,
+            OP_HANDOFF: self._handoff
+        }
+        self.connections = {}
+        # requests waiting for a worker and responses waiting to be sent
+        self.requests = Queue()
+        self.responses = Queue()
+        # responses of writes not on disk yet, with the sequence number of
+        # the last record of the log when they were served
+        self.unsynced = deque()
 
     def _put(self, key, value):
         self.logger.debug("put")
@@ -37,71 +84,260 @@ class DHTServer(Process):
 
     def _del(self, key):
         self.logger.debug("del")
-        self.dht.rem(key)
+        return self.dht.rem(key)
+
+    def _migrate(self, key, value):
+        self.logger.debug("migrate")
+        return self.dht.migrate(key, value)
+
+    def _join(self, node_id, ip, port):
+        self.logger.info("Node %s joins the ring." % node_id)
+        self.dht.add_node(int(node_id), ip, int(port))
+        return True
+
+    def _leave(self, node_id):
+        self.logger.info("Node %s leaves the ring." % node_id)
+        self.dht.remove_node(int(node_id))
+        return True
+
+    def _handoff(self, node_id):
+        self.logger.info("Node %s handed over its keys." % node_id)
+        self.dht.handoff_done(int(node_id))
         return True
-    
-    def _message_handler(self, sock, addr):
+
+    def wakeup(self):
+        """Interrupt the event loop so that it checks the terminate flag."""
+        os.write(self.wakeup_w, 'x')
+
+    def _handle_request(self, conn, req_id, view, start, end):
+        """Run the request held by view[start:end] and return the encoded
+        response to send back, or None if the request is left to a worker
+        because it may need other nodes."""
         try:
-            sock.setblocking(0)
-            self.socket_list.append(sock)
-            
-            exch = MessageExchanger(sock)
+            opcode, keys, values = decode_request(view, start, end)
+        except (struct.error, ValueError) as e:
+            self.logger.error(repr(e))
+            return encode_response([None])
+        self.logger.debug("Request %d on %d keys received." % (opcode, len(keys)))
+
+        if opcode in self.membership_actions:
+            try:
+                return encode_response([self.membership_actions[opcode](*keys)])
+            except (TypeError, ValueError, KeyError) as e:
+                self.logger.error(repr(e))
+                return encode_response([False])
+        forwarded = opcode & FORWARDED
+        previous = opcode & PREVIOUS
+        opcode &= ~FLAGS
+        if opcode not in self.actions_list:
+            return encode_response([None] * len(keys))
+        if previous:
+            res = encode_response(self._run(opcode, keys, values, self.store_actions))
+        # served in the loop unless a key has to be read, written or
+        # deleted on another node
+        elif opcode == OP_MIGRATE or (not self.dht.migrating() and (
+                forwarded or all(self.dht.server_hash(key) == self.dht.id for key in keys))):
+            res = encode_response(self._run(opcode, keys, values))
+        else:
+            self.requests.put((conn, req_id, opcode, forwarded, keys, values))
+            return None
+        if self.dht.log is not None and opcode in WRITE_OPS:
+            self.unsynced.append((self.dht.log.last_lsn, conn, req_id, res))
+            return None
+        return res
+
+    def _run(self, opcode, keys, values, actions=None):
+        """Run an action of this node on each key."""
+        action = (actions or self.actions_list)[opcode]
+        if values is None:
+            return [action(key) for key in keys]
+        return [action(key, value) for key, value in zip(keys, values)]
+
+    def _route(self, opcode, forwarded, keys, values):
+        """Run an action on each key on the node owning it. The keys of a
+        forwarded request are served here, never forwarded again."""
+        groups = {}
+        for i, key in enumerate(keys):
+            owner = self.dht.id if forwarded else self.dht.server_hash(key)
+            groups.setdefault(owner, []).append(i)
+        results = [None] * len(keys)
+        for owner, idx in groups.iteritems():
+            group_keys = [keys[i] for i in idx]
+            group_values = None if values is None else [values[i] for i in idx]
+            if owner == self.dht.id:
+                group_results = self._run(opcode, group_keys, group_values)
+            else:
+                group_results = self.dht.remote(owner, opcode|FORWARDED, group_keys, group_values)
+            for i, res in zip(idx, group_results):
+                results[i] = res
+        return results
+
+    def _work(self):
+        """Serve the requests left by the event loop and give their
+        responses back to it."""
+        while True:
+            conn, req_id, opcode, forwarded, keys, values = self.requests.get()
+            try:
+                results = self._route(opcode, forwarded, keys, values)
+            except (error, EOFError, KeyError) as e:
+                self.logger.error(repr(e))
+                results = [None] * len(keys)
+            except Exception:
+                # an unexpected error must neither kill the worker nor leave
+                # the client waiting: it gets the error response
+                self.logger.exception("Request %d failed." % req_id)
+                results = [None] * len(keys)
+            try:
+                if opcode in WRITE_OPS:
+                    self.dht.sync()
+                res = encode_response(results)
+            except Exception:
+                self.logger.exception("Request %d failed." % req_id)
+                res = encode_response([None] * len(keys))
+            self.responses.put((conn, req_id, res))
+            self.wakeup()
+
+    def _send_responses(self):
+        """Queue the responses of the workers and of the writes now on disk
+        on their connection."""
+        ready = []
+        while True:
+            try:
+                ready.append(self.responses.get_nowait())
+            except Empty:
+                break
+        if self.dht.log is not None:
+            synced_lsn = self.dht.log.synced_lsn
+            while self.unsynced and self.unsynced[0][0] <= synced_lsn:
+                ready.append(self.unsynced.popleft()[1:])
+        fds = set()
+        for conn, req_id, res in ready:
+            # the connection may have been closed in the meantime
+            if self.connections.get(conn.fd) is conn:
+                conn.outbuf += HEADER.pack(len(res), req_id)
+                conn.outbuf += res
+                fds.add(conn.fd)
+        for fd in fds:
+            if fd in self.connections:
+                self._flush(fd)
+
+    def _accept(self):
+        while True:
+            try:
+                in_sock, in_addr = self.listening_socket.accept()
+            except error as e:
+                if e.errno in (EAGAIN, EWOULDBLOCK):
+                    return
+                raise
+            self.logger.debug("Connection from %s:%d." % in_addr)
+            in_sock.setblocking(0)
+            in_sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            self.connections[in_sock.fileno()] = Connection(in_sock)
+            self.poller.register(in_sock.fileno(), select.EPOLLIN)
+
+    def _close(self, fd):
+        conn = self.connections.pop(fd)
+        self.poller.unregister(fd)
+        conn.sock.close()
+
+    def _read(self, fd):
+        """Read what is available on a connection and answer every complete
+        request it holds. Return False if the connection is closed."""
+        conn = self.connections[fd]
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except error as e:
+            if e.errno in (EAGAIN, EWOULDBLOCK):
+                return True
+            data = ''
+        if not data:
+            self._close(fd)
+            return False
+        conn.inbuf += data
+        start = 0
+        end = len(conn.inbuf)
+        view = memoryview(conn.inbuf)
+        while end - start >= HEADER.size:
+            msglen, req_id = HEADER.unpack_from(view, start)
+            if end - start < HEADER.size + msglen:
+                break
+            msg_start = start + HEADER.size
+            start = msg_start + msglen
+            res = self._handle_request(conn, req_id, view, msg_start, start)
+            if res is None:
+                continue
+            # the response carries the id of its request
+            conn.outbuf += HEADER.pack(len(res), req_id)
+            conn.outbuf += res
+        # the buffer cannot be resized while it is viewed
+        del view
+        del conn.inbuf[:start]
+        return self._flush(fd)
+
+    def _flush(self, fd):
+        """Send as much of the pending responses as the socket accepts and
+        wait for it to be writable if some are left. Return False if the
+        connection is closed."""
+        conn = self.connections[fd]
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except error as e:
+                if e.errno not in (EAGAIN, EWOULDBLOCK):
+                    self._close(fd)
+                    return False
+                sent = 0
+            del conn.outbuf[:sent]
+        if conn.outbuf:
+            self.poller.modify(fd, select.EPOLLIN|select.EPOLLOUT)
+        else:
+            self.poller.modify(fd, select.EPOLLIN)
+        return True
 
-            while True:
-                try:
-                    readable, _, _ = select([sock], [], [], 0.1)
-                except error:
-                    sock.shutdown(2)
-                    sock.close()
-                    self.socket_list.remove(sock)
-                    break
-                if readable:
-                    cmd = exch.recv()
-                    if cmd is None:
-                        continue
-                    cmd_vec = cmd.split()
-                    action = cmd_vec[0]
-                    args = cmd_vec[1:]
-                    self.logger.debug("Request %s received." % (cmd))
-
-                    if action not in self.actions_list:
-                        exch.send(py2str[None])
-                    else:
-                        res = self.actions_list[action](*args)
-                        if res in py2str:
-                            exch.send(py2str[res])
-                        else:
-                            exch.send(res)
-                if self.dht.terminate.value == 1:
-                    break
-        except KeyboardInterrupt as e:
-            self.dht.terminate.value = 1
-    
     def run(self):
         self.logger.info('Starting DHT server.')
         self.listening_socket = socket(AF_INET, SOCK_STREAM)
         self.listening_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.listening_socket.bind(("0.0.0.0", self.dht.port))
+        self.listening_socket.bind((self.dht.bind_ip, self.dht.port))
         self.listening_socket.listen(self.dht.peers_count)
+        self.listening_socket.setblocking(0)
         self.logger.info("DHT server listening on port %d." % (self.dht.port))
 
-        read_list = [self.listening_socket]
+        # one loop serves all the peer connections
+        self.poller = select.epoll()
+        listening_fd = self.listening_socket.fileno()
+        self.poller.register(listening_fd, select.EPOLLIN)
+        self.poller.register(self.wakeup_r, select.EPOLLIN)
+        for _ in range(WORKERS):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
         try:
-            while True:
-                readable, _, _ = select(read_list, [], [], 0.1)
-                if self.dht.terminate.value == 1:
-                    break
-                elif readable:
-                    in_sock, in_addr = self.listening_socket.accept()
-                    handler = Process(target=self._message_handler, args=(in_sock, in_addr))
-                    handler.daemon = True
-                    handler.start()
-        except KeyboardInterrupt:
-            sys.stderr.write("\r")
-            self.logger.debug("Shutting down DHT server.")
-            self.dht.terminate.value = 1
+            while self.dht.terminate.value == 0:
+                try:
+                    events = self.poller.poll()
+                except IOError as e:
+                    # interrupted by a signal
+                    continue
+                for fd, event in events:
+                    if fd == listening_fd:
+                        self._accept()
+                    elif fd == self.wakeup_r:
+                        os.read(self.wakeup_r, RECV_SIZE)
+                        self._send_responses()
+                    elif fd in self.connections:
+                        if event & (select.EPOLLIN|select.EPOLLHUP|select.EPOLLERR):
+                            if not self._read(fd):
+                                continue
+                        if event & select.EPOLLOUT:
+                            self._flush(fd)
         finally:
+            self.logger.debug("Shutting down DHT server.")
+            for fd in self.connections.keys():
+                self._close(fd)
+            if self.dht.log is not None:
+                self.dht.log.close()
+            self.poller.close()
             self.listening_socket.close()
-
-
-    
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
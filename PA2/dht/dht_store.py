@@ -0,0 +1,115 @@
+from threading import Lock
+from dht_log import WriteLog, LOG_PUT, LOG_REM, SNAPSHOT_SIZE
+
+
+class ShardedStore:
+    """In-memory hashmap split in shards, each protected by its own lock.
+
+    The store lives in the process serving the DHT: operations on keys of
+    different shards do not wait for each other and none of them goes
+    through another process."""
+
+    def __init__(self, n_shards=16):
+        # power of two to pick the shard with a mask
+        self.n_shards = 1
+        while self.n_shards < n_shards:
+            self.n_shards *= 2
+        self.mask = self.n_shards - 1
+        self.shards = [{} for _ in range(self.n_shards)]
+        self.locks = [Lock() for _ in range(self.n_shards)]
+
+    def _shard(self, key):
+        return hash(key) & self.mask
+
+    def put(self, key, value):
+        """Fill the store with a key and value."""
+        i = self._shard(key)
+        with self.locks[i]:
+            self.shards[i][key] = value
+        return True
+
+    def get(self, key):
+        """Get value of a given key, None if it is missing."""
+        i = self._shard(key)
+        with self.locks[i]:
+            return self.shards[i].get(key)
+
+    def put_new(self, key, value):
+        """Fill the store with a key and value unless the key is already
+        there, return False in that case."""
+        i = self._shard(key)
+        with self.locks[i]:
+            if key in self.shards[i]:
+                return False
+            self.shards[i][key] = value
+            return True
+
+    def rem(self, key):
+        """Delete entry in the store, return False if it is missing."""
+        i = self._shard(key)
+        with self.locks[i]:
+            return self.shards[i].pop(key, None) is not None
+
+    def items(self):
+        """Iterate over a copy of the entries, one shard at a time."""
+        for i in range(self.n_shards):
+            with self.locks[i]:
+                shard_items = self.shards[i].items()
+            for item in shard_items:
+                yield item
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+
+class DurableStore(ShardedStore):
+    """Sharded store whose writes are also appended to a log on disk.
+
+    The store is rebuilt from the log at startup. A write returns before
+    its record is on disk: the sequence number of the last record is
+    log.last_lsn and log.wait(lsn) waits until a record is on disk."""
+
+    def __init__(self, path, n_shards=16, snapshot_size=SNAPSHOT_SIZE, on_sync=None):
+        ShardedStore.__init__(self, n_shards)
+        self.log = WriteLog(path, snapshot_size, on_sync)
+        self.log.replay(self._replay_put, self._replay_rem)
+        self.log.start(self.items)
+
+    def _replay_put(self, key, value):
+        self.shards[self._shard(key)][key] = value
+
+    def _replay_rem(self, key):
+        self.shards[self._shard(key)].pop(key, None)
+
+    def put(self, key, value):
+        """Fill the store with a key and value."""
+        i = self._shard(key)
+        with self.locks[i]:
+            self.shards[i][key] = value
+            # under the lock of the shard: the log keeps the order of the
+            # writes of a key
+            self.log.append(LOG_PUT, key, value)
+        return True
+
+    def put_new(self, key, value):
+        """Fill the store with a key and value unless the key is already
+        there, return False in that case."""
+        i = self._shard(key)
+        with self.locks[i]:
+            if key in self.shards[i]:
+                return False
+            self.shards[i][key] = value
+            self.log.append(LOG_PUT, key, value)
+            return True
+
+    def rem(self, key):
+        """Delete entry in the store, return False if it is missing."""
+        i = self._shard(key)
+        with self.locks[i]:
+            if self.shards[i].pop(key, None) is None:
+                return False
+            self.log.append(LOG_REM, key)
+            return True
+
+    def close(self):
+        self.log.close()
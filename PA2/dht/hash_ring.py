@@ -0,0 +1,70 @@
+import struct
+
+from bisect import bisect_right
+from hashlib import md5
+
+# number of points of each node on the ring
+VNODES = 100
+TOKEN = struct.Struct('>Q')
+
+
+def token(key):
+    """Position of a key on the ring: the first 64 bits of its md5."""
+    return TOKEN.unpack_from(md5(key).digest())[0]
+
+
+class HashRing:
+    """Consistent hashing ring with virtual nodes.
+
+    Each node is placed at vnodes points of the ring and a key belongs to
+    the node of the first point following the key, so adding or removing
+    a node only moves the keys of the ranges it gains or loses."""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        self.vnodes = vnodes
+        self.nodes = set(nodes)
+        self.tokens = []
+        self.owners = []
+        self._build()
+
+    def _build(self):
+        points = sorted((token("%s#%d" % (node, i)), node)
+                        for node in self.nodes for i in range(self.vnodes))
+        self.tokens = [t for t, node in points]
+        self.owners = [node for t, node in points]
+
+    def add(self, node):
+        """Add a node to the ring."""
+        self.nodes.add(node)
+        self._build()
+
+    def remove(self, node):
+        """Remove a node from the ring."""
+        self.nodes.discard(node)
+        self._build()
+
+    def lookup(self, key):
+        """Return the node owning a key."""
+        i = bisect_right(self.tokens, TOKEN.unpack_from(md5(key).digest())[0])
+        if i == len(self.tokens):
+            i = 0
+        return self.owners[i]
+
+    def successors(self, key, count):
+        """Return the first count distinct nodes following a key."""
+        count = min(count, len(self.nodes))
+        i = bisect_right(self.tokens, token(key))
+        found = []
+        while len(found) < count:
+            node = self.owners[i % len(self.owners)]
+            if node not in found:
+                found.append(node)
+            i += 1
+        return found
+
+
+def key_movement(keys, old_owner, new_owner):
+    """Return the fraction of keys whose owner changes between two hash
+    functions."""
+    moved = sum(1 for key in keys if old_owner(key) != new_owner(key))
+    return float(moved) / len(keys) if keys else 0.
@@ -0,0 +1,41 @@
+import json
+
+from urllib2 import urlopen
+from socket import *
+
+IPIFY_URL = 'https://api.ipify.org/?format=json'
+# the public ip service is only asked when no configured address is local
+IPIFY_TIMEOUT = 5
+
+
+def is_local_ip(ip):
+    """Return True if ip is an address of an interface of this machine."""
+    sock = socket(AF_INET, SOCK_DGRAM)
+    try:
+        # binding only succeeds on a local address, without any traffic
+        sock.bind((ip, 0))
+        return True
+    except (error, gaierror):
+        return False
+    finally:
+        sock.close()
+
+def public_ip(timeout=IPIFY_TIMEOUT):
+    """Return the public ip of this machine, as seen from the internet."""
+    return str(json.load(urlopen(IPIFY_URL, timeout=timeout))['ip'])
+
+def resolve_node_id(peers_map):
+    """Return the id of the peer of this machine in the config, found from
+    the local interfaces, or from the public ip when no address is local."""
+    local_ids = [id for id, config in peers_map.iteritems() if is_local_ip(config['ip'])]
+    if len(local_ids) > 1:
+        raise ValueError("peers %s are all on this machine: give the id of the node." %
+                         sorted(local_ids))
+    if local_ids:
+        return local_ids[0]
+    # behind a NAT, as on EC2, the public ip is not an interface address
+    this_ip = public_ip()
+    this_server = [id for id, config in peers_map.iteritems() if config['ip'] == this_ip]
+    if not this_server:
+        raise ValueError("peer %s is not included in the config file." % this_ip)
+    return this_server[0]
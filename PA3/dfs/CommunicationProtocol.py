@@ -1,27 +1,110 @@
 from socket import *
+from select import select
+from message_codec import CODECS, CompactCodec
 
 import struct
-import pickle
 import sys
 import os
 import logging
 import errno
 import time
 
-BUFFER_SIZE = 4096
+
+def _libc_sendfile():
+    """
+    Wrap the sendfile system call of the C library with the signature of os.sendfile, for python 2 on Linux.
+    :return: sendfile function, or None if the C library has no Linux sendfile.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        # sendfile64 takes a 64 bits offset on 32 bits systems as well
+        c_sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    c_sendfile.restype = ctypes.c_ssize_t
+
+    def libc_sendfile(out_fd, in_fd, offset, count):
+        sent = c_sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return libc_sendfile
+
+
+def _libc_posix_fallocate():
+    """
+    Wrap posix_fallocate of the C library with the signature of os.posix_fallocate, for python 2 on Linux.
+    :return: posix_fallocate function, or None if the C library has none.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        # posix_fallocate64 takes 64 bits offsets on 32 bits systems as well
+        c_fallocate = libc.posix_fallocate64
+    except (ImportError, OSError, AttributeError):
+        return None
+    c_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    c_fallocate.restype = ctypes.c_int
+
+    def libc_posix_fallocate(fd, offset, length):
+        # the error number is returned, errno is not set
+        err = c_fallocate(fd, offset, length)
+        if err != 0:
+            raise OSError(err, os.strerror(err))
+    return libc_posix_fallocate
+
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # pysendfile package for python 2
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = _libc_sendfile()
+
+try:
+    from os import posix_fallocate
+except ImportError:
+    posix_fallocate = _libc_posix_fallocate()
+
+# below this size the length and the content of a message are joined and sent in one system call, above it they
+# are sent from their own buffers without copying the content
+COPY_THRESHOLD = 512 * 1024
+SENDFILE_CHUNK_SIZE = 8 * 1024 ** 2
+RECV_BUFFER_SIZE = 1024 ** 2
+PROGRESS_INTERVAL = 0.5
+# gathering send of python 3, python 2 sends the buffers one after the other
+HAS_SENDMSG = hasattr(socket, 'sendmsg')
 
 logging.basicConfig(level=logging.DEBUG)
 
 
 class MessageExchanger:
-    def __init__(self, sock, log='INFO'):
+    # codec of the objects sent by all the exchangers of this process, see set_codec
+    codec = CompactCodec()
+
+    def __init__(self, sock, log='INFO', codec=None):
         """
         Initialize a MessageExchanger object.
         :param sock: socket through which communication is done.
         :param log: level of logging for this object.
+        :param codec: object encoding and decoding the python objects exchanged, the class codec if None.
         :return: None
         """
         self.sock = sock
+        if codec is not None:
+            self.codec = codec
+        self.recv_buffer = None
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.getLevelName(log))
 
@@ -31,20 +114,36 @@ class MessageExchanger:
         :param msg: message to send as a string.
         :return: None
         """
-        # send length of the message
-        msg = struct.pack('>L', len(msg)) + msg
-        l = len(msg)
-        bytes_sent = 0
-        while bytes_sent < l:
+        header = struct.pack('>L', len(msg))
+        if len(msg) <= COPY_THRESHOLD:
+            self._send_views([header + msg])
+        else:
+            self._send_views([header, memoryview(msg)])
+
+    def _send_views(self, views):
+        """
+        Send buffers in order, with a single gathering call per write when the socket supports sendmsg, and wait for
+        the socket to be writable when its buffer is full.
+        :param views: list of strings or memoryviews to send.
+        :return: None
+        """
+        while views:
             try:
-                lb = bytes_sent
-                ub = max(lb+BUFFER_SIZE, l)
-                bs = self.sock.send(msg[lb:ub])
-                bytes_sent += bs
+                if HAS_SENDMSG:
+                    sent = self.sock.sendmsg(views)
+                else:
+                    sent = self.sock.send(views[0])
             except error as e:
-                if e.errno == errno.EAGAIN:
-                    time.sleep(0.05)
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    select([], [self.sock], [])
                     continue
+                raise
+            # drop the buffers sent and slice the first one not sent entirely, without copying it
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views and sent:
+                views[0] = memoryview(views[0])[sent:]
 
     def recv(self):
         """
@@ -61,44 +160,77 @@ class MessageExchanger:
 
     def recvall(self, n):
         """
-        Helper function to receive n bytes or return None if EOF is hit.
+        Helper function to receive n bytes or return None if EOF is hit. When the message does not come in one piece,
+        the rest is received in place in a buffer of the size of the message, waiting for the socket to be readable
+        when no data is available.
         :param n: number of bytes to receive.
         :return: data received as a string.
         """
-        data = ''
-        while len(data) < n:
-            packet = self.sock.recv(n - len(data))
-            if not packet:
+        data = None
+        view = None
+        received = 0
+        while received < n:
+            try:
+                if data is None:
+                    packet = self.sock.recv(n)
+                    if len(packet) == n:
+                        return packet
+                    elif not packet:
+                        return None
+                    data = bytearray(n)
+                    view = memoryview(data)
+                    view[:len(packet)] = packet
+                    nbytes = len(packet)
+                else:
+                    nbytes = self.sock.recv_into(view[received:], n - received)
+            except error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    select([self.sock], [], [])
+                    continue
+                raise
+            if not nbytes:
                 return None
-            data += packet
-        return data
+            received += nbytes
+        return str(data) if data is not None else ''
 
-    def pkl_send(self, obj):
+    @classmethod
+    def set_codec(cls, name):
         """
-        Pickle an object and send it through the socket with the end marker.
+        Select the codec used by default by the exchangers of this process.
+        :param name: name of the codec, 'compact' or 'pickle'.
+        :return: None
+        """
+        if name not in CODECS:
+            raise ValueError("codec should be one of %s" % CODECS.keys())
+        cls.codec = CODECS[name]()
+
+    def obj_send(self, obj):
+        """
+        Encode an object with the codec of this exchanger and send it.
         :param obj: python object to send.
         :return: None
         """
-        self.logger.debug("send pkl: %s", repr(obj))
-        str_obj = pickle.dumps(obj)
-        return self.send(str_obj)
+        self.logger.debug("send obj: %r", obj)
+        return self.send(self.codec.encode(obj))
 
-    def pkl_recv(self):
+    def obj_recv(self):
         """
-        Read from the socket and unpickle the content.
-        :return: python object received.
+        Read a message from the socket and decode it with the codec of this exchanger.
+        :return: python object received, None if the connection is closed.
         """
-        str_obj = self.recv()
-        if str_obj is None:
+        data = self.recv()
+        if data is None:
             return None
-        obj = pickle.loads(str_obj)
-        self.logger.debug("recv pkl: %s", repr(obj))
+        obj = self.codec.decode(data)
+        self.logger.debug("recv obj: %r", obj)
         return obj
 
-    def file_send(self, f_path):
+    def file_send(self, f_path, chunk_size=SENDFILE_CHUNK_SIZE, zero_copy=True):
         """
-        Send a file by first sending its size in bytes and t hen sending the file.
+        Send a file by first sending its size in bytes and then sending the file.
         :param f_path: local path to the file to send.
+        :param chunk_size: maximum number of bytes handed to the kernel in one call.
+        :param zero_copy: if True, send the file with sendfile when it is available.
         :return: False if the file does not exist, else True.
         """
         try:
@@ -108,20 +240,54 @@ class MessageExchanger:
             return False
 
         self.logger.debug("send file: %s %d", f_path, fs)
-        self.sock.send(header)
+        self.sock.sendall(header)
         with open(f_path, "rb") as f_to_send:
-            data = True
-            while data:
-                data = f_to_send.read(BUFFER_SIZE)
-                self.sock.send(data)
+            sent = 0
+            if zero_copy and sendfile is not None:
+                sent = self._sendfile(f_to_send, fs, chunk_size)
+            f_to_send.seek(sent)
+            # fallback when sendfile is unavailable or not supported for this file
+            while sent < fs:
+                data = f_to_send.read(min(chunk_size, fs - sent))
+                if not data:
+                    break
+                self.sock.sendall(data)
+                sent += len(data)
         return True
 
+    def _sendfile(self, f_to_send, size, chunk_size):
+        """
+        Copy a file to the socket in kernel space.
+        :param f_to_send: file object opened for reading.
+        :param size: number of bytes to send.
+        :param chunk_size: maximum number of bytes sent by one sendfile call.
+        :return: number of bytes sent, 0 if sendfile is not supported for this file.
+        """
+        in_fd = f_to_send.fileno()
+        out_fd = self.sock.fileno()
+        offset = 0
+        while offset < size:
+            try:
+                sent = sendfile(out_fd, in_fd, offset, min(chunk_size, size - offset))
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    select([], [self.sock], [])
+                    continue
+                elif offset == 0 and e.errno in (errno.EINVAL, errno.ENOSYS):
+                    return 0
+                raise
+            if sent == 0:  # file truncated while sending
+                break
+            offset += sent
+        return offset
+
     def file_recv(self, f_path, show_progress=True):
         """
-        Receive a file and store it on disk.
+        Receive a file and store it on disk. The file is preallocated and the data is received in a reusable buffer
+        until exactly the announced size has been read, so the next message on the socket is left untouched.
         :param f_path: local path to store the file.
         :param show_progress: if True, messages will be printed to show the progress of the file transfer.
-        :return: None
+        :return: None if the connection is closed before the end of the file, else True.
         """
         bytes_received = 0
 
@@ -131,16 +297,50 @@ class MessageExchanger:
         filesize = struct.unpack('>I', raw_filesize)[0]
 
         self.logger.debug("recv file: %s %d", f_path, filesize)
-        out_f = os.open(f_path, os.O_WRONLY | os.O_CREAT)
-        while bytes_received < filesize:
-            shard = self.sock.recv(BUFFER_SIZE)
-            bytes_written = os.write(out_f, shard)
-            bytes_received += bytes_written
-            self.logger.debug("Received %d bytes", bytes_received)
-            # print percentage downloaded
-            if show_progress:
-                perc = int(100. * bytes_received / filesize)
-                self.logger.debug("Downloading file... %3d%% [%d/%d]" % (perc, bytes_received, filesize))
-        if show_progress:
-            print
-        os.close(out_f)
+        if self.recv_buffer is None:
+            self.recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(self.recv_buffer)
+        last_progress = time.time()
+        out_f = os.open(f_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            self._preallocate(out_f, filesize)
+            while bytes_received < filesize:
+                # fill the buffer before writing it to disk
+                to_read = min(RECV_BUFFER_SIZE, filesize - bytes_received)
+                filled = 0
+                while filled < to_read:
+                    nbytes = self.sock.recv_into(view[filled:to_read], to_read - filled)
+                    if not nbytes:
+                        return None
+                    filled += nbytes
+                written = 0
+                while written < filled:
+                    written += os.write(out_f, view[written:filled])
+                bytes_received += filled
+                # print percentage downloaded at a bounded rate
+                if show_progress and time.time() - last_progress > PROGRESS_INTERVAL:
+                    last_progress = time.time()
+                    perc = int(100. * bytes_received / filesize)
+                    self.logger.info("Downloading file... %3d%% [%d/%d]", perc, bytes_received, filesize)
+        finally:
+            os.close(out_f)
+        return True
+
+    def _preallocate(self, fd, size):
+        """
+        Reserve the disk space of a file before writing it.
+        :param fd: file descriptor of the file.
+        :param size: final size of the file in bytes.
+        :return: None
+        """
+        if size == 0:
+            return
+        if posix_fallocate is not None:
+            try:
+                posix_fallocate(fd, 0, size)
+                return
+            except OSError as e:
+                # e.g. EOPNOTSUPP or ENOSPC: the file is written without reserved space
+                self.logger.debug("posix_fallocate failed: %s", e)
+        # last resort: a sparse file of the final size
+        os.ftruncate(fd, size)
@@ -0,0 +1,77 @@
+"""
+Usage:
+    python bench_codec.py [repeat=10000]
+
+Encode and decode the messages of the hot actions with the pickle module as the nodes used to, with cPickle, and
+with the compact codec, and print the time per message and the size of each encoding.
+
+The compact codec is written in python and cPickle in C: it is faster on the DHT requests and the long lists of
+strings and as fast on the lists of peers, but 0.1 to 0.4 us slower than cPickle on the search, register and
+obtain requests, whose dicts cost more to build in python. Its point is elsewhere: the messages of the hot actions are never unpickled, and the other ones only when
+they are made of plain data.
+"""
+import pickle
+import sys
+import time
+
+from message_codec import PickleCodec, CompactCodec
+
+# names and peer ids as in the first experiment: 10k files per node named after the node address
+PEER_ID = "54.210.10.11:4000"
+NAME = "f0042_54.210.10.11"
+MESSAGES = [
+    ('search', dict(type='search', id=PEER_ID, name=NAME)),
+    ('register', dict(type='register', name=NAME, id=PEER_ID)),
+    ('obtain', dict(type='obtain', name=NAME)),
+    ('get', dict(action='get', args=[NAME])),
+    ('put', dict(action='put', args=[NAME, [PEER_ID, "54.210.10.12:4000"]])),
+    ('peers', [PEER_ID, "54.210.10.12:4000", "54.210.10.13:4000"]),
+    ('ack', True),
+    ('keys 10k', ["f%04d_54.210.10.%d" % (i % 10000, i // 10000) for i in range(10000)])
+]
+
+
+class Protocol0Codec:
+    """
+    Encoding of the former pkl_send: pure python pickle with the default protocol.
+    """
+    def encode(self, obj):
+        return pickle.dumps(obj)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+CODECS = [('pickle', Protocol0Codec()), ('cPickle', PickleCodec()), ('compact', CompactCodec())]
+
+
+def time_codec(codec, msg, repeat):
+    """
+    Encode and decode a message repeatedly.
+    :param codec: codec to measure.
+    :param msg: message to encode.
+    :param repeat: number of round trips.
+    :return: time of an encoding and a decoding in microseconds, and size of the encoded message.
+    """
+    data = codec.encode(msg)
+    if codec.decode(data) != msg:
+        raise ValueError("%s does not decode %r" % (codec.__class__.__name__, msg))
+    t0 = time.time()
+    for _ in xrange(repeat):
+        codec.decode(codec.encode(msg))
+    return (time.time() - t0) / repeat * 1e6, len(data)
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    header = "{:<10}".format("message")
+    for name, _ in CODECS:
+        header += "{:>14}{:>8}".format(name + " us", "bytes")
+    print(header)
+    for label, msg in MESSAGES:
+        # the large lists are only sent by list and the benchmarks
+        n = repeat if len(repr(msg)) < 1000 else max(1, repeat // 1000)
+        line = "{:<10}".format(label)
+        for _, codec in CODECS:
+            line += "{:>14.2f}{:>8}".format(*time_codec(codec, msg, n))
+        print(line)
@@ -0,0 +1,91 @@
+"""
+Usage:
+    python bench_file_transfer.py [max_size=1G] [data_dir=/tmp/dfs_bench]
+
+Transfer files of the sizes used by ec2/gen_files.py through a localhost socket with MessageExchanger, with and
+without sendfile, and print the throughput of each transfer.
+"""
+import os
+import sys
+import time
+
+from socket import *
+from threading import Thread
+from CommunicationProtocol import MessageExchanger, sendfile
+
+SIZES = [('1K', 1024), ('10K', 10 * 1024), ('100K', 100 * 1024), ('1M', 1024 ** 2), ('10M', 10 * 1024 ** 2),
+         ('100M', 100 * 1024 ** 2), ('1G', 1024 ** 3)]
+BLOCK = "0" * 1024 ** 2
+
+
+def create_file(f_path, size):
+    """
+    Create a file filled with zeros, the same way as ec2/gen_files.py, unless it already exists.
+    :param f_path: path of the file to create.
+    :param size: size of the file in bytes.
+    :return: None
+    """
+    if os.path.isfile(f_path) and os.path.getsize(f_path) == size:
+        return
+    with open(f_path, 'wb') as fd:
+        written = 0
+        while written < size:
+            block = BLOCK[:size - written]
+            fd.write(block)
+            written += len(block)
+
+
+def time_transfer(f_path, out_path, zero_copy):
+    """
+    Send a file to a local receiver and measure the time until it is stored on disk.
+    :param f_path: file to send.
+    :param out_path: path where the receiver stores the file.
+    :param zero_copy: use sendfile on the sending side.
+    :return: duration of the transfer in seconds.
+    """
+    listening_socket = socket(AF_INET, SOCK_STREAM)
+    listening_socket.bind(("127.0.0.1", 0))
+    listening_socket.listen(1)
+    send_sock = socket(AF_INET, SOCK_STREAM)
+    send_sock.connect(listening_socket.getsockname())
+    recv_sock, _ = listening_socket.accept()
+
+    receiver = Thread(target=MessageExchanger(recv_sock).file_recv, args=(out_path,), kwargs={'show_progress': False})
+    t0 = time.time()
+    receiver.start()
+    MessageExchanger(send_sock).file_send(f_path, zero_copy=zero_copy)
+    receiver.join()
+    delta = time.time() - t0
+
+    for sock in [send_sock, recv_sock, listening_socket]:
+        sock.close()
+    os.remove(out_path)
+    return delta
+
+
+if __name__ == '__main__':
+    max_size = sys.argv[1] if len(sys.argv) > 1 else '1G'
+    data_dir = sys.argv[2] if len(sys.argv) > 2 else '/tmp/dfs_bench'
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    labels = [label for label, _ in SIZES]
+    if max_size not in labels:
+        sys.stderr.write("max_size should be one of %s\n" % labels)
+        sys.exit(1)
+    # without sendfile the zero-copy transfer would silently measure read+send again
+    modes = [False, True] if sendfile is not None else [False]
+    if sendfile is None:
+        sys.stderr.write("sendfile is not available on this system: the zero-copy path is not measured.\n")
+
+    print("{:<8}{:>16}{:>16}".format("size", "read+send MB/s", "sendfile MB/s"))
+    for label, size in SIZES[:labels.index(max_size) + 1]:
+        f_path = os.path.join(data_dir, "f_%s" % label)
+        out_path = os.path.join(data_dir, "recv_%s" % label)
+        create_file(f_path, size)
+        line = "{:<8}".format(label)
+        for zero_copy in modes:
+            delta = time_transfer(f_path, out_path, zero_copy)
+            line += "{:>16.1f}".format(size / 1024. ** 2 / delta)
+        if sendfile is None:
+            line += "{:>16}".format("n/a")
+        print(line)
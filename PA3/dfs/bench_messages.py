@@ -0,0 +1,116 @@
+"""
+Usage:
+    python bench_messages.py [max_size=100M]
+
+Send messages of 1K to 100M through a localhost socket with MessageExchanger, with the former send and recvall and
+with the current ones, and print the throughput of each size. The sending socket is non-blocking, as the sockets of
+the distributed indexing server.
+"""
+import errno
+import struct
+import sys
+import time
+
+from select import select
+from socket import *
+from threading import Thread
+from CommunicationProtocol import MessageExchanger
+
+SIZES = [('1K', 1024), ('10K', 10 * 1024), ('100K', 100 * 1024), ('1M', 1024 ** 2), ('10M', 10 * 1024 ** 2),
+         ('100M', 100 * 1024 ** 2)]
+# bytes sent for each size, so that the small messages are timed over many round trips
+VOLUME = 100 * 1024 ** 2
+
+
+class LegacyExchanger(MessageExchanger):
+    """
+    MessageExchanger with the former send and recvall.
+    """
+    def send(self, msg):
+        msg = struct.pack('>L', len(msg)) + msg
+        l = len(msg)
+        bytes_sent = 0
+        while bytes_sent < l:
+            try:
+                lb = bytes_sent
+                ub = max(lb+4096, l)
+                bs = self.sock.send(msg[lb:ub])
+                bytes_sent += bs
+            except error as e:
+                if e.errno == errno.EAGAIN:
+                    time.sleep(0.05)
+                    continue
+
+    def recvall(self, n):
+        data = ''
+        while len(data) < n:
+            packet = self.sock.recv(n - len(data))
+            if not packet:
+                return None
+            data += packet
+        return data
+
+
+def receive(exch, count):
+    """
+    Receive messages and acknowledge each of them with a 1 byte message.
+    :param exch: exchanger of the receiving socket.
+    :param count: number of messages to receive.
+    :return: None
+    """
+    for _ in xrange(count):
+        exch.recv()
+        exch.send('1')
+
+
+def time_messages(exchanger_class, size, count):
+    """
+    Send messages to a local receiver, waiting for the acknowledgement of each message.
+    :param exchanger_class: MessageExchanger class used on both sides.
+    :param size: size of the messages in bytes.
+    :param count: number of messages.
+    :return: duration of the transfers in seconds.
+    """
+    listening_socket = socket(AF_INET, SOCK_STREAM)
+    listening_socket.bind(("127.0.0.1", 0))
+    listening_socket.listen(1)
+    send_sock = socket(AF_INET, SOCK_STREAM)
+    send_sock.connect(listening_socket.getsockname())
+    recv_sock, _ = listening_socket.accept()
+    for sock in [send_sock, recv_sock]:
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    send_sock.setblocking(0)
+
+    msg = "0" * size
+    receiver = Thread(target=receive, args=(exchanger_class(recv_sock), count))
+    receiver.start()
+    exch = exchanger_class(send_sock)
+    t0 = time.time()
+    for _ in xrange(count):
+        exch.send(msg)
+        # the former recvall does not wait on a non-blocking socket
+        select([send_sock], [], [])
+        exch.recv()
+    delta = time.time() - t0
+    receiver.join()
+
+    for sock in [send_sock, recv_sock, listening_socket]:
+        sock.close()
+    return delta
+
+
+if __name__ == '__main__':
+    max_size = sys.argv[1] if len(sys.argv) > 1 else '100M'
+    labels = [label for label, _ in SIZES]
+    if max_size not in labels:
+        sys.stderr.write("max_size should be one of %s\n" % labels)
+        sys.exit(1)
+
+    print("{:<8}{:>10}{:>14}{:>14}".format("size", "messages", "former MB/s", "current MB/s"))
+    for label, size in SIZES[:labels.index(max_size) + 1]:
+        count = max(1, min(VOLUME // size, 10000))
+        rates = []
+        for exchanger_class in [LegacyExchanger, MessageExchanger]:
+            delta = time_messages(exchanger_class, size, count)
+            rates.append(size * count / 1024. ** 2 / delta)
+        print("{:<8}{:>10}{:>14.1f}{:>14.1f}".format(label, count, rates[0], rates[1]))
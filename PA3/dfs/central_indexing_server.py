@@ -22,6 +22,8 @@ class IndexingServer:
         self.timeout_value = config['timeout_value']
         self.idx_server_port = config['idx_server_port']
         self.max_connections = config['max_connections']
+        # encoding of the messages exchanged with the peers
+        MessageExchanger.set_codec(config.get('codec', 'compact'))
 
         self.logger = logging.getLogger(self.__class__.__name__)
         level = logging.getLevelName(config['log_level'])
@@ -36,6 +38,7 @@ class IndexingServer:
 
         self.actions = {
             'register': self._register,
+            'register_many': self._register_many,
             'list': self._list,
             'search': self._search,
             'close': self._close_connection,
@@ -89,6 +92,38 @@ class IndexingServer:
         """
         self.local_register(id, name)
         # send back the peers where he need to replicate this file
+        other_peers = self._replicate_to(id)
+        exch.obj_send(other_peers)
+        for k in other_peers:
+            self.local_register(k, name)
+
+        return True
+
+    def _register_many(self, exch, id, names):
+        """
+        Register several files in the indexing server and answer with one message giving the peers where each file
+        needs to be copied.
+        :param exch: MessageExchanger object connected to the peer.
+        :param id: identifier of the peer.
+        :param names: names of the files to register.
+        :return: True
+        """
+        replicate_to = {}
+        for name in names:
+            self.local_register(id, name)
+            replicate_to[name] = self._replicate_to(id)
+        exch.obj_send(replicate_to)
+        for name, other_peers in replicate_to.iteritems():
+            for k in other_peers:
+                self.local_register(k, name)
+        return True
+
+    def _replicate_to(self, id):
+        """
+        Choose the peers where a file registered by a peer needs to be copied.
+        :param id: identifier of the peer registering the file.
+        :return: list of peers address and port.
+        """
         self.logger.debug(self.peer_status)
         other_peers = self.peer_status.keys()
         other_peers.remove(id)
@@ -97,13 +132,9 @@ class IndexingServer:
         if not other_peers:
             other_peers = []
         elif len(other_peers) > self.replica:
-            other_peers = list(np.random.choice(other_peers, self.replica, replace=False))
-
-        exch.pkl_send(other_peers)
-        for k in other_peers:
-            self.local_register(k, name)
-
-        return True
+            # plain strings: the numpy ones would not be unpickled by the compact codec of the peer
+            other_peers = [str(k) for k in np.random.choice(other_peers, self.replica, replace=False)]
+        return other_peers
 
     def _list(self, exch):
         """
@@ -111,7 +142,7 @@ class IndexingServer:
         :param exch: MessageExchanger object connected to the peer.
         :return: True
         """
-        exch.pkl_send(self.file2peers.keys())
+        exch.obj_send(self.file2peers.keys())
         return True
 
     def _search(self, exch, id, name):
@@ -127,7 +158,7 @@ class IndexingServer:
         if name in self.file2peers:
             # return ids of the peers that have this file
             to_return = [pid for pid in self.file2peers[name] if pid != id]
-        exch.pkl_send(to_return)
+        exch.obj_send(to_return)
         return True
 
     def _generic_action(self, action):
@@ -160,7 +191,7 @@ class IndexingServer:
                 break
             elif readable:
                 exch = MessageExchanger(client_sock)
-                action = exch.pkl_recv()
+                action = exch.obj_recv()
                 self.logger.debug(repr(action))
                 action['exch'] = exch
                 open_conn = self._generic_action(action)
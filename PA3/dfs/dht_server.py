@@ -1,6 +1,7 @@
 import logging
 import sys
 
+from types import GeneratorType
 from select import select
 from CommunicationProtocol import *
 from multiprocessing import Process
@@ -27,8 +28,18 @@ class DHTServer(Process):
         self.actions_list = {
             "put": self._put,
             "get": self._get,
+            "append_peer": self._append_peer,
+            "remove_peer": self._remove_peer,
+            "append_peers": self._append_peers,
+            "remove_peers": self._remove_peers,
             "rem": self._del,
-            "keys": self._keys
+            "keys": self._keys,
+            "keys_stream": self._keys_stream,
+            "get_local": self._get_local,
+            "migrate": self._migrate,
+            "join": self._join,
+            "leave": self._leave,
+            "handoff_done": self._handoff_done
         }
         self.socket_list = []
 
@@ -40,6 +51,16 @@ class DHTServer(Process):
         self.logger.debug("keys")
         return self.parent.keys()
 
+    def _keys_stream(self, chunk_size):
+        """
+        Call its parent function to get the keys of local hashtable by chunks, and send them as they come.
+        :param chunk_size: number of keys per message.
+        :return: generator of lists of keys.
+        """
+        self.logger.debug("keys_stream")
+        for chunk in self.parent.key_chunks(chunk_size):
+            yield chunk
+
     def _put(self, key, value):
         """
         Call its parent function to put a key-value pair in the local hashtable.
@@ -60,6 +81,44 @@ class DHTServer(Process):
         self.logger.debug("get")
         return self.parent.get(key)
 
+    def _append_peer(self, key, peer_id):
+        """
+        Call its parent function to add a peer to the list of peers of a key in the local hashtable.
+        :param key: key of the entry.
+        :param peer_id: identifier of the peer to add.
+        :return: True
+        """
+        self.logger.debug("append_peer")
+        return self.parent.append_peer(key, peer_id)
+
+    def _remove_peer(self, key, peer_id):
+        """
+        Call its parent function to remove a peer from the list of peers of a key in the local hashtable.
+        :param key: key of the entry.
+        :param peer_id: identifier of the peer to remove.
+        :return: True
+        """
+        self.logger.debug("remove_peer")
+        return self.parent.remove_peer(key, peer_id)
+
+    def _append_peers(self, items):
+        """
+        Call its parent function to add peers to the lists of peers of several keys in the local hashtable.
+        :param items: list of (key, peers) pairs.
+        :return: True
+        """
+        self.logger.debug("append_peers")
+        return self.parent.append_peers(items)
+
+    def _remove_peers(self, items):
+        """
+        Call its parent function to remove peers from the lists of peers of several keys in the local hashtable.
+        :param items: list of (key, peers) pairs.
+        :return: True
+        """
+        self.logger.debug("remove_peers")
+        return self.parent.remove_peers(items)
+
     def _del(self, key):
         """
         Call its parent function to remove an entry from the local hashtable.
@@ -70,6 +129,51 @@ class DHTServer(Process):
         self.parent.rem(key)
         return True
 
+    def _get_local(self, key):
+        """
+        Call its parent function to get the value associated with a given key in the local hashtable only.
+        :param key: key to search in the local hashtable.
+        :return: value associated with the key.
+        """
+        self.logger.debug("get_local")
+        return self.parent.get_local(key)
+
+    def _migrate(self, items):
+        """
+        Call its parent function to store the entries handed over by another node.
+        :param items: list of (key, value) pairs.
+        :return: True
+        """
+        self.logger.debug("migrate")
+        return self.parent.migrate(items)
+
+    def _join(self, ip):
+        """
+        Call its parent function to add a node to the ring and hand over its entries.
+        :param ip: address of the joining node.
+        :return: True
+        """
+        self.logger.info("Node %s joins the ring.", ip)
+        return self.parent.add_node(ip)
+
+    def _leave(self, sid):
+        """
+        Call its parent function to remove a node from the ring.
+        :param sid: id of the leaving node.
+        :return: True
+        """
+        self.logger.info("Node %d leaves the ring.", sid)
+        return self.parent.remove_node(sid)
+
+    def _handoff_done(self, sid):
+        """
+        Call its parent function once a leaving node handed over its entries.
+        :param sid: id of the leaving node.
+        :return: True
+        """
+        self.logger.info("Node %d handed over its entries.", sid)
+        return self.parent.handoff_done(sid)
+
     def _message_handler(self, sock, addr):
         """
         Handle the message received by this server by parsing the messages and calling the corresponding action.
@@ -91,7 +195,7 @@ class DHTServer(Process):
                     self.socket_list.remove(sock)
                     break
                 if readable:
-                    dht_action = exch.pkl_recv()
+                    dht_action = exch.obj_recv()
                     if dht_action is None:
                         break
                     action = dht_action['action']
@@ -99,10 +203,23 @@ class DHTServer(Process):
                     self.logger.debug("Request %s received." % (action))
 
                     if action not in self.actions_list:
-                        exch.pkl_send(None)
+                        exch.obj_send(None)
                     else:
                         res = self.actions_list[action](*args)
-                        exch.pkl_send(res)
+                        if isinstance(res, GeneratorType):
+                            # streamed answer: one message per chunk, then None
+                            try:
+                                for chunk in res:
+                                    exch.obj_send(chunk)
+                                exch.obj_send(None)
+                            except error as e:
+                                # the client stopped reading the stream and closed its connection
+                                self.logger.debug("Stream to %s interrupted: %s" % (addr, e))
+                                break
+                            finally:
+                                res.close()
+                        else:
+                            exch.obj_send(res)
                 if self.parent.terminate.value == 1:
                     break
         except KeyboardInterrupt as e:
@@ -114,7 +231,7 @@ class DHTServer(Process):
         self.listening_socket = socket(AF_INET, SOCK_STREAM)
         self.listening_socket.setblocking(0)
         self.listening_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.listening_socket.bind(("0.0.0.0", self.parent.port))
+        self.listening_socket.bind((self.parent.bind_ip, self.parent.port))
         self.listening_socket.listen(self.parent.nodes_count)
 
         read_list = [self.listening_socket]
@@ -1,20 +1,24 @@
 import json
 import logging
 
-from urllib2 import urlopen
-from hashlib import md5
+from socket import *
+from CommunicationProtocol import MessageExchanger
 from dht_server import DHTServer
-from multiprocessing import Manager, Value, Lock, Process
+from durable_dict import IndexManager
+from hash_ring import HashRing, VNODES
+from node_identity import resolve_ip, bind_address
+from multiprocessing import Value, Lock, Process
 
 logging.basicConfig(level=logging.DEBUG)
 
 
 class DHT():
-    def __init__(self, config, terminate):
+    def __init__(self, config, terminate, ip=None):
         """
         Initialize a DHT object.
         :param config: configuration parameters given as a python dictionary.
         :param terminate: shared value to watch to know if the processes associated with this DHT are still running.
+        :param ip: address of this node if already known, else it is found from the config and the local interfaces.
         :return: None
         """
         self.config = config
@@ -24,24 +28,44 @@ class DHT():
 
         self.nodes_list = config['nodes']
         self.nodes_count = len(self.nodes_list)
+        # keys are spread over the nodes with consistent hashing
+        self.vnodes = config.get('vnodes', VNODES)
+        self.ring = HashRing(range(self.nodes_count), self.vnodes)
+        # ring before the last membership change while keys are handed over
+        self.prev_ring = None
         self.timeout_value = config['timeout_value']
 
         # get this server info from config file
         self.nodes_list = config['nodes']
         self.replica = config['replica']
         # get this server info from config file
-        self.this_ip = str(json.load(urlopen('https://api.ipify.org/?format=json'))['ip'])
+        self.this_ip = ip if ip is not None else resolve_ip(config)
         if self.this_ip not in self.nodes_list:
             raise ValueError("peer %s is not included in the config file." % self.this_ip)
         self.id = self.nodes_list.index(self.this_ip)
 
         self.ip = self.this_ip
+        self.bind_ip = bind_address(self.ip)
         self.port = config['idx_server_port']
 
-        self.manager = Manager()
-        self.hashmap = self.manager.dict()
+        # the hashtable is kept on disk if the config gives a data directory
+        self.durable = bool(config.get('data_dir'))
+        self.manager = IndexManager()
+        self.manager.start()
+        if self.durable:
+            self.hashmap = self.manager.DurableDict(config['data_dir'])
+        else:
+            self.hashmap = self.manager.IndexDict()
         self.map_lock = self.manager.Lock()
 
+        # membership shared by the server processes and the user interface: addresses of the nodes (a node
+        # keeps its id when it leaves), ids of the nodes of the ring and of the ring before the change
+        self.members = self.manager.dict(nodes=list(self.nodes_list), active=range(self.nodes_count),
+                                         previous=None)
+        # incremented at each membership change so that the rings are only rebuilt when it changes
+        self.members_version = Value('i', 0)
+        self.local_version = 0
+
         self.terminate = terminate
 
         self.server = DHTServer(self)
@@ -56,19 +80,122 @@ class DHT():
         self.map_lock.acquire()
         self.hashmap[key] = value
         self.map_lock.release()
+        self.sync()
         return True
 
     def get(self, key):
         """
-        Get value of a given key.
+        Get value of a given key. While keys are handed over, a key missing here is read from its former owner.
         :param key: key to search.
         :return: value associated with the key.
         """
         self.map_lock.acquire()
         val = self.hashmap.get(key)
         self.map_lock.release()
+        if val is None:
+            self.refresh_members()
+            if self.prev_ring is not None:
+                prev_id = self.prev_ring.lookup(key)
+                if prev_id != self.id:
+                    val = self.remote(prev_id, "get_local", [key])
         return val
 
+    def get_many(self, keys):
+        """
+        Get the values of several keys in one call to the manager of the hashtable. While keys are handed over, the
+        keys missing here are read from their former owner.
+        :param keys: list of keys to search.
+        :return: list of the values associated with the keys.
+        """
+        self.map_lock.acquire()
+        values = self.hashmap.get_many(keys)
+        self.map_lock.release()
+        self.refresh_members()
+        if self.prev_ring is not None:
+            values = [self.get(key) if val is None else val for key, val in zip(keys, values)]
+        return values
+
+    def append_peers(self, items):
+        """
+        Add peers to the lists of peers of several keys in the local hashtable, as one atomic update: concurrent
+        registrations of a key do not lose each other's peers. While keys are handed over, the list of a key missing
+        here is first read from its former owner.
+        :param items: list of (key, peers) pairs.
+        :return: True
+        """
+        previous = None
+        self.refresh_members()
+        if self.prev_ring is not None:
+            keys = [key for key, _ in items]
+            previous = dict(zip(keys, self.get_many(keys)))
+        self.map_lock.acquire()
+        self.hashmap.append_many(items, previous)
+        self.map_lock.release()
+        self.sync()
+        return True
+
+    def remove_peers(self, items):
+        """
+        Remove peers from the lists of peers of several keys in the local hashtable, as one atomic update. A key
+        whose list becomes empty is deleted. While keys are handed over, the list of a key missing here is first read
+        from its former owner, so that the handover does not bring the removed peers back.
+        :param items: list of (key, peers) pairs.
+        :return: True
+        """
+        previous = None
+        self.refresh_members()
+        if self.prev_ring is not None:
+            keys = [key for key, _ in items]
+            previous = dict(zip(keys, self.get_many(keys)))
+        self.map_lock.acquire()
+        self.hashmap.remove_many(items, previous)
+        self.map_lock.release()
+        self.sync()
+        return True
+
+    def append_peer(self, key, peer_id):
+        """
+        Add a peer to the list of peers of a key in the local hashtable, as one atomic update.
+        :param key: key of the entry.
+        :param peer_id: identifier of the peer to add.
+        :return: True
+        """
+        return self.append_peers([(key, [peer_id])])
+
+    def remove_peer(self, key, peer_id):
+        """
+        Remove a peer from the list of peers of a key in the local hashtable, as one atomic update.
+        :param key: key of the entry.
+        :param peer_id: identifier of the peer to remove.
+        :return: True
+        """
+        return self.remove_peers([(key, [peer_id])])
+
+    def get_local(self, key):
+        """
+        Get value of a given key from the local hashtable only.
+        :param key: key to search.
+        :return: value associated with the key.
+        """
+        self.map_lock.acquire()
+        val = self.hashmap.get(key)
+        self.map_lock.release()
+        return val
+
+    def migrate(self, items):
+        """
+        Store entries handed over by their former owner, except the keys written here since the ring changed.
+        :param items: list of (key, value) pairs.
+        :return: True
+        """
+        self.map_lock.acquire()
+        for key, value in items:
+            if key not in self.hashmap:
+                self.hashmap[key] = value
+        self.map_lock.release()
+        self.sync()
+        return True
+
     def rem(self, key):
         """
         Delete entry in the hashmap.
@@ -78,8 +205,18 @@ class DHT():
         self.map_lock.acquire()
         del self.hashmap[key]
         self.map_lock.release()
+        self.sync()
         return True
 
+    def sync(self):
+        """
+        Wait until the writes made so far are on disk when the hashtable is kept on disk. The lock of the
+        hashtable is not held meanwhile so that the writes of several processes share an fsync.
+        :return: None
+        """
+        if self.durable:
+            self.hashmap.sync()
+
     def keys(self):
         """
         Get all the keys of the hashmap.
@@ -90,10 +227,181 @@ class DHT():
         self.map_lock.release()
         return keys_list
 
+    def key_chunks(self, chunk_size):
+        """
+        Get the keys of the hashmap by chunks, without copying them all to this process.
+        :param chunk_size: number of keys per chunk.
+        :return: generator of lists of keys.
+        """
+        self.map_lock.acquire()
+        listing_id = self.hashmap.open_key_chunks(chunk_size)
+        self.map_lock.release()
+        try:
+            while True:
+                chunk = self.hashmap.next_key_chunk(listing_id)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # the listing is dropped too when the caller stops early
+            self.hashmap.close_key_chunks(listing_id)
+
     def server_hash(self, key):
         """
         Compute the identifier of the peer to communicate with given a key/
         :param key: key to hash.
         :return: id of the peer to communicate with.
         """
-        return int(md5(key).hexdigest(), 16) % self.nodes_count
+        self.refresh_members()
+        return self.ring.lookup(key)
+
+    def replica_hash(self, key):
+        """
+        Compute the identifier of the peer keeping the replica of a key: the next node on the ring.
+        :param key: key to hash.
+        :return: id of the peer to communicate with.
+        """
+        self.refresh_members()
+        return self.ring.successors(key, 2)[-1]
+
+    def refresh_members(self):
+        """
+        Rebuild the rings of this process if the membership was changed by another process.
+        :return: None
+        """
+        version = self.members_version.value
+        if version == self.local_version:
+            return
+        self.nodes_list = list(self.members['nodes'])
+        self.nodes_count = len(self.nodes_list)
+        self.ring = HashRing(self.members['active'], self.vnodes)
+        previous = self.members['previous']
+        self.prev_ring = HashRing(previous, self.vnodes) if previous is not None else None
+        self.local_version = version
+
+    def _set_members(self, active, previous, nodes=None):
+        """
+        Change the membership seen by every process of this node.
+        :param active: ids of the nodes of the ring.
+        :param previous: ids of the nodes of the ring before the change, None once the keys are handed over.
+        :param nodes: addresses of the nodes, unchanged if None.
+        :return: None
+        """
+        with self.members_version.get_lock():
+            if nodes is not None:
+                self.members['nodes'] = nodes
+            self.members['active'] = active
+            self.members['previous'] = previous
+            self.members_version.value += 1
+        self.refresh_members()
+
+    def remote(self, sid, action, args):
+        """
+        Run an action on another node of the ring.
+        :param sid: id of the node.
+        :param action: name of the action.
+        :param args: arguments of the action.
+        :return: result of the action.
+        """
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.connect((self.nodes_list[sid], self.port))
+        try:
+            exch = MessageExchanger(sock)
+            exch.obj_send(dict(action=action, args=args))
+            return exch.obj_recv()
+        finally:
+            sock.close()
+
+    def handoff(self):
+        """
+        Send the entries this node does not keep anymore to the nodes that keep them since the last membership
+        change, by one message per node, and remove them from the local hashtable.
+        :return: number of entries removed.
+        """
+        self.refresh_members()
+        holders_count = 2 if self.replica > 0 else 1
+        moved = {}
+        removed = []
+        self.map_lock.acquire()
+        items = self.hashmap.items()
+        self.map_lock.release()
+        for key, value in items:
+            old_holders = self.prev_ring.successors(key, holders_count)
+            new_holders = self.ring.successors(key, holders_count)
+            for sid in new_holders:
+                if sid not in old_holders:
+                    moved.setdefault(sid, []).append((key, value))
+            if self.id not in new_holders:
+                removed.append(key)
+        for sid, items in moved.iteritems():
+            self.remote(sid, "migrate", [items])
+            self.logger.info("%d entries handed over to node %d.", len(items), sid)
+        self.map_lock.acquire()
+        for key in removed:
+            self.hashmap.pop(key, None)
+        self.map_lock.release()
+        self.sync()
+        return len(removed)
+
+    def add_node(self, ip):
+        """
+        Add a node joining the ring and hand over the entries it keeps from now on.
+        :param ip: address of the node.
+        :return: True
+        """
+        self.refresh_members()
+        nodes = list(self.nodes_list)
+        if ip not in nodes:
+            nodes.append(ip)
+        active = list(self.ring.nodes)
+        self._set_members(active + [nodes.index(ip)], active, nodes)
+        self.handoff()
+        self._set_members(list(self.ring.nodes), None)
+        return True
+
+    def remove_node(self, sid):
+        """
+        Remove a node leaving the ring. Its entries are read from it until it has handed them over.
+        :param sid: id of the node.
+        :return: True
+        """
+        self.refresh_members()
+        active = list(self.ring.nodes)
+        self._set_members([i for i in active if i != sid], active)
+        return True
+
+    def handoff_done(self, sid):
+        """
+        Take note that a leaving node handed over all its entries.
+        :param sid: id of the node.
+        :return: True
+        """
+        self.refresh_members()
+        self._set_members(list(self.ring.nodes), None)
+        return True
+
+    def join(self):
+        """
+        Join the ring of the other nodes of the config file: each of them hands over the entries of this node.
+        :return: None
+        """
+        others = [sid for sid in range(self.nodes_count) if sid != self.id]
+        self._set_members(range(self.nodes_count), others)
+        for sid in others:
+            self.remote(sid, "join", [self.ip])
+        self._set_members(range(self.nodes_count), None)
+
+    def leave(self):
+        """
+        Leave the ring: hand over all the entries of this node to the other nodes.
+        :return: None
+        """
+        self.refresh_members()
+        active = list(self.ring.nodes)
+        others = [sid for sid in active if sid != self.id]
+        for sid in others:
+            self.remote(sid, "leave", [self.id])
+        self._set_members(others, active)
+        self.handoff()
+        for sid in others:
+            self.remote(sid, "handoff_done", [self.id])
@@ -0,0 +1,422 @@
+import itertools
+import logging
+import mmap
+import os
+import pickle
+import struct
+import zlib
+
+from multiprocessing.managers import SyncManager, DictProxy
+from threading import Thread, Condition
+
+# The log follows PA2/dht/dht_log.py: the assignments are run on their own, so the few functions PA3 needs are
+# copied rather than imported from the other assignment.
+# a record is the crc of the rest of the record, an operation, the length of the key and of the value, and their
+# raw bytes
+RECORD = struct.Struct('>IBII')
+LOG_PUT = 1
+LOG_REM = 2
+# size of the log above which a snapshot of the dictionary is written and a new log is started
+SNAPSHOT_SIZE = 64 * 1024 ** 2
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+def encode_record(op, key, value=''):
+    """
+    Encode an operation of the log.
+    :param op: LOG_PUT or LOG_REM.
+    :param key: key written as a string.
+    :param value: value written as a string.
+    :return: record as a string.
+    """
+    body = RECORD.pack(0, op, len(key), len(value))[4:] + key + value
+    return struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body
+
+
+def read_records(path):
+    """
+    Read the valid records of a file: a record cut by a crash ends the file.
+    :param path: path of the file.
+    :return: iterator over the operation, key, value, and offset of the end of each record.
+    """
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size == 0:
+        return
+    with open(path, 'rb') as fd:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = 0
+        while offset + RECORD.size <= size:
+            crc, op, key_len, value_len = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + key_len + value_len
+            if end > size or zlib.crc32(data[offset + 4:end]) & 0xffffffff != crc:
+                break
+            key_start = offset + RECORD.size
+            yield op, data[key_start:key_start + key_len], data[key_start + key_len:end], end
+            offset = end
+    finally:
+        data.close()
+
+
+class WriteLog():
+    def __init__(self, path, snapshot_size=SNAPSHOT_SIZE):
+        """
+        Initialize an append-only log. Records are buffered and a writer thread writes and fsyncs everything
+        buffered at once, so concurrent writers share each fsync. When the log grows above snapshot_size, a new log
+        is started and a snapshot is written: at startup, the last complete snapshot is loaded and the logs that
+        follow it are replayed.
+        :param path: directory of the log and snapshot files.
+        :param snapshot_size: size of the log in bytes above which a snapshot is written.
+        :return: None
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.INFO)
+
+        self.path = path
+        self.snapshot_size = snapshot_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.cond = Condition()
+        self.buf = []
+        # sequence number of the last record appended and of the last record on disk
+        self.last_lsn = 0
+        self.synced_lsn = 0
+        self.gen = 0
+        self.log_fd = None
+        self.log_size = 0
+        self.items = None
+        self.snapshot_thread = None
+        self.closed = False
+        self.writer = None
+
+    def _file(self, name, gen):
+        return os.path.join(self.path, "%s.%d" % (name, gen))
+
+    def _gens(self, name):
+        gens = []
+        for f in os.listdir(self.path):
+            prefix, _, gen = f.partition('.')
+            if prefix == name and gen.isdigit():
+                gens.append(int(gen))
+        return sorted(gens)
+
+    def replay(self, put, rem):
+        """
+        Load the last snapshot and replay the logs written after it.
+        :param put: function called with the key and value of each write.
+        :param rem: function called with the key of each deletion.
+        :return: number of records read.
+        """
+        snapshots = self._gens("snapshot")
+        self.gen = snapshots[-1] if snapshots else 0
+        count = 0
+        for op, key, value, end in read_records(self._file("snapshot", self.gen)):
+            put(key, value)
+            count += 1
+        end = 0
+        for gen in [gen for gen in self._gens("log") if gen >= self.gen]:
+            end = 0
+            for op, key, value, end in read_records(self._file("log", gen)):
+                if op == LOG_PUT:
+                    put(key, value)
+                else:
+                    rem(key)
+                count += 1
+            self.gen = gen
+        # appends go after the last valid record of the last log
+        self.log_fd = os.open(self._file("log", self.gen), os.O_WRONLY | os.O_CREAT)
+        os.ftruncate(self.log_fd, end)
+        os.lseek(self.log_fd, end, os.SEEK_SET)
+        self.log_size = end
+        self.logger.info("%d records replayed from %s.", count, self.path)
+        return count
+
+    def start(self, items):
+        """
+        Start the writer thread.
+        :param items: function returning the records of a snapshot as (key, value) pairs.
+        :return: None
+        """
+        self.items = items
+        self.writer = Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def append(self, op, key, value=''):
+        """
+        Buffer a record.
+        :param op: LOG_PUT or LOG_REM.
+        :param key: key written as a string.
+        :param value: value written as a string.
+        :return: sequence number of the record.
+        """
+        record = encode_record(op, key, value)
+        with self.cond:
+            self.buf.append(record)
+            self.last_lsn += 1
+            self.cond.notify_all()
+            return self.last_lsn
+
+    def wait(self, lsn):
+        """
+        Wait until a record is on disk.
+        :param lsn: sequence number of the record.
+        :return: None
+        """
+        with self.cond:
+            while self.synced_lsn < lsn and not self.closed:
+                self.cond.wait()
+
+    def _write(self):
+        while True:
+            with self.cond:
+                while not self.buf and not self.closed:
+                    self.cond.wait()
+                if not self.buf:
+                    return
+                records, self.buf = self.buf, []
+                lsn = self.last_lsn
+            data = ''.join(records)
+            os.write(self.log_fd, data)
+            os.fsync(self.log_fd)
+            self.log_size += len(data)
+            with self.cond:
+                self.synced_lsn = lsn
+                self.cond.notify_all()
+            if self.log_size > self.snapshot_size and (
+                    self.snapshot_thread is None or not self.snapshot_thread.is_alive()):
+                self._rotate()
+
+    def _rotate(self):
+        # the new log is replayed on top of the snapshot
+        os.close(self.log_fd)
+        self.gen += 1
+        self.log_fd = os.open(self._file("log", self.gen), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        self.log_size = 0
+        self.snapshot_thread = Thread(target=self._snapshot, args=(self.gen,))
+        self.snapshot_thread.start()
+
+    def _snapshot(self, gen):
+        tmp_path = self._file("snapshot", gen) + ".tmp"
+        with open(tmp_path, 'wb') as fd:
+            fd.write(''.join(encode_record(LOG_PUT, key, value) for key, value in self.items()))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp_path, self._file("snapshot", gen))
+        dir_fd = os.open(self.path, os.O_RDONLY)
+        os.fsync(dir_fd)
+        os.close(dir_fd)
+        # the snapshot replaces the older snapshots and logs
+        for name in ["snapshot", "log"]:
+            for old_gen in self._gens(name):
+                if old_gen < gen:
+                    os.remove(self._file(name, old_gen))
+
+    def close(self):
+        """
+        Write the buffered records and stop the writer thread.
+        :return: None
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        os.close(self.log_fd)
+
+
+class IndexDict(dict):
+    """
+    Dictionary shared through a manager that also reads and writes entries by batches, in one call to the manager.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        # listings of the keys given by chunks, by id
+        self.listings = {}
+        self.listing_ids = itertools.count()
+
+    def get_many(self, keys):
+        """
+        Get the values of several keys.
+        :param keys: list of keys.
+        :return: list of the values of the keys, None for a missing key.
+        """
+        return [self.get(key) for key in keys]
+
+    def open_key_chunks(self, chunk_size):
+        """
+        List the keys once, in the process of the manager, to give them by chunks with next_key_chunk: through a
+        proxy, only one chunk at a time is copied to the caller, and the keys written meanwhile do not break the
+        iteration.
+        :param chunk_size: number of keys per chunk.
+        :return: id of the listing.
+        """
+        keys = self.keys()
+        listing_id = next(self.listing_ids)
+        self.listings[listing_id] = (keys[i:i+chunk_size] for i in xrange(0, len(keys), chunk_size))
+        return listing_id
+
+    def next_key_chunk(self, listing_id):
+        """
+        Give the next chunk of a listing of the keys.
+        :param listing_id: id given by open_key_chunks.
+        :return: list of keys, None once all the keys are given.
+        """
+        chunk = next(self.listings.get(listing_id, iter([])), None)
+        if chunk is None:
+            self.close_key_chunks(listing_id)
+        return chunk
+
+    def close_key_chunks(self, listing_id):
+        """
+        Forget a listing of the keys, whether all its chunks were given or not.
+        :param listing_id: id given by open_key_chunks.
+        :return: None
+        """
+        self.listings.pop(listing_id, None)
+
+    def append_many(self, items, previous=None):
+        """
+        Add values to the lists of several keys, skipping the values already in a list.
+        :param items: list of (key, values) pairs.
+        :param previous: dictionary giving the list of a key missing here, read from its former owner.
+        :return: None
+        """
+        for key, values in items:
+            current = self.get(key)
+            if current is None:
+                current = list(previous.get(key) or []) if previous else []
+            added = [v for v in values if v not in current]
+            if added or key not in self:
+                self[key] = current + added
+
+    def remove_many(self, items, previous=None):
+        """
+        Remove values from the lists of several keys, and delete the keys whose list becomes empty.
+        :param items: list of (key, values) pairs.
+        :param previous: dictionary giving the list of a key missing here, read from its former owner.
+        :return: None
+        """
+        for key, values in items:
+            current = self.get(key)
+            if current is None:
+                if not previous or not previous.get(key):
+                    continue
+                # an empty list is kept so that the handover does not restore the former list
+                self[key] = [v for v in previous[key] if v not in values]
+                continue
+            kept = [v for v in current if v not in values]
+            if not kept:
+                del self[key]
+            elif len(kept) < len(current):
+                self[key] = kept
+
+    def sync(self):
+        """
+        Wait until the writes made so far are on disk, nothing to wait for in memory.
+        :return: None
+        """
+        pass
+
+
+class DurableDict(IndexDict):
+    def __init__(self, path):
+        """
+        Initialize a dictionary whose writes are also appended to a log on disk. It is rebuilt from the log at
+        startup. A write returns before its record is on disk: sync waits until the writes made so far are on disk,
+        so that the writes of several processes share an fsync.
+        :param path: directory of the log and snapshot files.
+        :return: None
+        """
+        IndexDict.__init__(self)
+        self.log = WriteLog(path)
+        self.log.replay(self._replay_put, self._replay_rem)
+        self.log.start(self._snapshot_items)
+
+    def _replay_put(self, key, value):
+        dict.__setitem__(self, key, pickle.loads(value))
+
+    def _replay_rem(self, key):
+        dict.pop(self, key, None)
+
+    def _snapshot_items(self):
+        return [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in dict.items(self)]
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.log.append(LOG_PUT, key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.log.append(LOG_REM, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.log.append(LOG_REM, key)
+        return dict.pop(self, key, *default)
+
+    # the other writes of the dictionary exposed by the proxy go through the log as well
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.log.append(LOG_REM, key)
+        return key, value
+
+    def clear(self):
+        for key in dict.keys(self):
+            self.log.append(LOG_REM, key)
+        dict.clear(self)
+
+    def sync(self):
+        """
+        Wait until the writes made so far are on disk.
+        :return: None
+        """
+        self.log.wait(self.log.last_lsn)
+
+
+class IndexDictProxy(DictProxy):
+    _exposed_ = DictProxy._exposed_ + ('get_many', 'open_key_chunks', 'next_key_chunk', 'close_key_chunks',
+                                       'append_many', 'remove_many', 'sync')
+
+    def get_many(self, keys):
+        return self._callmethod('get_many', (keys,))
+
+    def open_key_chunks(self, chunk_size):
+        return self._callmethod('open_key_chunks', (chunk_size,))
+
+    def next_key_chunk(self, listing_id):
+        return self._callmethod('next_key_chunk', (listing_id,))
+
+    def close_key_chunks(self, listing_id):
+        return self._callmethod('close_key_chunks', (listing_id,))
+
+    def append_many(self, items, previous=None):
+        return self._callmethod('append_many', (items, previous))
+
+    def remove_many(self, items, previous=None):
+        return self._callmethod('remove_many', (items, previous))
+
+    def sync(self):
+        return self._callmethod('sync')
+
+
+class IndexManager(SyncManager):
+    pass
+
+
+IndexManager.register('IndexDict', IndexDict, IndexDictProxy)
+IndexManager.register('DurableDict', DurableDict, IndexDictProxy)
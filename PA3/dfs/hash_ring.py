@@ -0,0 +1,86 @@
+import struct
+
+from bisect import bisect_right
+from hashlib import md5
+
+# number of points of each node on the ring
+VNODES = 100
+TOKEN = struct.Struct('>Q')
+
+
+def token(key):
+    """
+    Compute the position of a key on the ring.
+    :param key: key to place on the ring.
+    :return: first 64 bits of the md5 of the key.
+    """
+    return TOKEN.unpack_from(md5(key).digest())[0]
+
+
+class HashRing():
+    def __init__(self, nodes, vnodes=VNODES):
+        """
+        Initialize a consistent hashing ring. Each node is placed at vnodes points of the ring and a key
+        belongs to the node of the first point following the key, so adding or removing a node only moves
+        the keys of the ranges it gains or loses.
+        :param nodes: ids of the nodes.
+        :param vnodes: number of points of each node on the ring.
+        :return: None
+        """
+        self.vnodes = vnodes
+        self.nodes = set(nodes)
+        self.tokens = []
+        self.owners = []
+        self._build()
+
+    def _build(self):
+        points = sorted((token("%s#%d" % (node, i)), node)
+                        for node in self.nodes for i in range(self.vnodes))
+        self.tokens = [t for t, node in points]
+        self.owners = [node for t, node in points]
+
+    def add(self, node):
+        """
+        Add a node to the ring.
+        :param node: id of the node.
+        :return: None
+        """
+        self.nodes.add(node)
+        self._build()
+
+    def remove(self, node):
+        """
+        Remove a node from the ring.
+        :param node: id of the node.
+        :return: None
+        """
+        self.nodes.discard(node)
+        self._build()
+
+    def lookup(self, key):
+        """
+        Get the node owning a key.
+        :param key: key to look up.
+        :return: id of the node.
+        """
+        i = bisect_right(self.tokens, TOKEN.unpack_from(md5(key).digest())[0])
+        if i == len(self.tokens):
+            i = 0
+        return self.owners[i]
+
+    def successors(self, key, count):
+        """
+        Get the first distinct nodes following a key on the ring.
+        :param key: key to look up.
+        :param count: number of nodes to return.
+        :return: list of node ids, starting with the owner of the key.
+        """
+        count = min(count, len(self.nodes))
+        i = bisect_right(self.tokens, token(key))
+        found = []
+        while len(found) < count:
+            node = self.owners[i % len(self.owners)]
+            if node not in found:
+                found.append(node)
+            i += 1
+        return found
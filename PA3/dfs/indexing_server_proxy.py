@@ -3,12 +3,16 @@ import sys
 import errno
 import logging
 import numpy as np
-import copy
 
 from hashlib import md5
+from threading import Thread
+from Queue import Queue
 from CommunicationProtocol import *
 from socket import *
 
+# number of file names in each message of a streamed list
+LIST_CHUNK_SIZE = 1000
+
 logging.basicConfig(level=logging.DEBUG)
 
 
@@ -41,6 +45,13 @@ class ISProxy():
         """
         return
 
+    def list_stream(self):
+        """
+        List the files stored in the indexing server by chunks, as soon as they are received.
+        :return: generator of lists of file names.
+        """
+        yield self.list()
+
     @abc.abstractmethod
     def register(self, id, name):
         """
@@ -51,6 +62,16 @@ class ISProxy():
         """
         return
 
+    @abc.abstractmethod
+    def register_many(self, id, names):
+        """
+        Register several files to the indexing server at once.
+        :param id: identifier of the peer.
+        :param names: names of the files to register.
+        :return: dictionary associating each name with the peers where the file needs to be replicated, or False.
+        """
+        return
+
     @abc.abstractmethod
     def search(self, id, name):
         """
@@ -68,41 +89,47 @@ class CentralizedISProxy(ISProxy):
 
     def init_connection(self, id):
         idx_action = dict(type='init', id=id)
-        self.exch.pkl_send(idx_action)
+        self.exch.obj_send(idx_action)
 
     def close_connection(self, id):
         idx_action = dict(type='close', id=id)
-        self.exch.pkl_send(idx_action)
+        self.exch.obj_send(idx_action)
 
     def list(self):
         idx_action = dict(type='list')
-        self.exch.pkl_send(idx_action)
-        return self.exch.pkl_recv()
+        self.exch.obj_send(idx_action)
+        return self.exch.obj_recv()
 
     def register(self, id, name):
         idx_action = dict(type='register', name=name, id=id)
-        self.exch.pkl_send(idx_action)
-        replicate_to = self.exch.pkl_recv()
+        self.exch.obj_send(idx_action)
+        replicate_to = self.exch.obj_recv()
         return replicate_to
 
+    def register_many(self, id, names):
+        idx_action = dict(type='register_many', names=names, id=id)
+        self.exch.obj_send(idx_action)
+        return self.exch.obj_recv()
+
     def search(self, id, name):
         idx_action = dict(type='search', id=id, name=name)
         # request indexing server
-        self.exch.pkl_send(idx_action)
-        available_peers = self.exch.pkl_recv()
+        self.exch.obj_send(idx_action)
+        available_peers = self.exch.obj_recv()
         return available_peers
 
 
 class DistributedISProxy(ISProxy):
     def __init__(self, parent):
         self.parent = parent
-        self.socket_map = [None] * self.parent.nodes_count
+        # nodes may join the ring: sockets are kept by node id
+        self.socket_map = {}
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.getLevelName(self.parent.log_level))
 
     def get_peer_sock(self, server_id):
         self.logger.debug("Server id requested: %s", repr(server_id))
-        if self.socket_map[server_id] is None:
+        if self.socket_map.get(server_id) is None:
             sock = socket(AF_INET, SOCK_STREAM)
             peer_ip = self.parent.nodes_list[server_id]
             try:
@@ -118,44 +145,188 @@ class DistributedISProxy(ISProxy):
         pass
 
     def close_connection(self, id):
-        for j, sock in enumerate(self.socket_map):
+        for j, sock in self.socket_map.items():
             if sock:
                 sock.shutdown(1)
                 sock.close()
             self.socket_map[j] = None
 
     def list(self):
-        ls = set(self.parent.keys())
-        for sid, ip in enumerate(self.parent.nodes_list):
-            if ip != self.parent.ip:
-                sock = self.get_peer_sock(sid)
-                if not sock:
-                    continue
-                self.logger.debug(repr(sock))
-                exch = MessageExchanger(sock)
-                dht_action = dict(action="keys", args=[])
-                exch.pkl_send(dht_action)
-                res = exch.pkl_recv()
-                ls |= set(res)
-        return list(ls)
+        ls = []
+        for chunk in self.list_stream():
+            ls.extend(chunk)
+        return ls
+
+    def list_stream(self, chunk_size=LIST_CHUNK_SIZE):
+        """
+        List the files of all the nodes: every node is asked at the same time, on a connection of its own, and
+        streams its keys by chunks, which are merged as they arrive, so that the first names are given before the
+        slowest node answers.
+        :param chunk_size: number of keys per message.
+        :return: generator of lists of file names not given before.
+        """
+        self.parent.refresh_members()
+        # the connections kept in socket_map serve the other requests: a stream the caller stops reading must not
+        # leave chunks on them
+        socks = {}
+        for sid in self.parent.ring.nodes:
+            if sid != self.parent.id:
+                sock = self._connect(sid)
+                if sock:
+                    socks[sid] = sock
+        chunks = Queue()
+        threads = [Thread(target=self._stream_keys, args=(sid, sock, chunk_size, chunks))
+                   for sid, sock in socks.items()]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            seen = set()
+            chunk = self.parent.keys()
+            done = 0
+            while True:
+                new = [name for name in chunk if name not in seen]
+                seen.update(new)
+                if new:
+                    yield new
+                # a node sends None once all its keys are sent
+                chunk = None
+                while chunk is None and done < len(threads):
+                    chunk = chunks.get()
+                    if chunk is None:
+                        done += 1
+                if chunk is None:
+                    break
+        finally:
+            # the caller stopped early or the stream is over: the readers stop on their closed connection
+            for sock in socks.values():
+                try:
+                    sock.shutdown(SHUT_RDWR)
+                except error:
+                    pass
+
+    def _connect(self, server_id):
+        """
+        Open a new connection to a node, besides the one kept in socket_map.
+        :param server_id: id of the node.
+        :return: connected socket, or None if the node is offline.
+        """
+        sock = socket(AF_INET, SOCK_STREAM)
+        try:
+            sock.connect((self.parent.nodes_list[server_id], self.parent.port))
+            return sock
+        except error as e:
+            self.logger.debug("Peer %s seems to be offline: %s", server_id, e)
+            sock.close()
+            return None
+
+    def _stream_keys(self, sid, sock, chunk_size, chunks):
+        """
+        Receive the keys of a node by chunks and put them in a queue, then close the connection.
+        :param sid: id of the node.
+        :param sock: connection of its own to the node.
+        :param chunk_size: number of keys per message.
+        :param chunks: queue receiving the chunks of keys, then None.
+        :return: None
+        """
+        try:
+            exch = MessageExchanger(sock)
+            exch.obj_send(dict(action="keys_stream", args=[chunk_size]))
+            while True:
+                chunk = exch.obj_recv()
+                if chunk is None:
+                    break
+                chunks.put(chunk)
+        except error as e:
+            self.logger.debug("Stream of the keys of %s interrupted: %s", sid, e)
+        finally:
+            sock.close()
+            chunks.put(None)
+
+    def _holders(self, replicate=True):
+        """
+        Functions giving the nodes keeping the list of peers of a name.
+        :param replicate: if True, the node keeping the replica is included.
+        :return: list of hash functions.
+        """
+        holders = [self.parent.server_hash]
+        if replicate and self.parent.replica > 0:
+            holders.append(self.parent.replica_hash)
+        return holders
 
     def _local_register(self, id, name, replicate=True):
-        previous_value = self._get(name)
-        self.logger.debug(repr(previous_value))
-        if previous_value is False:  # nodes are offline
+        """
+        Add a peer to the list of peers of a name with one atomic update on each node keeping the name.
+        :param id: identifier of the peer.
+        :param name: name of the file.
+        :param replicate: if True, the node keeping the replica is also updated.
+        :return: False if the nodes of the name are offline, else True.
+        """
+        results = [self._generic_action_sid(sid, "append_peer", [name, id]) for sid in self._holder_ids(name, replicate)]
+        self.logger.debug(repr(results))
+        if not any(results):  # nodes are offline
             return False
-        elif previous_value is None:
-            previous_value = []
-        if id not in previous_value:
-            previous_value.append(id)
-        self._put(name, previous_value, replicate=replicate)
+        return True
 
-    def register(self, id, name):
-        ret = self._local_register(id, name)
-        if ret is False:
-            return False
-        other_peers = copy.copy(self.parent.nodes_list)
-        other_peers.pop(self.parent.id)
+    def _holder_ids(self, name, replicate=True):
+        """
+        Give the ids of the nodes keeping the list of peers of a name.
+        :param name: name of the file.
+        :param replicate: if True, the node keeping the replica is included.
+        :return: list of node ids, without duplicates.
+        """
+        sids = []
+        for hash_func in self._holders(replicate):
+            sid = hash_func(name)
+            if sid not in sids:
+                sids.append(sid)
+        return sids
+
+    def _local_register_many(self, id, names, replicate_to):
+        """
+        Register several names as register does, with one atomic update per node keeping some of the names instead
+        of one per name: the node of a name gets the peer and the peers of its copies, the node keeping the replica
+        only gets the peer.
+        :param id: identifier of the peer.
+        :param names: names of the files.
+        :param replicate_to: peers where the files are copied.
+        :return: False if the nodes of a name are offline, else True.
+        """
+        stored = set()
+        owners = self._group(names, self.parent.server_hash)
+        for sid, sid_names in owners.iteritems():
+            items = [(name, [id] + replicate_to) for name in sid_names]
+            if self._generic_action_sid(sid, "append_peers", [items]):
+                stored.update(sid_names)
+        for hash_func in self._holders()[1:]:
+            for sid, sid_names in self._group(names, hash_func).iteritems():
+                # the node of a name may also keep its replica
+                owned = set(owners.get(sid, ()))
+                items = [(name, [id]) for name in sid_names if name not in owned]
+                if items and self._generic_action_sid(sid, "append_peers", [items]):
+                    stored.update(name for name, peers in items)
+        return len(stored) == len(names)
+
+    def _group(self, names, hash_func):
+        """
+        Group names by node.
+        :param names: list of names.
+        :param hash_func: function giving the id of the node of a name.
+        :return: dictionary associating a node id with its names.
+        """
+        groups = {}
+        for name in names:
+            groups.setdefault(hash_func(name), []).append(name)
+        return groups
+
+    def _replicate_to(self):
+        """
+        Choose the peers where a registered file is copied.
+        :return: list of peer ids.
+        """
+        self.parent.refresh_members()
+        other_peers = [self.parent.nodes_list[sid] for sid in sorted(self.parent.ring.nodes)
+                       if sid != self.parent.id]
         other_peers = [":".join([x, str(self.parent.config['file_server_port'])]) for x in other_peers]
         nb_replica = self.parent.replica
         replicate_to = []
@@ -164,11 +335,52 @@ class DistributedISProxy(ISProxy):
         elif len(other_peers) < nb_replica:
             replicate_to = other_peers
         else:
-            replicate_to = np.random.choice(other_peers, nb_replica)
+            # plain strings: the numpy ones would not be unpickled by the compact codec of the DHT nodes
+            replicate_to = [str(k) for k in np.random.choice(other_peers, nb_replica)]
+        return replicate_to
+
+    def register(self, id, name):
+        ret = self._local_register(id, name)
+        if ret is False:
+            return False
+        replicate_to = self._replicate_to()
         for k in replicate_to:
             self._local_register(k, name, replicate=False)
         return replicate_to
 
+    def register_many(self, id, names):
+        # the copies of the whole batch go to the same peers
+        replicate_to = list(self._replicate_to())
+        if self._local_register_many(id, names, replicate_to) is False:
+            return False
+        return dict((name, replicate_to) for name in names)
+
+    def unregister(self, id, name):
+        """
+        Remove a peer from the list of peers of a name with one atomic update on each node keeping the name.
+        :param id: identifier of the peer.
+        :param name: name of the file.
+        :return: False if the nodes of the name are offline, else True.
+        """
+        results = [self._generic_action_sid(sid, "remove_peer", [name, id]) for sid in self._holder_ids(name)]
+        return any(results)
+
+    def unregister_many(self, id, names):
+        """
+        Remove a peer from the lists of peers of several names, with one atomic update per node keeping some of the
+        names instead of one per name.
+        :param id: identifier of the peer.
+        :param names: names of the files.
+        :return: False if the nodes of a name are offline, else True.
+        """
+        removed = set()
+        for hash_func in self._holders():
+            for sid, sid_names in self._group(names, hash_func).iteritems():
+                items = [(name, [id]) for name in sid_names]
+                if self._generic_action_sid(sid, "remove_peers", [items]):
+                    removed.update(sid_names)
+        return len(removed) == len(names)
+
     def search(self, id, name):
         available_peers = self._get(name)
         if available_peers and id in available_peers:
@@ -190,20 +402,20 @@ class DistributedISProxy(ISProxy):
                 return False
             exch = MessageExchanger(sock)
             dht_action = dict(action=action, args=args)
-            exch.pkl_send(dht_action)
-            res = exch.pkl_recv()
+            exch.obj_send(dht_action)
+            res = exch.obj_recv()
         return res
 
     def _put(self, key, value, replicate=True):
         sid = self.parent.server_hash(key)
         if replicate and self.parent.replica > 0:
-            sid_replica = (sid + 1) % self.parent.nodes_count
+            sid_replica = self.parent.replica_hash(key)
             self._generic_action_sid(sid_replica, "put", [key, value])
         return self._generic_action_sid(sid, "put", [key, value])
 
     def _get(self, key):
         sid = self.parent.server_hash(key)
-        sid_replica = (sid + 1) % self.parent.nodes_count
+        sid_replica = self.parent.replica_hash(key)
         sids = [sid, sid_replica]
         obtained = False
         while obtained == False and sids:
@@ -214,7 +426,7 @@ class DistributedISProxy(ISProxy):
 
     def _del(self, key):
         sid = self.parent.server_hash(key)
-        sid_replica = (sid + 1) % self.parent.nodes_count
+        sid_replica = self.parent.replica_hash(key)
         sids = [sid, sid_replica]
         for sid in sids:
             self._generic_action_sid(sid, "rem", [key])
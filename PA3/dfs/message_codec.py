@@ -0,0 +1,190 @@
+from cStringIO import StringIO
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# The compact encoding of a message is a tag byte followed by a list of strings, each terminated by a NUL byte:
+# file names and peer ids never contain one, and the few strings that do are pickled. Tags are below 0x20 so
+# that they never start a pickle, whatever its protocol: a compact codec still reads messages pickled by an
+# older peer, and pickles the messages without schema.
+SEP = '\0'
+# the only globals a pickle read by the compact codec may load: the messages without schema are plain data
+SAFE_GLOBALS = set([('__builtin__', 'set'), ('__builtin__', 'frozenset')])
+
+T_NONE = 1
+T_TRUE = 2
+T_FALSE = 3
+T_STR_LIST = 4
+# requests of the indexing server and of the file server: dict(type=..., <fields>)
+T_SEARCH = 8
+T_REGISTER = 9
+T_OBTAIN = 10
+# requests of the distributed indexing server: dict(action=..., args=[...])
+T_GET = 16
+T_PUT = 17
+T_REM = 18
+T_APPEND_PEER = 19
+T_REMOVE_PEER = 20
+
+# fields of the requests with a 'type', in the order they are encoded
+TYPE_SCHEMAS = {
+    'search': (T_SEARCH, ('id', 'name')),
+    'register': (T_REGISTER, ('id', 'name')),
+    'obtain': (T_OBTAIN, ('name',))
+}
+# number of string arguments of the requests with an 'action', a put is followed by the list of peers of its key
+ACTION_SCHEMAS = {
+    'get': (T_GET, 1),
+    'put': (T_PUT, 1),
+    'rem': (T_REM, 1),
+    'append_peer': (T_APPEND_PEER, 2),
+    'remove_peer': (T_REMOVE_PEER, 2)
+}
+CONSTANTS = {T_NONE: None, T_TRUE: True, T_FALSE: False}
+TAG_TYPES = dict((tag, (t, fields)) for t, (tag, fields) in TYPE_SCHEMAS.items())
+TAG_ACTIONS = dict((tag, action) for action, (tag, _) in ACTION_SCHEMAS.items())
+ENCODED_NONE, ENCODED_TRUE, ENCODED_FALSE = chr(T_NONE), chr(T_TRUE), chr(T_FALSE)
+
+
+def encode_strings(tag, strings):
+    """
+    Encode a tag and a list of strings.
+    :param tag: tag of the message.
+    :param strings: list of strings.
+    :return: encoded message as a string, or None if an element is not a str or contains a NUL byte.
+    """
+    for s in strings:
+        if not isinstance(s, str):
+            return None
+    if not strings:
+        return chr(tag)
+    body = SEP.join(strings)
+    # one pass in C instead of a test per string
+    if body.count(SEP) != len(strings) - 1:
+        return None
+    return chr(tag) + body + SEP
+
+
+def _find_global(module, name):
+    if (module, name) not in SAFE_GLOBALS:
+        raise pickle.UnpicklingError("pickled message refers to %s.%s" % (module, name))
+    return getattr(__import__(module), name)
+
+
+def safe_loads(data):
+    """
+    Unpickle a message made of plain data only: any other class or function in the pickle is refused, so that a
+    peer cannot make this process run code.
+    :param data: pickled message.
+    :return: python object.
+    """
+    unpickler = pickle.Unpickler(StringIO(data))
+    # cPickle looks the globals up with find_global, pickle with find_class
+    if pickle.__name__ == 'cPickle':
+        unpickler.find_global = _find_global
+    else:
+        unpickler.find_class = _find_global
+    return unpickler.load()
+
+
+class PickleCodec:
+    """
+    Encode any python object with pickle. Unpickling runs any code the sender chooses: only use it between trusted
+    peers.
+    """
+    def encode(self, obj):
+        """
+        Encode a python object.
+        :param obj: python object to encode.
+        :return: encoded object as a string.
+        """
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        """
+        Decode a message.
+        :param data: encoded object as a string.
+        :return: python object.
+        """
+        return pickle.loads(data)
+
+
+class CompactCodec(PickleCodec):
+    """
+    Encode the messages of the hot actions (search, register, obtain, get, put, rem, append_peer, remove_peer and
+    their answers) with a fixed schema, without pickle. The other messages are pickled, and only unpickled when
+    they are made of plain data.
+    """
+    def _encode_compact(self, obj):
+        """
+        Encode a message with a fixed schema.
+        :param obj: python object to encode.
+        :return: encoded message, or None if the message has no schema.
+        """
+        cls = obj.__class__
+        if cls is dict:
+            if 'action' in obj:
+                schema = ACTION_SCHEMAS.get(obj['action'])
+                if schema is None or len(obj) != 2:
+                    return None
+                tag, n = schema
+                args = obj['args']
+                if tag == T_PUT:
+                    # key followed by the list of peers
+                    if len(args) == 2 and args[1].__class__ is list:
+                        return encode_strings(tag, [args[0]] + args[1])
+                elif len(args) == n:
+                    return encode_strings(tag, args)
+            elif 'type' in obj:
+                schema = TYPE_SCHEMAS.get(obj['type'])
+                if schema is not None and len(obj) == len(schema[1]) + 1:
+                    return encode_strings(schema[0], [obj.get(f) for f in schema[1]])
+        elif cls is list:
+            return encode_strings(T_STR_LIST, obj)
+        elif obj is None:
+            return ENCODED_NONE
+        elif obj is True:
+            return ENCODED_TRUE
+        elif obj is False:
+            return ENCODED_FALSE
+        return None
+
+    def encode(self, obj):
+        data = self._encode_compact(obj)
+        if data is None:
+            return PickleCodec.encode(self, obj)
+        return data
+
+    def decode(self, data):
+        tag = ord(data[0])
+        if tag >= 0x20:
+            return safe_loads(data)
+        elif tag in CONSTANTS:
+            return CONSTANTS[tag]
+        # list of strings, decoded inline: on the small hot messages a call costs as much as the decoding
+        if len(data) == 1:
+            strings = []
+        elif data[-1] == SEP:
+            strings = data[1:-1].split(SEP)
+        else:
+            raise ValueError("truncated compact message")
+        if tag in TAG_ACTIONS:
+            if tag == T_PUT:
+                return {'action': 'put', 'args': [strings[0], strings[1:]]}
+            return {'action': TAG_ACTIONS[tag], 'args': strings}
+        elif tag in TAG_TYPES:
+            t, fields = TAG_TYPES[tag]
+            obj = dict(zip(fields, strings))
+            obj['type'] = t
+            return obj
+        elif tag == T_STR_LIST:
+            return strings
+        raise ValueError("unknown message tag %d" % tag)
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'compact': CompactCodec
+}
@@ -6,8 +6,9 @@ import json
 import sys
 import os
 
-from urllib2 import urlopen
+from CommunicationProtocol import MessageExchanger
 from distributed_indexing_server import DHT
+from node_identity import resolve_ip, bind_address
 from peer_client import PeerClient
 from peer_server import PeerServer
 
@@ -34,7 +35,11 @@ class Node:
         self.log_level = config['log_level']
         self.timeout_value = config['timeout_value']
         self.max_connections = config['max_connections']
-        self.ip = str(json.load(urlopen('https://api.ipify.org/?format=json'))['ip'])
+        # encoding of the messages exchanged with the other nodes and the indexing server
+        MessageExchanger.set_codec(config.get('codec', 'compact'))
+        # address of this node, found locally when the config does not give it
+        self.ip = resolve_ip(config)
+        self.bind_ip = bind_address(self.ip)
 
         # set up logger
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -63,7 +68,7 @@ class Node:
         self.client = PeerClient(self)
         self.file_server = PeerServer(self)
         if self.idx_type == 'distributed':
-            self.dht = DHT(config, self.terminate)
+            self.dht = DHT(config, self.terminate, ip=self.ip)
 
     def run(self):
         """
@@ -92,17 +97,20 @@ class Node:
 
 
 def print_usage(args):
-    print("Usage: python %s config.json" % args[0])
+    print("Usage: python %s config.json [id]" % args[0])
     sys.exit(1)
 
 
 if __name__ == '__main__':
     # parse arguments
     args = sys.argv
-    if len(args) != 2:
+    if len(args) not in [2, 3]:
         print_usage(args)
     with open(args[1]) as config_fd:
         run_args = json.load(config_fd)
+    if len(args) == 3:
+        # position of this node in the nodes list of the config
+        run_args['id'] = int(args[2])
 
     peer = Node(run_args)
     peer.run()
@@ -0,0 +1,63 @@
+import json
+
+from urllib2 import urlopen
+from socket import *
+
+IPIFY_URL = 'https://api.ipify.org/?format=json'
+# the public ip service is only asked when no configured address is local
+IPIFY_TIMEOUT = 5
+
+
+def is_local_ip(ip):
+    """
+    Check if an address belongs to an interface of this machine, without sending anything on the network.
+    :param ip: address to check.
+    :return: True if a socket can be bound to this address.
+    """
+    sock = socket(AF_INET, SOCK_DGRAM)
+    try:
+        sock.bind((ip, 0))
+        return True
+    except (error, gaierror):
+        return False
+    finally:
+        sock.close()
+
+
+def public_ip(timeout=IPIFY_TIMEOUT):
+    """
+    Ask a public service for the address of this machine as seen from the internet.
+    :param timeout: maximum time in seconds to wait for the answer.
+    :return: public ip address of this machine.
+    """
+    return str(json.load(urlopen(IPIFY_URL, timeout=timeout))['ip'])
+
+
+def resolve_ip(config):
+    """
+    Find the address under which the other peers reach this node: the `ip` of the config if given, else the
+    address of the config nodes list that belongs to this machine, else the public address.
+    :param config: configuration parameters given as a python dictionary.
+    :return: ip address of this node.
+    """
+    if config.get('ip'):
+        return str(config['ip'])
+    if config.get('id') is not None:
+        return str(config['nodes'][config['id']])
+    local_ips = [ip for ip in config.get('nodes', []) if is_local_ip(ip)]
+    if len(local_ips) > 1:
+        raise ValueError("nodes %s are all on this machine: give the id of the node." % local_ips)
+    if local_ips:
+        return str(local_ips[0])
+    # behind a NAT, as on EC2, the public ip is not an interface address
+    return public_ip()
+
+
+def bind_address(ip):
+    """
+    Pick the address the servers of a node listen on.
+    :param ip: address of the node.
+    :return: the address of the node if it is local, so that several nodes can run on one machine, else all the
+    interfaces.
+    """
+    return ip if is_local_ip(ip) else "0.0.0.0"
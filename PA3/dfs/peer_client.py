@@ -1,4 +1,5 @@
 import glob
+import fnmatch
 import logging
 import random
 import time
@@ -55,10 +56,13 @@ class PeerClient(Process):
             'lookup': self._lookup,
             'search': self._search,
             'register': self._register,
+            'unregister': self._unregister,
             'list': self._ls,
             'help': self._display_help,
             'ls': self._local_ls,
-            'benchmark': self._benchmark
+            'benchmark': self._benchmark,
+            'join': self._join,
+            'leave': self._leave
         }
 
     def _benchmark1(self, cmd):
@@ -128,6 +132,29 @@ class PeerClient(Process):
         self.close_connection()
         return True, None
 
+    def _join(self):
+        """
+        Join the ring of the distributed indexing server: the other nodes hand over the entries of this node.
+        :return: False, True if the node joined.
+        """
+        if self.parent.idx_type != 'distributed':
+            self.logger.error("join is only available with a distributed indexing server.")
+            return False, False
+        self.parent.dht.join()
+        return False, True
+
+    def _leave(self):
+        """
+        Hand over the entries of this node to the other nodes of the distributed indexing server and shut down.
+        :return: True, True if the node left.
+        """
+        if self.parent.idx_type != 'distributed':
+            self.logger.error("leave is only available with a distributed indexing server.")
+            return False, False
+        self.parent.dht.leave()
+        self._exit()
+        return True, True
+
     def _get_peer_sock(self, peer_id):
         addr, port = peer_id.split(':')
         self.logger.debug(addr)
@@ -176,9 +203,9 @@ class PeerClient(Process):
             if peer_sock:
                 peer_exch = MessageExchanger(peer_sock)
                 peer_action = dict(type='obtain', name=name)
-                peer_exch.pkl_send(peer_action)
+                peer_exch.obj_send(peer_action)
                 f_path = os.path.join(self.download_dir, name)
-                file_exists = peer_exch.pkl_recv()
+                file_exists = peer_exch.obj_recv()
                 if file_exists:
                     peer_exch.file_recv(f_path, show_progress=False)
                     file_obtained = True
@@ -212,12 +239,7 @@ class PeerClient(Process):
         :return: False, True if replication has been done or False otherwise.
         """
         if regex != False:
-            files = glob.glob(f_path)
-            results = []
-            for f in files:
-                term, ret = self._register(f)
-                results.append(ret)
-            return False, Counter(results)
+            return False, self._register_many(glob.glob(f_path))
 
         if not os.path.isfile(f_path):
             self.logger.error("%s does not exist or is not a file." % f_path)
@@ -244,11 +266,87 @@ class PeerClient(Process):
                 if peer_sock:
                     peer_exch = MessageExchanger(peer_sock)
                     peer_action = dict(type='replicate', name=name)
-                    peer_exch.pkl_send(peer_action)
+                    peer_exch.obj_send(peer_action)
                     peer_exch.file_send(f_path)
 
         return False, True
 
+    def _register_many(self, paths):
+        """
+        Register files by batch: one request to the indexing server for all the files, then the copies of the files
+        are streamed to each replica peer on one connection.
+        :param paths: paths of the files to register.
+        :return: Counter of True for the files registered and False for the others.
+        """
+        files = {}
+        results = Counter()
+        for f_path in paths:
+            if os.path.isfile(f_path):
+                files[os.path.basename(f_path)] = f_path
+            else:
+                self.logger.error("%s does not exist or is not a file." % f_path)
+                results[False] += 1
+        if not files:
+            return results
+
+        # Register to the indexing server
+        replicate_to = self.idx_server_proxy.register_many(self.id, files.keys())
+        if replicate_to == False:
+            self.logger.debug("Main node and replica are done for metadata.")
+            results[False] += len(files)
+            return results
+
+        # Register locally
+        self.parent.local_files.update(dict((name, os.path.abspath(f_path)) for name, f_path in files.iteritems()))
+
+        # Replicate files, grouped by peer
+        names_by_peer = {}
+        for name, peers in replicate_to.iteritems():
+            for peer_id in peers:
+                names_by_peer.setdefault(peer_id, []).append(name)
+        for peer_id, names in names_by_peer.iteritems():
+            self.logger.debug("Replicate %d files to %s", len(names), peer_id)
+            peer_sock = self._get_peer_sock(peer_id)
+            if peer_sock:
+                peer_exch = MessageExchanger(peer_sock)
+                peer_action = dict(type='replicate_many', names=names)
+                peer_exch.obj_send(peer_action)
+                for name in names:
+                    peer_exch.file_send(files[name])
+
+        results[True] += len(files)
+        return results
+
+    def _unregister(self, name, regex=False):
+        """
+        Remove this peer from the peers of a registered file in the distributed indexing server. The copies made on
+        the replica peers stay registered.
+        :param name: name of the file to unregister.
+        :param regex: if not False, then name is processed as a pattern matching the names of the local files.
+        :return: False, True if the files have been unregistered.
+        """
+        if self.parent.idx_type != 'distributed':
+            self.logger.error("unregister is only available with a distributed indexing server.")
+            return False, False
+        local_files = self.parent.local_files
+        if regex != False:
+            names = fnmatch.filter(local_files.keys(), name)
+        else:
+            names = [name] if name in local_files else []
+        if not names:
+            self.logger.error("%s does not match any registered file." % name)
+            return False, False
+
+        if len(names) == 1:
+            ret = self.idx_server_proxy.unregister(self.id, names[0])
+        else:
+            ret = self.idx_server_proxy.unregister_many(self.id, names)
+        if ret:
+            for f_name in names:
+                local_files.pop(f_name, None)
+            self.parent.local_files = local_files
+        return False, ret
+
     def _local_ls(self, regex="./*"):
         """
         Print a list of local files matched by a given regular expression.
@@ -267,10 +365,13 @@ class PeerClient(Process):
         :param pprint: if True, print one file name per line.
         :return: False, list of all available files.
         """
-        available_files = self.idx_server_proxy.list()
-        if pprint != False:
-            for f in available_files:
-                print f
+        available_files = []
+        # the names are printed as they are received from the nodes
+        for chunk in self.idx_server_proxy.list_stream():
+            available_files.extend(chunk)
+            if pprint != False:
+                for f in chunk:
+                    print f
         return False, available_files
 
     def _display_help(self):
@@ -283,9 +384,12 @@ class PeerClient(Process):
             'lookup': 'Download a given file from an available peer.',
             'search': 'Return the list of other peers having a given file.',
             'register': 'Register a given file to the indexing server.',
+            'unregister': 'Remove this peer from the peers of a registered file.',
             'ls': 'Local listing of files',
             'list': 'List all the available files through the indexing server.',
             'help': 'Display the help screen.',
+            'join': 'Join the ring of the distributed indexing server.',
+            'leave': 'Hand over the entries of this node to the other nodes and shut down.',
         }
         keys = sorted(help_ui.keys())
         for k in keys:
@@ -311,7 +415,7 @@ class PeerClient(Process):
                 try:
                     exch = MessageExchanger(sock)
                     peer_action = dict(type='exit', id=peer_id)
-                    exch.pkl_send(peer_action)
+                    exch.obj_send(peer_action)
                     sock.shutdown(1)
                     sock.close()
                 except error:
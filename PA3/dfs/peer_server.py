@@ -27,13 +27,14 @@ class PeerServer(Process):
         self.actions = {
             'obtain': self._obtain,
             'replicate': self._recv_replica,
+            'replicate_many': self._recv_replicas,
             'exit': self._close_socket
         }
         self.ip = parent.ip
         self.port = parent.file_server_port
         self.listening_socket = socket(AF_INET, SOCK_STREAM)
         self.listening_socket.setblocking(0)
-        self.listening_socket.bind(("0.0.0.0", self.port))
+        self.listening_socket.bind((parent.bind_ip, self.port))
         self.listening_socket.listen(parent.max_connections)
 
 
@@ -49,11 +50,11 @@ class PeerServer(Process):
         """
         try:
             fpath = self.parent.local_files[name]
-            exch.pkl_send(True)
+            exch.obj_send(True)
             exch.file_send(fpath)
             return True
         except KeyError as e:
-            exch.pkl_send(False)
+            exch.obj_send(False)
             return True
 
     def _recv_replica(self, exch, name):
@@ -70,6 +71,22 @@ class PeerServer(Process):
         exch.file_recv(fpath, show_progress=False)
         return True
 
+    def _recv_replicas(self, exch, names):
+        """
+        Action executed when another peer pushes the replicas of several files to this peer, one after the other.
+        :param exch: MessageExchanger with the peer that made the request.
+        :param names: names of the files pushed, in the order they are sent.
+        :return: True, False if the connection was closed before the last file.
+        """
+        received = {}
+        for name in names:
+            fpath = os.path.join(self.parent.download_dir, name)
+            if exch.file_recv(fpath, show_progress=False) is None:
+                break
+            received[name] = os.path.abspath(fpath)
+        self.parent.local_files.update(received)
+        return len(received) == len(names)
+
     def _generic_action(self, action):
         """
         Parse the action given as a parameter and call the corresponding function.
@@ -93,7 +110,7 @@ class PeerServer(Process):
         open_conn = True
         while open_conn != False:
             self.logger.debug("%s: %s", repr(peer_sock), open_conn)
-            action = peer_exch.pkl_recv()
+            action = peer_exch.obj_recv()
             if action is None:
                 break
             self.logger.debug(repr(action))
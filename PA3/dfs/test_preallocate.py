@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from socket import socketpair
+from CommunicationProtocol import MessageExchanger, posix_fallocate
+
+
+class PreallocateTest(unittest.TestCase):
+    def setUp(self):
+        self.socks = socketpair()
+        self.exch = MessageExchanger(self.socks[0])
+        # not /tmp: it may be a tmpfs
+        self.dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        shutil.rmtree(self.dir)
+
+    @unittest.skipIf(posix_fallocate is None, "posix_fallocate is not available")
+    def test_blocks_reserved(self):
+        size = 8 * 1024 ** 2
+        path = os.path.join(self.dir, 'f')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            self.exch._preallocate(fd, size)
+        finally:
+            os.close(fd)
+        st = os.stat(path)
+        self.assertEqual(st.st_size, size)
+        # a sparse file of this size would have no block
+        self.assertGreaterEqual(st.st_blocks * 512, size)
+
+
+if __name__ == '__main__':
+    unittest.main()
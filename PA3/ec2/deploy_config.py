@@ -10,6 +10,7 @@ default_distributed = {
     'idx_type': 'distributed',
     'log_level': log_level,
     'replica': 0,
+    'vnodes': 100,
     'max_connections': 20,
     'download_dir': download_dir,
     'timeout_value': 0.2,
@@ -3,9 +3,17 @@ import json
 import os
 
 from time import time
-from urllib2 import urlopen
 
-ip = str(json.load(urlopen('https://api.ipify.org/?format=json'))['ip'])
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dfs'))
+from node_identity import resolve_ip
+
+# the files of a node are named after its address, found the same way as the node does from its config
+config_path = sys.argv[1] if len(sys.argv) > 1 else '../dfs/config.json'
+config = {}
+if os.path.exists(config_path):
+    with open(config_path) as config_fd:
+        config = json.load(config_fd)
+ip = resolve_ip(config)
 
 # generate files for first experiment
 def files_exp1(): # around 10 seconds
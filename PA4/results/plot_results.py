@@ -119,6 +119,25 @@ def plot_avg(measure_type, tofile=None):
     else:
         plt.show()
 
+def plot_percentiles(op_type, latencies, tofile=None):
+    """Plot the p50 and p99 latencies recorded by the PyDHT nodes."""
+    fig, ax = plt.subplots()
+    by_nodes = latencies[op_type]
+    nodes = sorted(by_nodes)
+    for p, fmt in [('p50', 'r*:'), ('p99', 'r^-')]:
+        plt.errorbar(nodes, [by_nodes[n][p] for n in nodes], fmt=fmt, label='PyDHT ' + p)
+    ax.set_xticks(nodes)
+    ax.set_xlabel('Number of concurrent nodes.')
+    ax.set_xlim([0, max(nodes) + 1])
+    ax.set_ylabel('Latency in ms for %s operations.' % op_type)
+    lgd = plt.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
+                     ncol=2, mode="expand", borderaxespad=0.)
+    plt.grid(True)
+    if tofile is not None:
+        plt.savefig(tofile, bbox_extra_artists=(lgd,), bbox_inches='tight')
+    else:
+        plt.show()
+
 
 for metric in ['latency', 'throughput']:
     for op in op_types:
@@ -126,3 +145,9 @@ for metric in ['latency', 'throughput']:
 # plot_latency('put', 1000., tofile='latency_put.png')
 # plot_throughput('put', 1000., tofile='throughput_put.png')
     plot_avg(metric, tofile='avg_' + metric + '.png')
+
+# percentiles of the histograms recorded by "benchmark mixed", if any
+pydht_latencies = pydht.load_results()
+for op in op_types:
+    if op in pydht_latencies:
+        plot_percentiles(op, pydht_latencies, tofile='pydht_latency_' + op + '.png')
@@ -1,3 +1,13 @@
+import glob
+import json
+import os
+
+# results written by the "benchmark mixed" command of the PA2 nodes, one
+# file per node, in pydht/<number of nodes>/
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pydht')
+OP_NAMES = {'put': 'put', 'get': 'get', 'del': 'delete'}
+PERCENTILES = [50, 99]
+
 put = {
     1: [14.169],
     2: [15.570,14.706],
@@ -21,3 +31,37 @@ delete = {
     8: [16.287,17.076,16.224,16.621,16.468,16.345,16.412,16.109],
     16: [18.604,18.735,19.012,18.534,18.127,18.659,18.174,18.415,18.102,18.338,18.015,18.645,18.453,18.990,18.558,18.391]
 }
+
+
+def percentile(histogram, p):
+    """Return the lower bound in ms of the bucket holding the p-th percentile
+    of a histogram given as {lower bound in microseconds: count}."""
+    count = sum(histogram.values())
+    if not count:
+        return 0.
+    rank = p / 100. * count
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            return bucket / 1000.
+    return max(histogram) / 1000.
+
+def load_results(results_dir=RESULTS_DIR, percentiles=PERCENTILES):
+    """Merge the latency histograms recorded by all the nodes of each run and
+    return the latency percentiles in ms, as {op: {number of nodes: {'p50':
+    ..., 'p99': ...}}}. Return an empty dict when there is no result."""
+    histograms = {}
+    for path in sorted(glob.glob(os.path.join(results_dir, '*', '*.json'))):
+        with open(path) as results_fd:
+            res = json.load(results_fd)
+        for op, op_res in res['operations'].items():
+            merged = histograms.setdefault(OP_NAMES[op], {}).setdefault(res['nodes'], {})
+            for bucket, count in op_res['histogram']:
+                merged[bucket] = merged.get(bucket, 0) + count
+    latencies = {}
+    for op, by_nodes in histograms.items():
+        for nodes, histogram in by_nodes.items():
+            latencies.setdefault(op, {})[nodes] = dict(
+                ('p%d' % p, percentile(histogram, p)) for p in percentiles)
+    return latencies